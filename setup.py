@@ -44,7 +44,9 @@ setup(name='Spikepy',
                                            'results_icon.png',
                                            'underline.png']},
     scripts=['spikepy/scripts/spikepy_gui.py', 
-             'spikepy/scripts/spikepy_plugin_info.py'],
+             'spikepy/scripts/spikepy_plugin_info.py',
+             'spikepy/scripts/spikepy_batch.py',
+             'spikepy/scripts/spikepy_worker.py'],
     license='GPL',
     platforms = ['windows', 'mac', 'linux']
     )
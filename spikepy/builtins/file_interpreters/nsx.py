@@ -2,7 +2,7 @@
 Written by Jeff Pobst 2012 while referencing code by Kaushik Ghose 2009
 David, if you end up using this, feel free to update this section as appropriate.
 """
-#NOTE get_recording_length and read_data_file work if there is only one data 
+#NOTE get_num_timesteps and read_data_file work if there is only one data 
 # packet (i.e. there were no pauses during the recording).  These could be made 
 # more general by heading in metadata from the data packets to know when 
 # subsequent data packets start
@@ -14,6 +14,7 @@ import struct
 import wx
 
 from spikepy.developer.file_interpreter import FileInterpreter, Trial
+from spikepy.common.lazy_traces import LazyTraces
 from spikepy.gui.named_controls import NamedTextCtrl
 
 class SettingsDialog(wx.Dialog):
@@ -54,6 +55,8 @@ class SettingsDialog(wx.Dialog):
         return info_dict
         
 class Nsx(FileInterpreter):
+    metadata_bytes_per_data_packet = 9
+
     def __init__(self):
         self.name = 'Nsx'
         self.extentions = ['.ns1','.ns2','.ns3','.ns4','.ns5','.ns6','.ns7',
@@ -80,18 +83,25 @@ class Nsx(FileInterpreter):
             infile.seek(286)
             period = struct.unpack('<I', infile.read(4))[0]
             sampling_freq = 30000.0/period
-            recording_length_s = self.get_recording_length(infile, 
-                    sampling_freq)
-            end_time_s = min(end_time_s, recording_length_s)
             infile.seek(310)
             num_channels = struct.unpack('<I', infile.read(4))[0]
-            vtrace_arrays = []
-            for channel in channels:
-                vtrace_arrays.append(self.read_channel(infile, channel, 
-                        start_time_s, end_time_s, sampling_freq, num_channels, 
-                        skip_points=skip_points))
+            num_timesteps = self.get_num_timesteps(infile, num_channels)
+            recording_length_s = num_timesteps/sampling_freq
+            end_time_s = min(end_time_s, recording_length_s)
 
-        voltage_traces = numpy.vstack(vtrace_arrays)/1000.0
+        # the samples are only read (and scaled to mV) when they're used.
+        start_index = int(start_time_s * sampling_freq - 0.5)
+        end_index = int(end_time_s * sampling_freq - 0.5)
+        step = int(skip_points+1)
+        trace_length = int(end_index - start_index + 1)/step
+        voltage_traces = LazyTraces(fullpath, '<i2', 
+                (num_timesteps, num_channels), 
+                offset=self.get_data_start(num_channels) + 
+                        self.metadata_bytes_per_data_packet,
+                scale=1/1000.0, channels_first=False,
+                channels=[channel-1 for channel in channels],
+                start=start_index, stop=start_index + trace_length*step, 
+                step=step)
 
         display_name = os.path.splitext(os.path.split(fullpath)[-1])[0]
         new_sampling_freq = sampling_freq/float(skip_points+1)
@@ -99,43 +109,13 @@ class Nsx(FileInterpreter):
                 origin=fullpath, display_name=display_name)
         return [trial]
 
-    def read_channel(self, infile, channel, start_time_s, end_time_s, 
-            sampling_freq, num_channels, skip_points=0):
-
-        data_bytes_per_channel = 2 # (per time step)
-        metadata_bytes_per_data_packet = 9
-        bytes_per_time_step = data_bytes_per_channel * num_channels
-        start_index = int(start_time_s * sampling_freq - 0.5)
-        end_index = int(end_time_s * sampling_freq - 0.5)
-
-        offset_from_data_packet = (data_bytes_per_channel * (channel - 1) + 
-                metadata_bytes_per_data_packet)
-        start_byte = start_index * bytes_per_time_step + offset_from_data_packet
-        skip_bytes = (bytes_per_time_step * (skip_points + 1) - 
-                data_bytes_per_channel)
-
+    def get_data_start(self, num_channels):
         num_bytes_in_main_header = 314
         num_bytes_in_extended_headers = 66
-        data_start_pos_in_bytes = (num_bytes_in_main_header +
+        return (num_bytes_in_main_header +
                 num_bytes_in_extended_headers * num_channels)
 
-        infile.seek(data_start_pos_in_bytes)
-        infile.seek(start_byte, 1)
-        trace_length = int(end_index - start_index + 1)/int(skip_points+1)
-        vtrace = numpy.zeros(trace_length, dtype='short')
-        for i in range(trace_length):
-            vtrace[i] = struct.unpack('h', 
-                    infile.read(data_bytes_per_channel))[0]
-            infile.seek(skip_bytes,1)
-        
-        return vtrace
-
-    
-    def get_recording_length(self, infile, sampling_freq):
-        bytes_before_data_bytes = 6721 #NOTE this is true when there are 97
-                                       # channels
-        infile.seek(bytes_before_data_bytes)
-        num_timesteps = struct.unpack('I', infile.read(4))[0]
-        rec_length_s = num_timesteps/sampling_freq
-
-        return rec_length_s
+    def get_num_timesteps(self, infile, num_channels):
+        # the data packet starts with a header byte and a timestamp.
+        infile.seek(self.get_data_start(num_channels) + 5)
+        return struct.unpack('<I', infile.read(4))[0]
@@ -34,7 +34,7 @@ def threshold_detection(signal, sampling_freq, threshold_1=None,
         for i in range(len(signal)):
             # determine thresholds
             if threshold_units.lower() == 'standard deviation':
-                factor = numpy.std(signal[i])
+                factor = numpy.std(signal[i], dtype=numpy.float64)
             elif threshold_units.lower() == 'median':
                 factor = numpy.median(signal[i])
             else:
@@ -54,7 +54,7 @@ def threshold_detection(signal, sampling_freq, threshold_1=None,
     else:
         # determine thresholds
         if threshold_units.lower() == 'standard deviation':
-            factor = numpy.std(signal)
+            factor = numpy.std(signal, dtype=numpy.float64)
         elif threshold_units.lower() == 'median':
             factor = numpy.median(signal)
         else:
@@ -64,7 +64,8 @@ class ExtractionSpikeWaveletCoefficients(ExtractionMethod):
         for features in features_list:
             total_len += len(features)
 
-        unified_features = numpy.empty((total_len, )+features_list[0].shape[1:])
+        unified_features = numpy.empty((total_len, )+features_list[0].shape[1:],
+                dtype=features_list[0].dtype)
         begin = 0
         end = 0
         unpacking_index = {}
@@ -77,9 +78,12 @@ class ExtractionSpikeWaveletCoefficients(ExtractionMethod):
         wavelet_coefficients = get_wavelet_coefficients(unified_features, 
                 wavelet, num_coefficients_kept)
         if normalize:
-            means = numpy.average(wavelet_coefficients, axis=0)
-            stds = numpy.std(wavelet_coefficients, axis=0)
-            wavelet_coefficients = (wavelet_coefficients-means)/stds
+            means = numpy.mean(wavelet_coefficients, axis=0, 
+                    dtype=numpy.float64)
+            stds = numpy.std(wavelet_coefficients, axis=0, 
+                    dtype=numpy.float64)
+            wavelet_coefficients = ((wavelet_coefficients-means)/
+                    stds).astype(wavelet_coefficients.dtype)
 
         # deunify wavelet_coefficients before returning them
         wavelet_coefficients_list = []
@@ -118,7 +122,7 @@ def get_wavelet_coefficients(observations, wavelet='db20', num_coefficients=10):
     # calculate wavelet coefficients
     coeffs = numpy.hstack(pywt.wavedec(observations[0], wavelet))
     obs_wavelet_coeffs = numpy.empty((len(observations), len(coeffs)), 
-            dtype=numpy.float64)
+            dtype=observations.dtype)
     obs_wavelet_coeffs[0] = coeffs
 
     for i, obs in enumerate(observations[1:]):
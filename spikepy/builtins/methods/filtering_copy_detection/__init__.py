@@ -26,6 +26,7 @@ class FilteringCopyDetection(FilteringMethod):
     is_stochastic = False
     requires = ['df_traces', 'df_sampling_freq'] # different from defaults.
     provides = ['ef_traces', 'ef_sampling_freq']
+    aliases = ['df_traces', 'df_sampling_freq']
 
     def run(self, signal, sampling_freq, **kwargs):
         return [signal, sampling_freq]
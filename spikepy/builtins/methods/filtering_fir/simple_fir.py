@@ -104,6 +104,10 @@ def fir_filter(signal, sampling_freq, critical_freq, kernel_window='hamming',
 
     kernel = make_fir_filter(sampling_freq, critical_freq, kernel_window, order,
             kind, **kwargs)
+    # filter in the signal's precision (float32 in float32 processing mode).
+    if signal.dtype.kind == 'f':
+        kernel = kernel.astype(signal.dtype)
+    denominator = numpy.ones(1, dtype=kernel.dtype)
 
     taps = order+1
 
@@ -115,10 +119,12 @@ def fir_filter(signal, sampling_freq, critical_freq, kernel_window='hamming',
         for i in range(len(signal)):
             zero_padded_signal = numpy.hstack([signal[i], 
                     numpy.zeros(taps, dtype=signal.dtype)])
-            result[i] = numpy.roll(scisig.lfilter(kernel, [1], zero_padded_signal), 
+            result[i] = numpy.roll(scisig.lfilter(kernel, denominator, 
+                    zero_padded_signal), 
                     -taps/2+1)[:len(signal[i])]
     else:
         zero_padded_signal = numpy.hstack([signal, 
                 numpy.zeros(taps, dtype=signal.dtype)])
-        result = numpy.roll(scisig.lfilter(kernel, [1], signal), -taps/2+1)[:len(signal)]
+        result = numpy.roll(scisig.lfilter(kernel, denominator, signal), 
+                -taps/2+1)[:len(signal)]
     return result
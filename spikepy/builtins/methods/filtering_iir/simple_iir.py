@@ -67,6 +67,8 @@ def butterworth(signal, sampling_freq, critical_freq,
     else:
         result = iir_filter(signal, sampling_freq, critical_freq,
                       scisig.butter, order, kind, **kwargs)
+        if signal.dtype.kind == 'f':
+            result = result.astype(signal.dtype)
     return result
 
 butterworth.__doc__ += '\n--iir_filter docstring--\n%s' % iir_filter.__doc__
@@ -84,6 +86,8 @@ def bessel(signal, sampling_freq, critical_freq,
     else:
         result = iir_filter(signal, sampling_freq, critical_freq,
                       scisig.bessel, order, kind, **kwargs)
+        if signal.dtype.kind == 'f':
+            result = result.astype(signal.dtype)
     return result
 
 bessel.__doc__ += '\n--iir_filter docstring--\n%s' % iir_filter.__doc__
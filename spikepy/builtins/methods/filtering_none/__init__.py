@@ -22,6 +22,7 @@ class NoFiltering(FilteringMethod):
     name = "No Filtering"
     description = "No Filtering, simply use the raw traces."
     is_stochastic = False
+    aliases = ['pf_traces', 'pf_sampling_freq']
 
     def run(self, signal, sampling_freq, **kwargs):
         return [signal, sampling_freq]
@@ -52,8 +52,12 @@ def filt(data, maxlevel = 6, wavelet = 'db20', mode = 'sym', minlevel = 1):
     # print data.shape
     numchannels, datalength = data.shape
 
-    # Initialize the container for the filtered data
-    fdata = np.empty((numchannels, datalength))
+    # Initialize the container for the filtered data (float32 data stays
+    #   float32)
+    if data.dtype.kind == 'f':
+        fdata = np.empty((numchannels, datalength), dtype=data.dtype)
+    else:
+        fdata = np.empty((numchannels, datalength))
 
     for i in range(numchannels):
         # Decompose the signal
@@ -0,0 +1,197 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import glob
+import os
+import Queue
+import time
+import traceback
+
+from spikepy.common.config_manager import config_manager
+from spikepy.common.errors import *
+
+def find_input_files(patterns):
+    '''
+        Return the files matching the glob <patterns> (a string or a list
+    of strings) in sorted order and without duplicates.
+    '''
+    if isinstance(patterns, basestring):
+        patterns = [patterns]
+    fullpaths = []
+    seen = set()
+    for pattern in patterns:
+        for fullpath in sorted(glob.glob(pattern)):
+            fullpath = os.path.abspath(fullpath)
+            if fullpath not in seen and os.path.isfile(fullpath):
+                seen.add(fullpath)
+                fullpaths.append(fullpath)
+    return fullpaths
+
+def iter_chunks(items, chunk_size):
+    '''Yield lists of (at most) <chunk_size> consecutive <items>.'''
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class BatchSummary(object):
+    '''Counts and timings for a run of BatchProcessor.process.'''
+    def __init__(self):
+        self.start_time = time.time()
+        self.end_time = None
+        self.num_files = 0
+        self.num_trials = 0
+        self.num_exported = 0
+        self.input_bytes = 0
+        self.phase_times = {'open':0.0, 'process':0.0, 'export':0.0}
+        self.failed_files = [] # (fullpath, reason)
+        self.failed_trials = [] # (display_name, reason)
+        self.written_files = []
+
+    @property
+    def total_time(self):
+        end_time = self.end_time
+        if end_time is None:
+            end_time = time.time()
+        return end_time - self.start_time
+
+    def format_summary(self):
+        '''Return the throughput and failures as text.'''
+        total_time = max(self.total_time, 1e-9)
+        megabytes = self.input_bytes/float(2**20)
+        lines = ['Processed %d files (%.2f MB) containing %d trials in '
+                '%.2f seconds.' % (self.num_files, megabytes, self.num_trials,
+                total_time),
+                '    Throughput: %.3f trials/s, %.3f MB/s' %
+                (self.num_trials/total_time, megabytes/total_time),
+                '    Time spent opening: %.2fs, processing: %.2fs, '
+                'exporting: %.2fs' % (self.phase_times['open'],
+                self.phase_times['process'], self.phase_times['export']),
+                '    Exported %d trials to %d files.' % (self.num_exported,
+                len(self.written_files))]
+        for fullpath, reason in self.failed_files:
+            lines.append('    FAILED to open %s: %s' % (fullpath, reason))
+        for display_name, reason in self.failed_trials:
+            lines.append('    FAILED to export %s: %s' % (display_name,
+                    reason))
+        return '\n'.join(lines)
+
+
+class BatchProcessor(object):
+    '''
+        Streams data files through a session without keeping them all in
+    memory.  The files are opened <trials_in_flight> at a time (defaults to
+    [backend] batch_trials_in_flight); the trials are processed with
+    <strategy>, exported with the data-interpreter named
+    <data_interpreter_name> and then removed from the session.
+        Note that pooling stages (like clustering) only pool the trials
+    that are in flight together.
+    '''
+    def __init__(self, session, strategy, data_interpreter_name, base_path,
+            trials_in_flight=None, export_kwargs={}):
+        self.session = session
+        self.strategy = strategy
+        self.data_interpreter = session.plugin_manager.data_interpreters[
+                data_interpreter_name]
+        self.base_path = base_path
+        if trials_in_flight is None:
+            trials_in_flight = config_manager['backend'][
+                    'batch_trials_in_flight']
+        self.trials_in_flight = max(int(trials_in_flight), 1)
+        self.export_kwargs = export_kwargs
+
+    def process(self, fullpaths, report=None):
+        '''
+            Process the files at <fullpaths> (any iterable, it is consumed
+        lazily).  If given, <report> is called with a line of text as each
+        group of trials is finished.  Returns a BatchSummary.
+        '''
+        if not os.path.exists(self.base_path):
+            os.makedirs(self.base_path)
+        summary = BatchSummary()
+        for chunk in iter_chunks(fullpaths, self.trials_in_flight):
+            trials = self._open(chunk, summary)
+            if trials:
+                try:
+                    self._process(trials, summary)
+                finally:
+                    self._drop(trials)
+            if report is not None:
+                report('%d files, %d trials done (%.3f trials/s)' %
+                        (summary.num_files, summary.num_trials,
+                        summary.num_trials/max(summary.total_time, 1e-9)))
+        summary.end_time = time.time()
+        return summary
+
+    def _open(self, fullpaths, summary):
+        start_time = time.time()
+        session = self.session
+        session.mark_all_trials(False) # only the new trials are processed.
+        results = session.open_files(fullpaths)
+        trials = [t for t in results if hasattr(t, 'trial_id')]
+        opened = set(os.path.abspath(trial.origin) for trial in trials
+                if trial.origin is not None)
+        for fullpath in fullpaths:
+            summary.num_files += 1
+            summary.input_bytes += os.path.getsize(fullpath)
+            if os.path.abspath(fullpath) not in opened:
+                summary.failed_files.append((fullpath,
+                        'no trials could be read.'))
+        summary.num_trials += len(trials)
+        summary.phase_times['open'] += time.time() - start_time
+        return trials
+
+    def _process(self, trials, summary):
+        start_time = time.time()
+        # a plain Queue, the messages are thrown away after each run.
+        message_queue = Queue.Queue()
+        self.session.run(strategy=self.strategy, message_queue=message_queue)
+        errors = {}
+        while not message_queue.empty():
+            statement, data = message_queue.get_nowait()
+            if statement == 'TASK_ERROR':
+                errors[data['task']] = data['traceback']
+        summary.phase_times['process'] += time.time() - start_time
+
+        start_time = time.time()
+        di = self.data_interpreter
+        for trial in trials:
+            if not di.is_available([trial]):
+                reason = 'results are missing.'
+                if errors:
+                    reason += ' (%d tasks failed in this group)' % len(errors)
+                summary.failed_trials.append((trial.display_name, reason))
+                continue
+            try:
+                written = di.write_data_file([trial], self.base_path,
+                        **self.export_kwargs)
+            except Exception as exception:
+                traceback.print_exc()
+                summary.failed_trials.append((trial.display_name,
+                        str(exception)))
+                continue
+            summary.num_exported += 1
+            summary.written_files.extend(written)
+        summary.phase_times['export'] += time.time() - start_time
+
+    def _drop(self, trials):
+        for trial in trials:
+            self.session.remove_trial(trial.trial_id)
@@ -0,0 +1,198 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import zlib
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+try:
+    import lz4.frame
+except ImportError: # optional
+    lz4 = None
+try:
+    import zstandard
+except ImportError: # optional
+    zstandard = None
+
+# compressed blocks are this big, so even one large array is compressed
+#   by many threads at once.
+GZIP_CHUNK_SIZE = 2**22
+
+def _zlib_compress(data, level):
+    return zlib.compress(data, level)
+
+def _lz4_compress(data, level):
+    # lz4 levels go from 0 (fast) to 16, those above 2 are many times 
+    #   slower, so only levels 7 to 9 use them.
+    return lz4.frame.compress(data, 
+            compression_level=max(0, (level - 6)*4))
+
+def _lz4_decompress(data):
+    return lz4.frame.decompress(data)
+
+def _zstd_compress(data, level):
+    # zstd levels go from 1 to 19 (22 with lots of memory).
+    return zstandard.ZstdCompressor(level=level*2-1).compress(data)
+
+def _zstd_decompress(data):
+    return zstandard.ZstdDecompressor().decompress(data)
+
+# codec name -> (file suffix, compress(data, level), decompress(data))
+codecs = {'zlib':('.zlib', _zlib_compress, zlib.decompress)}
+if lz4 is not None:
+    codecs['lz4'] = ('.lz4', _lz4_compress, _lz4_decompress)
+if zstandard is not None:
+    codecs['zstd'] = ('.zst', _zstd_compress, _zstd_decompress)
+
+def get_codec_name(name):
+    '''
+        Return the codec that compresses data for <name> ('none', 'zlib', 
+    'lz4' or 'zstd').  Codecs that aren't installed fall back to zlib.
+    '''
+    if name == 'none':
+        return None
+    if name not in codecs:
+        return 'zlib'
+    return name
+
+def get_suffix(codec_name):
+    '''The suffix given to files compressed with <codec_name> (or None).'''
+    if codec_name is None:
+        return ''
+    return codecs[codec_name][0]
+
+def find_codec_name(filename):
+    '''Return the codec that the file <filename> was compressed with.'''
+    for codec_name, (suffix, compress, decompress) in codecs.items():
+        if filename.endswith(suffix):
+            return codec_name
+    return None
+
+def compress(data, codec_name, level):
+    '''
+        Compress the string <data> with <codec_name> at <level>, from 1
+    (fastest) to 9 (smallest).
+    '''
+    return codecs[codec_name][1](data, level)
+
+def decompress(data, codec_name):
+    return codecs[codec_name][2](data)
+
+def map_in_threads(function, items, num_threads):
+    '''
+        Return [function(item) for item in items], calling <function> from
+    <num_threads> threads.  Only worth it when <function> releases the GIL,
+    like the compressors, numpy and file io do.
+    '''
+    items = list(items)
+    num_threads = min(num_threads, len(items))
+    if num_threads <= 1:
+        return [function(item) for item in items]
+    pool = ThreadPool(num_threads)
+    try:
+        return pool.map(function, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def _gzip_member(args):
+    chunk, level = args
+    # wbits=31 writes the gzip header and trailer.
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(chunk) + compressor.flush()
+
+class GzipWriter(object):
+    '''
+        A file-like object that writes what is written to it to <ofile> 
+    gzipped.  Every GZIP_CHUNK_SIZE bytes are compressed, in one of 
+    <num_threads> threads, while more is written.  Each chunk is a gzip
+    member of its own, which gzip.open reads back as one stream.  Only a
+    few chunks per thread are held at once, so something as large as a
+    session can be pickled straight into it.  close() (or leaving a with 
+    block) writes the rest, it doesn't close <ofile>.
+    '''
+    def __init__(self, ofile, level, num_threads):
+        self.ofile = ofile
+        self.level = level
+        self.num_threads = max(1, num_threads)
+        self._pool = None
+        self._compressing = deque() # results of _gzip_member, in order
+        self._parts = [] # written strings that don't fill a chunk yet
+        self._size = 0
+        self._num_members = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._stop_pool()
+
+    def write(self, data):
+        self._parts.append(data)
+        self._size += len(data)
+        if self._size < GZIP_CHUNK_SIZE:
+            return
+        if len(self._parts) == 1:
+            data = self._parts[0]
+        else:
+            data = ''.join(self._parts)
+        end = len(data) - len(data) % GZIP_CHUNK_SIZE
+        for start in xrange(0, end, GZIP_CHUNK_SIZE):
+            self._add_member(buffer(data, start, GZIP_CHUNK_SIZE))
+        self._parts = [data[end:]]
+        self._size = len(data) - end
+
+    def _add_member(self, chunk):
+        self._num_members += 1
+        if self.num_threads == 1:
+            self.ofile.write(_gzip_member((chunk, self.level)))
+            return
+        if self._pool is None:
+            self._pool = ThreadPool(self.num_threads)
+        self._compressing.append(self._pool.apply_async(_gzip_member, 
+                [(chunk, self.level)]))
+        # don't let chunks pile up faster than they are compressed.
+        while len(self._compressing) > 2*self.num_threads:
+            self.ofile.write(self._compressing.popleft().get())
+
+    def _stop_pool(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        self._compressing.clear()
+
+    def close(self):
+        if self._size or not self._num_members:
+            self._add_member(''.join(self._parts))
+        self._parts = []
+        self._size = 0
+        try:
+            while self._compressing:
+                self.ofile.write(self._compressing.popleft().get())
+        finally:
+            self._stop_pool()
+
+def write_gzip(ofile, data, level, num_threads):
+    '''
+        Write the string <data> to <ofile> gzipped, compressing chunks of it
+    in <num_threads> threads (see GzipWriter).
+    '''
+    with GzipWriter(ofile, level, num_threads) as writer:
+        writer.write(data)
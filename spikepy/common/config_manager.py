@@ -119,6 +119,55 @@ class ConfigManager(object):
         num_process_workers = min(num_process_workers, processes_limit)
         return num_process_workers
 
+    def get_processing_dtype(self):
+        '''
+            Return the numpy dtype that traces, spike windows and features
+        are processed and stored in, from the configuration variable
+        ['backend']['processing_dtype'].
+        '''
+        return numpy.dtype(self['backend']['processing_dtype'])
+
+    def get_resource_memory_ceiling(self):
+        '''
+            Return how many bytes of large arrays the resources may hold in
+        memory before the least recently used are spilled to disk, or None
+        if they are never spilled.  From the configuration variable
+        ['backend']['resource_memory_ceiling'].
+        '''
+        ceiling = self['backend']['resource_memory_ceiling']
+        if ceiling > 0:
+            return ceiling*2**20
+        return None
+
+    def get_session_compression(self):
+        '''
+            Return (codec name, level) that saved sessions are compressed 
+        with, from the configuration variables 
+        ['backend']['session_compression'] and 
+        ['backend']['compression_level'].
+        '''
+        return (self['backend']['session_compression'], 
+                self['backend']['compression_level'])
+
+    def get_memory_budget(self):
+        '''
+            Return the most memory (in bytes) the tasks running at once may
+        need, from the configuration variable ['backend']['memory_budget'].
+        If that is 0 the budget is three quarters of the physical memory, or
+        None (no limit) if that can't be determined.
+        '''
+        memory_budget = self['backend']['memory_budget']
+        if memory_budget > 0:
+            return memory_budget*2**20
+        try:
+            physical_memory = (os.sysconf('SC_PHYS_PAGES')*
+                    os.sysconf('SC_PAGE_SIZE'))
+        except (AttributeError, ValueError, OSError):
+            return None
+        if physical_memory <= 0:
+            return None
+        return physical_memory*3//4
+
     def get_size(self, name):
         if name == 'main_frame':
             height = self['gui']['main_frame']['height']
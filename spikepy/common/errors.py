@@ -24,6 +24,12 @@ class NoTasksError(SpikepyError):
 class ImpossibleTaskError(SpikepyError):
     pass
 
+class TaskFailedError(SpikepyError):
+    pass
+
+class RunCancelledError(SpikepyError):
+    pass
+
 class TaskCreationError(SpikepyError):
     pass
 
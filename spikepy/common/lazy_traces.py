@@ -0,0 +1,185 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+
+import numpy
+
+class LazyTraces(object):
+    '''
+        Raw voltage traces that stay in their file until they are used.  The
+    file is memory-mapped as an array of <file_dtype> with <file_shape> starting
+    at byte <offset>.  The file holds one row per channel, or one row per
+    sample (interleaved channels, like Nsx files) if <channels_first> is
+    False.  Only the <channels> (indices into the file's channels, default
+    all) and the samples in range(<start>, <stop>, <step>) are used.
+        Reading a channel gives values (of <dtype>) of raw*<scale> minus the
+    mean of the channel (like trial_manager.format_traces), converted a
+    chunk at a time.  The means are computed once (or passed in as <means>).  
+    Asking for the shape, dtype or len doesn't read the file and pickling
+    (sending to a worker) only stores the reference, so the file has to 
+    stay where it is.  Saved sessions hold the traces themselves unless
+    they are saved with traces_by_reference (see Session.save).
+    '''
+    # samples converted at a time.
+    chunk_size = 2**18
+
+    def __init__(self, filename, file_dtype, file_shape, offset=0, scale=1.0, 
+            channels_first=True, channels=None, start=0, stop=None, step=1,
+            means=None, dtype=numpy.float64):
+        self.filename = os.path.abspath(filename)
+        self.file_dtype = numpy.dtype(file_dtype)
+        self.file_shape = tuple(int(n) for n in file_shape)
+        self.offset = int(offset)
+        self.scale = float(scale)
+        self.channels_first = channels_first
+        if channels_first:
+            file_num_channels, file_num_samples = self.file_shape
+        else:
+            file_num_samples, file_num_channels = self.file_shape
+        if channels is None:
+            channels = range(file_num_channels)
+        self.channels = [int(channel) for channel in channels]
+        self.start, self.stop, self.step = slice(start, stop, 
+                step).indices(file_num_samples)
+        self._means = means
+        self._dtype = numpy.dtype(dtype)
+        self._memmap = None
+
+    def __reduce__(self):
+        return (LazyTraces, (self.filename, self.file_dtype.str, 
+                self.file_shape, self.offset, self.scale, self.channels_first, 
+                self.channels, self.start, self.stop, self.step, 
+                list(self.means), self.dtype.str))
+
+    def __repr__(self):
+        return '<LazyTraces %d x %d of %s>' % (self.shape[0], self.shape[1],
+                self.filename)
+
+    @property
+    def shape(self):
+        num_samples = len(xrange(self.start, self.stop, self.step))
+        return (len(self.channels), num_samples)
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    def astype(self, dtype):
+        '''Return LazyTraces of the same samples that are read as <dtype>.'''
+        if numpy.dtype(dtype) == self.dtype:
+            return self
+        return LazyTraces(self.filename, self.file_dtype, self.file_shape,
+                offset=self.offset, scale=self.scale, 
+                channels_first=self.channels_first, channels=self.channels,
+                start=self.start, stop=self.stop, step=self.step, 
+                means=self._means, dtype=dtype)
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def size(self):
+        return self.shape[0]*self.shape[1]
+
+    @property
+    def nbytes(self):
+        '''The size (in bytes) of the traces once they are read.'''
+        return self.size*self.dtype.itemsize
+
+    def __len__(self):
+        return len(self.channels)
+
+    def _raw_channel(self, index):
+        '''The (still unread) samples of the <index>th channel.'''
+        if self._memmap is None:
+            self._memmap = numpy.memmap(self.filename, dtype=self.file_dtype,
+                    mode='r', offset=self.offset, shape=self.file_shape)
+        if self.channels_first:
+            raw_channel = self._memmap[self.channels[index]]
+        else:
+            raw_channel = self._memmap[:, self.channels[index]]
+        return raw_channel[self.start:self.stop:self.step]
+
+    @property
+    def means(self):
+        '''The mean of each channel (after scaling).'''
+        if self._means is None:
+            means = []
+            for index in range(len(self.channels)):
+                raw_channel = self._raw_channel(index)
+                total = 0.0
+                for i in xrange(0, len(raw_channel), self.chunk_size):
+                    total += numpy.sum(raw_channel[i:i+self.chunk_size],
+                            dtype=numpy.float64)
+                means.append(total*self.scale/max(len(raw_channel), 1))
+            self._means = means
+        return numpy.array(self._means, dtype=numpy.float64)
+
+    def _read(self, index, sample_key=slice(None)):
+        raw_samples = self._raw_channel(index)[sample_key]
+        mean = self.means[index]
+        if numpy.ndim(raw_samples) == 0:
+            return self.dtype.type(float(raw_samples)*self.scale - mean)
+        result = numpy.empty(len(raw_samples), dtype=self.dtype)
+        for i in xrange(0, len(raw_samples), self.chunk_size):
+            # each chunk is worked out in float64, then stored as self.dtype.
+            chunk = numpy.array(raw_samples[i:i+self.chunk_size], 
+                    dtype=numpy.float64)
+            chunk *= self.scale
+            chunk -= mean
+            result[i:i+self.chunk_size] = chunk
+        return result
+
+    def __getitem__(self, key):
+        '''
+            Read the traces selected by <key> (like indexing a 2D array)
+        into a numpy array.
+        '''
+        if isinstance(key, tuple):
+            if len(key) > 2:
+                raise IndexError('Too many indices for LazyTraces.')
+            channel_key, sample_key = (key + (slice(None),))[:2]
+        else:
+            channel_key, sample_key = key, slice(None)
+        if isinstance(channel_key, (int, long, numpy.integer)):
+            index = range(len(self.channels))[channel_key]
+            return self._read(index, sample_key)
+        indices = numpy.arange(len(self.channels))[channel_key]
+        rows = [self._read(index, sample_key) for index in indices]
+        if not rows:
+            return numpy.empty((0, self.shape[1]), dtype=self.dtype)[
+                    :, sample_key]
+        return numpy.array(rows)
+
+    def __iter__(self):
+        for index in range(len(self.channels)):
+            yield self._read(index)
+
+    def __array__(self, dtype=None):
+        result = numpy.empty(self.shape, dtype=self.dtype)
+        for index in range(len(self.channels)):
+            result[index] = self._read(index)
+        if dtype is not None:
+            return result.astype(dtype)
+        return result
+
+def materialize(value):
+    '''Return <value>, read into an array if it is LazyTraces.'''
+    if isinstance(value, LazyTraces):
+        return numpy.asarray(value)
+    return value
@@ -0,0 +1,70 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from spikepy.common.runtime_estimates import RuntimeEstimates
+from spikepy.common.run_telemetry import get_serialized_size
+
+def get_input_bytes(task):
+    '''Return the size (in bytes) of the resources <task> requires.'''
+    return sum([get_serialized_size(resource.data)
+            for resource in task.requires])
+
+class MemoryEstimates(RuntimeEstimates):
+    '''
+        Per-plugin estimates of how much memory a task needs, as a multiple
+    of the size of its input resources.  The multipliers are learned from
+    the memory the workers measured for earlier tasks (see
+    run_telemetry.TaskRecord.memory_growth).  If a <filename> is given the
+    multipliers are loaded from it and save() writes them back.
+    '''
+    # assumed for plugins that have never been measured: the inputs, a
+    #   working copy of them and the results.
+    default_multiplier = 3.0
+    # the memory is measured in whole pages, so tasks on less input than
+    #   this would teach wildly inflated multipliers.
+    min_input_bytes = 2**20
+
+    def update(self, plugin_name, footprint, input_bytes):
+        '''
+            Record that <plugin_name> needed <footprint> bytes for 
+        <input_bytes> of input.
+        '''
+        if input_bytes < self.min_input_bytes:
+            return
+        RuntimeEstimates.update(self, plugin_name, footprint, input_bytes)
+
+    def multiplier(self, plugin_name):
+        with self._lock:
+            if plugin_name in self._estimates:
+                return self._estimates[plugin_name][0]
+        return self.default_multiplier
+
+    def estimate(self, plugin_name, input_bytes):
+        '''
+            Return the estimated memory (in bytes) <plugin_name> needs to
+        run on <input_bytes> of input.
+        '''
+        return self.multiplier(plugin_name)*input_bytes
+
+    def estimate_task(self, task, input_bytes=None):
+        '''
+            Return the estimated memory (in bytes) <task> needs.  The steps
+        of a fused task run one after the other so the hungriest step counts.
+        '''
+        if input_bytes is None:
+            input_bytes = get_input_bytes(task)
+        return max([self.estimate(step.plugin.name, input_bytes)
+                for step in task.steps])
@@ -50,7 +50,7 @@ def guess_file_interpreters(fullpath, file_interpreters):
     Returns a list of file_interpreters in descending order of
     applicability.
     """
-    filename = os.path.split(fullpath)[-1]
+    filename = os.path.split(fullpath.rstrip(os.sep))[-1] # or directory.
 
     candidates = {}
     for fi in file_interpreters.values():
@@ -51,6 +51,7 @@ def get_data_dirs(app_name=None):
     methods_dir = 'methods'
     visualizations_dir = 'visualizations'
     strategies_dir = 'strategies'
+    cache_dir = 'cache'
     # see if an App() instance is running.
     app = wx.GetApp()
     # creat an App() instance if we don't already have one.
@@ -87,6 +88,8 @@ def get_data_dirs(app_name=None):
                                                     visualizations_dir)
         data_dirs[base_name]['methods'] = os.path.join(base_dir, 
                                                     methods_dir)
+        data_dirs[base_name]['cache'] = os.path.join(base_dir, 
+                                                    cache_dir)
 
     # return app to former name
     app.SetAppName(old_app_name)
@@ -131,7 +131,7 @@ def load_all_plugins(data_dirs=None, module_suffix=None, **kwargs):
             for plugin in plugins:
                 plugin_levels[plugin] = level
                 category = get_plugin_category(plugin)
-                if plugin.name in loaded_plugins[category].keys():
+                if plugin.name in loaded_plugins[category]:
                     # already loaded this plugin.
                     existing_plugin = loaded_plugins[category][plugin.name]
                     existing_level = plugin_levels[existing_plugin]
@@ -144,6 +144,7 @@ class PluginManager(object):
     '''PluginManager is used to load and access spikepy plugins.'''
     def __init__(self, **kwargs):
         self._loaded_plugins = None
+        self._typed_filters = {}
         self.load_plugins(**kwargs)
 
     def validate_strategy(self, strategy):
@@ -164,6 +165,7 @@ class PluginManager(object):
     def load_plugins(self, **kwargs):
         '''Load or reload all plugins.'''
         self._loaded_plugins = load_all_plugins(**kwargs)
+        self._typed_filters = {}
 
     @property
     def visualizations(self):
@@ -186,7 +188,14 @@ class PluginManager(object):
         return self._get_filters_of_type('ef')
 
     def _get_filters_of_type(self, provides_prefix):
-        typed_filters = {}
+        # built once per load, find_plugin is called for every task.
+        if provides_prefix not in self._typed_filters:
+            self._typed_filters[provides_prefix] = self._build_filters_of_type(
+                    provides_prefix)
+        return self._typed_filters[provides_prefix]
+
+    def _build_filters_of_type(self, provides_prefix):
+        typed_filters = SubstringDict()
         for filter_ in self.loaded_plugins['filtering'].values():
             typed_filter = filter_.__class__() # new instance
             new_items = [item.replace('<stage_name>', provides_prefix)
@@ -234,17 +243,17 @@ class PluginManager(object):
     def get_plugins_by_stage(self, stage_name):
         ''' Return a list of plugins from the stage with <stage_name>.  '''
         lsn = stage_name.lower().replace(' ', '_')
-        lookup_index = {'detection_filter':self.detection_filters,
-                        'detection':self.detectors,
-                        'extraction_filter':self.extraction_filters,
-                        'extraction':self.extractors,
-                        'clustering':self.clusterers,
-                        'auxiliary':self.auxiliary_plugins}
-        if lsn not in lookup_index.keys():
+        lookup_index = {'detection_filter':'detection_filters',
+                        'detection':'detectors',
+                        'extraction_filter':'extraction_filters',
+                        'extraction':'extractors',
+                        'clustering':'clusterers',
+                        'auxiliary':'auxiliary_plugins'}
+        if lsn not in lookup_index:
             raise UnknownStageError(
                     'There is no stage "%s" (parsed from "%s").' % 
                     (lsn, stage_name))
-        return lookup_index[lsn]
+        return getattr(self, lookup_index[lsn])
 
     def find_plugin(self, stage_name, plugin_name):
         stage_plugins = self.get_plugins_by_stage(stage_name)
@@ -14,10 +14,11 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+import os
 import uuid
-import random
 import multiprocessing
 import traceback
+import threading
 import time
 from collections import defaultdict
 
@@ -31,8 +32,16 @@ except ImportError:
 from spikepy.common.open_data_file import open_data_file
 from spikepy.common.config_manager import config_manager
 from spikepy.common.plugin_manager import plugin_manager
+from spikepy.common.worker_pool import create_worker_pool,\
+        is_transient_failure
+from spikepy.common.result_cache import ResultCache
+from spikepy.common.runtime_estimates import RuntimeEstimates
+from spikepy.common.run_telemetry import RunTelemetry
+from spikepy.common.memory_estimates import MemoryEstimates
+from spikepy.common.path_utils import get_data_dirs
+from spikepy.common.shared_arrays import adopt_arrays
 from spikepy.common.task_manager import TaskManager, Task, RootTask,\
-        StageRootTask
+        StageRootTask, IncrementalRootTask, find_stale_tasks, fuse_tasks
 from spikepy.common.errors import *
 
 def build_tasks(marked_trials, plugin, plugin_category, plugin_kwargs):
@@ -48,48 +57,129 @@ def build_tasks(marked_trials, plugin, plugin_category, plugin_kwargs):
             tasks.append(Task([trial], plugin, plugin_category, plugin_kwargs)) 
     return tasks 
 
-def open_file_worker(input_queue, results_queue):
-    '''Worker process to handle open_file operations.'''
-    for fullpath in iter(input_queue.get, None):
-        file_interpreters = plugin_manager.file_interpreters
-        try:
-            results = open_data_file(fullpath, file_interpreters)
-        except:
-            results = []
-            traceback.print_exc()
-        results_queue.put(results)
-
-def task_worker(input_queue, results_queue):
-    '''Worker process to handle task operations.'''
-    for task_info in iter(input_queue.get, None):
-        args = task_info['args']
-        kwargs = task_info['kwargs']
-        stage_name = task_info['plugin_info']['stage']
-        plugin_name = task_info['plugin_info']['name']
-        plugin = plugin_manager.find_plugin(stage_name, plugin_name)
-
-        results_dict = {}
-        begin_time = time.time()
-        try:
-            results_dict['result'] = plugin.run(*args, **kwargs)
-        except:
-            results_dict['result'] = None
-            results_dict['traceback'] = traceback.format_exc()
-            traceback.print_exc()
-        end_time = time.time()
-        results_dict['task_id'] = task_info['task_id']
-        results_dict['runtime'] = end_time - begin_time
-
-        results_queue.put(results_dict)
-    
+class ProgressThrottle(object):
+    '''
+        Sends the operations that changed state (see 
+    TaskManager.pop_state_changes) to a message_queue as 'OPERATION_STATES'
+    messages, at most <rate> times per second (every time if <rate> is 0).
+    Changes made in between are coalesced into the next message.
+    '''
+    def __init__(self, message_queue, task_manager, base_time, rate):
+        self.message_queue = message_queue
+        self.task_manager = task_manager
+        self.base_time = base_time
+        if rate > 0:
+            self.period = 1.0/rate
+        else:
+            self.period = 0.0
+        self._last_sent = None
+
+    def update(self, force=False):
+        now = time.time()
+        if (not force and self._last_sent is not None and 
+                now - self._last_sent < self.period):
+            return
+        changes = self.task_manager.pop_state_changes()
+        if changes:
+            self.message_queue.put(('OPERATION_STATES', 
+                    (changes, now - self.base_time)))
+            self._last_sent = now
+
+
 class ProcessManager(object):
     '''
         ProcessManager handles all the multi-processing and task
-    creation and management.
+    creation and management.  If a <worker_pool> is supplied its workers 
+    are reused for every run, otherwise a temporary pool is started for 
+    each run.
     '''
-    def __init__(self, trial_manager):
+    def __init__(self, trial_manager, worker_pool=None):
         self.trial_manager  = trial_manager
+        self.worker_pool = worker_pool
         self.task_manager = None
+        self._result_cache = None
+        self._runtime_estimates = None
+        self._memory_estimates = None
+        self.telemetry = None
+        self._current_runs = {} # task_manager -> the state of its run
+
+    @property
+    def result_cache(self):
+        '''
+            The ResultCache used to skip deterministic tasks that have been
+        run before, or None if [backend] result_cache_size is 0.
+        '''
+        max_size = config_manager['backend']['result_cache_size']*2**20
+        if max_size <= 0:
+            return None
+        if self._result_cache is None:
+            cache_dir = os.path.join(
+                    get_data_dirs(app_name='spikepy')['user']['cache'],
+                    'results')
+            self._result_cache = ResultCache(cache_dir, max_size)
+        self._result_cache.max_size = max_size
+        return self._result_cache
+
+    @property
+    def runtime_estimates(self):
+        '''
+            The per-plugin RuntimeEstimates learned from earlier runs, used to
+        prioritize tasks on the critical path.
+        '''
+        if self._runtime_estimates is None:
+            filename = os.path.join(
+                    get_data_dirs(app_name='spikepy')['user']['cache'],
+                    'runtime_estimates.json')
+            self._runtime_estimates = RuntimeEstimates(filename)
+        return self._runtime_estimates
+
+    @property
+    def memory_estimates(self):
+        '''
+            The per-plugin MemoryEstimates learned from earlier runs, used to
+        keep the tasks running at once within [backend] memory_budget.
+        '''
+        if self._memory_estimates is None:
+            filename = os.path.join(
+                    get_data_dirs(app_name='spikepy')['user']['cache'],
+                    'memory_estimates.json')
+            self._memory_estimates = MemoryEstimates(filename)
+        return self._memory_estimates
+
+    def save_telemetry(self, telemetry):
+        '''
+            Write <telemetry> (see run_telemetry.RunTelemetry) to the user's
+        cache directory as a Chrome-trace file and a per-plugin summary table.
+        Returns the filename of the trace.  Only the latest run is kept.
+        '''
+        telemetry_dir = os.path.join(
+                get_data_dirs(app_name='spikepy')['user']['cache'],
+                'telemetry')
+        trace_filename = os.path.join(telemetry_dir, 'last_run.trace.json')
+        telemetry.save_trace(trace_filename)
+        telemetry.save_summary(os.path.join(telemetry_dir, 
+                'last_run.summary.txt'))
+        return trace_filename
+
+    def _get_worker_pool(self, num_jobs):
+        '''
+            Return (pool, is_temporary).  Temporary pools should be shut down
+        by the caller once it is finished with them.
+        '''
+        if self.worker_pool is not None:
+            return self.worker_pool, False
+        num_process_workers = min(config_manager.get_num_workers(), num_jobs)
+        return create_worker_pool(num_workers=num_process_workers), True
+
+    def _get_shared_memory_threshold(self):
+        '''
+            Return the size (in bytes) above which arrays are sent to workers
+        through shared memory, or None if shared memory should not be used.
+        '''
+        backend_config = config_manager['backend']
+        if not backend_config['use_shared_memory']:
+            return None
+        return backend_config['shared_memory_threshold']
 
     def build_tasks_from_strategy(self, strategy, stage_name=None):
         '''Create a task for each stage of the strategy.'''
@@ -136,107 +226,317 @@ class ProcessManager(object):
                         'auxiliary', plugin_kwargs))
         return tasks 
 
-    def prepare_to_run_strategy(self, strategy, stage_name=None):
+    def prepare_to_run_strategy(self, strategy, stage_name=None, 
+            incremental=False):
         '''
             Validate strategy, build tasks for it and put the task_manager.
+        If <incremental> is True, tasks whose results are already present
+        (according to the provenance stored in the trials' resources) and
+        don't depend on any task that must be rerun are left out.  If
+        [backend] fuse_tasks is True, chains of tasks on the same trial are
+        run as a single job (see task_manager.fuse_tasks).
         '''
         plugin_manager.validate_strategy(strategy)
         tasks = self.build_tasks_from_strategy(strategy, stage_name=stage_name)
-        self.task_manager = TaskManager()
-        for task in tasks:
-            self.task_manager.add_task(task)
-        if stage_name is None:
+        if incremental:
+            tasks = find_stale_tasks(tasks)
+            root_task = IncrementalRootTask(tasks)
+        elif stage_name is None:
             root_task = RootTask(self.trial_manager.marked_trials)
         else:
             plugins = [task.plugin for task in tasks]
             root_task = StageRootTask(self.trial_manager.marked_trials, plugins)
+        self.task_manager = self._build_task_manager(tasks)
         self.obsoleted_tasks = self.task_manager.add_root_task(root_task)
+
+        if config_manager['backend']['fuse_tasks']:
+            remaining_tasks = set(self.task_manager.tasks)
+            tasks = fuse_tasks([task for task in tasks 
+                    if task in remaining_tasks])
+            if len(tasks) < len(remaining_tasks):
+                self.task_manager = self._build_task_manager(tasks)
+                self.task_manager.add_root_task(root_task)
         return self.obsoleted_tasks
 
-    def run_tasks(self, message_queue=multiprocessing.Queue()):
+    def _build_task_manager(self, tasks):
+        task_manager = TaskManager(
+                policy=config_manager['backend']['scheduling_policy'],
+                runtime_estimates=self.runtime_estimates,
+                memory_estimates=self.memory_estimates,
+                memory_budget=config_manager.get_memory_budget())
+        for task in tasks:
+            task_manager.add_task(task)
+        return task_manager
+
+    def _update_memory_estimates(self, task_manager, task, record):
+        '''
+            Learn how much memory the plugins of <task> need from the
+        measurements in its telemetry <record>.  The task needed its inputs
+        plus whatever the worker's memory grew by (at least enough to hold
+        the results).
+        '''
+        input_bytes = task_manager.get_input_bytes(task)
+        growth = record.memory_growth
+        if growth is None:
+            growth = 0
+        footprint = input_bytes + max(growth, record.output_bytes)
+        for step in task.steps:
+            self.memory_estimates.update(step.plugin.name, footprint,
+                    input_bytes)
+
+    def _cancel_waiting_tasks(self, task_manager, submitted):
+        '''
+            Remove the tasks of <task_manager> that haven't been submitted to
+        the worker pool yet and return them.
+        '''
+        cancelled_tasks = [task for task in task_manager.tasks
+                if task.task_id not in submitted]
+        for task in cancelled_tasks:
+            task_manager.remove_task(task)
+        return cancelled_tasks
+
+    def cancel_run(self, task_manager=None):
+        '''
+            Cancel the run of the tasks in <task_manager> (or every run in
+        progress if it is None, see self.run_tasks), from any thread.  Tasks
+        that haven't started are dropped and the others are abandoned (see
+        WorkerPool.cancel).  Returns False if there is no such run in 
+        progress.
+        '''
+        if task_manager is None:
+            current_runs = self._current_runs.values()
+        elif task_manager in self._current_runs:
+            current_runs = [self._current_runs[task_manager]]
+        else:
+            current_runs = []
+        for current_run in current_runs:
+            current_run['cancel_event'].set()
+            current_run['pool'].cancel(current_run['channel'])
+        return bool(current_runs)
+
+    def run_tasks(self, message_queue=multiprocessing.Queue(), 
+            on_task_done=None, task_manager=None, cancel_event=None):
         '''
-            Run all the tasks in self.task_manager
-        (see self.prepare_to_run_strategy()).
+            Run all the tasks in <task_manager>, which defaults to 
+        self.task_manager (see self.prepare_to_run_strategy()).  Each run 
+        keeps to its own task_manager, so another strategy can be prepared 
+        and run (on other trials) while this one is in progress.  If a task
+        fails, the tasks that depend on it are cancelled and the rest of the
+        run continues (or the whole run is abandoned if [backend] 
+        failure_policy is 'abort_run').  Transient failures, like a worker
+        process dying, are retried up to [backend] max_task_retries times 
+        first.  The timing, data-transfer and memory use of every task are 
+        recorded in self.telemetry and (if [backend] save_telemetry is True)
+        saved with self.save_telemetry().  The run can be stopped early with 
+        self.cancel_run(<task_manager>), or by setting <cancel_event> (a
+        threading.Event), which works even before the run has started.
+            If <on_task_done> is given it is called as 
+        on_task_done(task, error) once each task is done, where <error> is
+        None if it succeeded, the traceback if it failed, or a message 
+        starting with 'Cancelled' if it was cancelled.
         '''
-        num_process_workers = config_manager.get_num_workers()
-        num_tasks = self.task_manager.num_tasks
+        if task_manager is None:
+            task_manager = self.task_manager
+        num_tasks = task_manager.num_tasks
         if num_tasks == 0:
             raise NoTasksError('There are no tasks to run')
-        if num_tasks < num_process_workers:
-            num_process_workers = num_tasks
-
-        input_queue = multiprocessing.Queue()
-        results_queue = multiprocessing.Queue()
 
-        # start the jobs
-        jobs = []
-        results_list = []
-        for i in xrange(num_process_workers):
-            job = multiprocessing.Process(target=task_worker, 
-                                          args=(input_queue, 
-                                                results_queue))
-            job.start()
-            jobs.append(job)
+        pool, pool_is_temporary = self._get_worker_pool(num_tasks)
+        pool.start()
+        channel = pool.new_channel()
+        if cancel_event is None:
+            cancel_event = threading.Event()
+        self._current_runs[task_manager] = {'cancel_event':cancel_event, 
+                'pool':pool, 'channel':channel}
+        run_finished = False
+        try:
+            results = self._run_tasks(task_manager, pool, channel, 
+                    cancel_event, message_queue, on_task_done)
+            run_finished = True
+            return results
+        finally:
+            # even if the run failed, so later runs (and cancel_run) work.
+            del self._current_runs[task_manager]
+            if pool_is_temporary:
+                pool.shutdown()
+            elif not run_finished:
+                pool.cancel(channel) # drop the jobs it still has.
+            message_queue.put(('FINISHED_RUN', None))
+
+    def _run_tasks(self, task_manager, pool, channel, cancel_event, 
+            message_queue, on_task_done):
+        '''The body of run_tasks, which cleans up after it.'''
+        run_cancelled = False
+        if on_task_done is None:
+            on_task_done = lambda task, error:None
+        shared_memory_threshold = self._get_shared_memory_threshold()
 
         task_index = {}
-        for task in self.task_manager.tasks:
+        for task in task_manager.tasks:
             task_index[task.task_id] = task
         message_queue.put(('TASKS', [str(t) for t in task_index.values()]))
-            
+
+        result_cache = self.result_cache
+        cache_keys = {}
+
+        backend_config = config_manager['backend']
+        isolate_failures = backend_config['failure_policy'] == 'isolate_trial'
+        max_retries = backend_config['max_task_retries']
+        submitted = {} # task_id -> task_info, kept in case of a retry.
+        num_retries = defaultdict(int)
+
         results_index = {}
-        queued_tasks = 0
-        base_time = time.time()
+        num_outstanding = 0
+        telemetry = RunTelemetry()
+        self.telemetry = telemetry
+
+        # the graph is laid out once, after that only the operations that
+        #   changed state are sent (at most progress_update_rate times a 
+        #   second).
+        message_queue.put(('GRAPH_LAYOUT', task_manager.get_plot_layout()))
+        progress = ProgressThrottle(message_queue, task_manager, 
+                telemetry.base_time, 
+                config_manager['backend']['progress_update_rate'])
         while True:
-            # queue up ready tasks
-            ready_tasks = self.task_manager.get_ready_tasks()
-            while ready_tasks:
-                picked_task = random.choice(ready_tasks)
-                task_info = self.task_manager.checkout_task(picked_task)
+            if cancel_event.is_set() and not run_cancelled:
+                run_cancelled = True
+                for task in self._cancel_waiting_tasks(task_manager, submitted):
+                    message_queue.put(('CANCELLED_TASK', str(task)))
+                    on_task_done(task, 'Cancelled: the run was cancelled.')
+                message_queue.put(('CANCELLED_RUN', None))
+
+            # queue up ready tasks, in the order given by the scheduling policy
+            picked_task = task_manager.get_next_task()
+            while picked_task is not None:
+
+                # alias tasks just pass their inputs along, no worker needed.
+                if picked_task.is_alias:
+                    task_manager.checkout_task(picked_task)
+                    alias_result = picked_task.alias_result()
+                    task_manager.complete_task(picked_task, alias_result)
+                    results_index[picked_task.task_id] = alias_result
+                    telemetry.task_aliased(picked_task)
+                    message_queue.put(('ALIASED_TASK', str(picked_task)))
+                    on_task_done(picked_task, None)
+                    picked_task = task_manager.get_next_task()
+                    continue
+
+                # skip tasks whose results are already in the cache.
+                cache_key = None
+                if result_cache is not None:
+                    cache_key = picked_task.cache_key
+                if cache_key is not None:
+                    cached_result = result_cache.lookup(cache_key)
+                    if cached_result is not None:
+                        task_manager.checkout_task(picked_task)
+                        task_manager.complete_task(picked_task, 
+                                cached_result)
+                        results_index[picked_task.task_id] = cached_result
+                        telemetry.task_cached(picked_task)
+                        message_queue.put(('CACHED_TASK', str(picked_task)))
+                        on_task_done(picked_task, None)
+                        picked_task = task_manager.get_next_task()
+                        continue
+                    cache_keys[picked_task.task_id] = cache_key
+
+                task_info = task_manager.checkout_task(picked_task)
+                # the pool sends large arrays through shared memory.
+                task_info['shared_memory_threshold'] = shared_memory_threshold
                 message_queue.put(('RUNNING_TASK', str(picked_task)))
-                message_queue.put(('DISPLAY_GRAPH', 
-                        (self.task_manager.get_plot_dict(), 
-                        time.time()-base_time)))
-                input_queue.put(task_info)
-                queued_tasks += 1
+                telemetry.task_enqueued(picked_task)
+                pool.submit(picked_task.job_kind, task_info, channel)
+                submitted[picked_task.task_id] = task_info
+                num_outstanding += 1
 
-                ready_tasks = self.task_manager.get_ready_tasks()
+                picked_task = task_manager.get_next_task()
 
             # wait for one result
-            if queued_tasks > 0:
-                result = results_queue.get()
+            if num_outstanding > 0:
+                result = pool.get_result(channel)
+                num_outstanding -= 1
                 finished_task_id = result['task_id']
+                result['result'] = adopt_arrays(result['result'])
                 finished_task = task_index[finished_task_id]
+                telemetry.task_finished(finished_task, result)
+
+                # transient failures (like a worker crash) are retried.
+                if (result['result'] is None and is_transient_failure(result)
+                        and num_retries[finished_task_id] < max_retries
+                        and not cancel_event.is_set()):
+                    num_retries[finished_task_id] += 1
+                    message_queue.put(('TASK_RETRY', 
+                            {'task':str(finished_task),
+                             'traceback':result['traceback'],
+                             'attempt':num_retries[finished_task_id]}))
+                    telemetry.task_enqueued(finished_task)
+                    pool.submit(finished_task.job_kind, 
+                            submitted[finished_task_id], channel)
+                    num_outstanding += 1
+                    continue
+
+                submitted.pop(finished_task_id, None)
                 results_index[finished_task_id] = result['result']
-                if result['result'] is None:
+                cache_key = cache_keys.pop(finished_task_id, None)
+                if result['result'] is None and cancel_event.is_set():
+                    # stopped by cancel_run, not a failure of the task.
+                    message_queue.put(('CANCELLED_TASK', str(finished_task)))
+                    task_manager.complete_task(finished_task)
+                    on_task_done(finished_task, 
+                            'Cancelled: the run was cancelled.')
+                elif result['result'] is None:
+                    if isolate_failures:
+                        # only the work that depends on this task is lost.
+                        cancelled_tasks = \
+                                task_manager.remove_dependent_tasks(
+                                finished_task)
+                    task_manager.complete_task(finished_task)
+                    if not isolate_failures:
+                        # tasks already running are allowed to finish.
+                        cancelled_tasks = self._cancel_waiting_tasks(
+                                task_manager, submitted)
                     message_queue.put(('TASK_ERROR', 
                             {'task':str(finished_task),
                              'traceback':result['traceback'],
-                             'runtime':result['runtime']}))
-                    self.task_manager.complete_task(finished_task)
-                    self.task_manager.remove_all_tasks()
+                             'runtime':result['runtime'],
+                             'aborted':not isolate_failures}))
+                    on_task_done(finished_task, result['traceback'])
+                    for task in cancelled_tasks:
+                        message_queue.put(('CANCELLED_TASK', str(task)))
+                        on_task_done(task, 'Cancelled: %s failed.' % 
+                                str(finished_task))
                 else:
                     message_queue.put(('FINISHED_TASK', 
                             {'task':str(finished_task), 
                              'runtime':result['runtime']}))
-                    self.task_manager.complete_task(finished_task, 
+                    step_runtimes = result.get('step_runtimes', 
+                            [result['runtime']])
+                    for step, runtime in zip(finished_task.steps, 
+                            step_runtimes):
+                        self.runtime_estimates.update(step.plugin.name,
+                                runtime, len(step.trials))
+                    self._update_memory_estimates(task_manager, 
+                            finished_task, telemetry.records[finished_task_id])
+                    task_manager.complete_task(finished_task, 
                             result['result'])
-                message_queue.put(('DISPLAY_GRAPH', 
-                        (self.task_manager.get_plot_dict(),
-                        time.time()-base_time)))
-
-            # are we done queueing up tasks? then add in the sentinals.
-            if self.task_manager.num_tasks == 0:
-                for i in xrange(num_process_workers):
-                    input_queue.put(None)
-            
-                # are we done getting results? then exit.
-                if len(results_index.keys()) == queued_tasks:
-                    break
-
-        for job in jobs:
-            job.join() # halt this thread until processes are all complete.
-        message_queue.put(('FINISHED_RUN', None))
-
+                    if cache_key is not None:
+                        result_cache.store_later(cache_key, result['result'])
+                    on_task_done(finished_task, None)
+            progress.update()
+
+            # are we done queueing up tasks and getting results? then exit.
+            if task_manager.num_tasks == 0 and num_outstanding == 0:
+                break
+
+        progress.update(force=True)
+        self.runtime_estimates.save()
+        self.memory_estimates.save()
+        telemetry.finish()
+        trace_filename = None
+        if config_manager['backend']['save_telemetry']:
+            trace_filename = self.save_telemetry(telemetry)
+        message_queue.put(('RUN_TELEMETRY', 
+                {'summary':telemetry.format_summary(),
+                 'trace_filename':trace_filename}))
         return task_index, results_index
 
     def open_file(self, fullpath, **kwargs):
@@ -261,35 +561,19 @@ class ProcessManager(object):
                 traceback.print_exc()
             return results
 
-        num_process_workers = config_manager.get_num_workers()
-        if len(fullpaths) < num_process_workers:
-            num_process_workers = len(fullpaths)
-
-        # setup the input and return queues.
-        input_queue = multiprocessing.Queue()
+        pool, pool_is_temporary = self._get_worker_pool(len(fullpaths))
+        channel = pool.new_channel()
+        processing_dtype = config_manager['backend']['processing_dtype']
         for fullpath in fullpaths:
-            input_queue.put(fullpath)
-        for i in xrange(num_process_workers):
-            input_queue.put(None)
-        results_queue = multiprocessing.Queue()
-
-        # start the jobs
-        jobs = []
-        for i in xrange(num_process_workers):
-            job = multiprocessing.Process(target=open_file_worker, 
-                                          args=(input_queue, 
-                                                results_queue))
-            job.start()
-            jobs.append(job)
+            pool.submit('open_file', {'fullpath':fullpath, 'kwargs':kwargs,
+                    'processing_dtype':processing_dtype}, channel)
 
         # collect the results, waiting for all the jobs to complete
         results_list = []
         for i in xrange(len(fullpaths)):
             # file_interpreters return list of trial objects.
-            results_list.extend(results_queue.get())
-
-        for job in jobs:
-            job.join() # halt this thread until processes are all complete.
+            results_list.extend(pool.get_result(channel))
 
+        if pool_is_temporary:
+            pool.shutdown()
         return results_list
-
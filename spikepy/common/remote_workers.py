@@ -0,0 +1,501 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import cPickle
+import itertools
+import multiprocessing
+import os
+import Queue
+import socket
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+
+from spikepy.common.config_manager import config_manager
+from spikepy.common.errors import *
+from spikepy.common.worker_pool import WorkerPool, pool_worker,\
+        make_failure_result
+
+# messages bigger than this are sent in several pieces.
+CHUNK_SIZE = 8*2**20
+
+def parse_address(address):
+    '''Turn 'host:port' into (host, port).'''
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        raise ConfigError('Addresses must look like host:port, not %s' %
+                address)
+    return (host or '127.0.0.1', int(port))
+
+def get_authkey(authkey=None):
+    '''Return <authkey> or, if it is None, [backend] remote_authkey.'''
+    if authkey is None:
+        authkey = config_manager['backend']['remote_authkey']
+    if not authkey:
+        raise ConfigError('Remote workers need a shared secret, set [backend] remote_authkey.')
+    return str(authkey)
+
+
+class ChunkedSender(object):
+    '''
+        Puts messages on <queue> as pickled pieces of at most <chunk_size>
+    bytes, so big arrays don't have to go through a connection in one piece.
+    Use a ChunkedReceiver to get them back.
+    '''
+    def __init__(self, queue, chunk_size=CHUNK_SIZE):
+        self.queue = queue
+        self.chunk_size = chunk_size
+        self._sender_id = uuid.uuid4().hex
+        self._message_ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def put(self, message):
+        data = cPickle.dumps(message, protocol=-1)
+        num_chunks = max((len(data) + self.chunk_size - 1)/self.chunk_size, 1)
+        with self._lock:
+            key = (self._sender_id, next(self._message_ids))
+            for i in xrange(num_chunks):
+                self.queue.put((key, i, num_chunks,
+                        data[i*self.chunk_size:(i+1)*self.chunk_size]))
+
+
+class ChunkedReceiver(object):
+    '''Reassembles the messages sent by ChunkedSenders to <queue>.'''
+    def __init__(self, queue):
+        self.queue = queue
+        self._partial = {}
+
+    def get(self, block=True, timeout=None):
+        '''Like Queue.get, the timeout applies to each piece.'''
+        while True:
+            key, i, num_chunks, data = self.queue.get(block, timeout)
+            if num_chunks == 1:
+                return cPickle.loads(data)
+            chunks = self._partial.setdefault(key, [None]*num_chunks)
+            chunks[i] = data
+            if None not in chunks:
+                del self._partial[key]
+                return cPickle.loads(''.join(chunks))
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+
+class WorkerManager(BaseManager):
+    '''The connection between a RemoteWorkerPool and its remote workers.'''
+    pass
+
+for typeid in ['get_registry', 'get_results_queue', 'get_input_queue']:
+    WorkerManager.register(typeid)
+
+
+class RemoteWorker(object):
+    '''The RemoteWorkerPool's view of one remote worker.'''
+    def __init__(self, pool, worker_index, host, pid):
+        self.pool = pool
+        self.worker_index = worker_index
+        self.host = host
+        self.pid = pid
+        self.last_seen = time.time()
+        self.retired = False
+        self.exitcode = None
+
+    def __str__(self):
+        return '%s (pid %s)' % (self.host, self.pid)
+
+    def is_alive(self):
+        return (not self.retired and time.time() - self.last_seen <
+                self.pool.heartbeat_timeout)
+
+    def terminate(self):
+        '''Ask the worker to stop the job it is running.'''
+        self.pool._input_queues[self.worker_index].put({'kind':'cancel'})
+
+    def join(self):
+        pass
+
+
+class RemoteWorkerRegistry(object):
+    '''Lives in the parent and is called by remote workers (via a proxy).'''
+    def __init__(self, pool):
+        self.pool = pool
+
+    def register(self, host, pid):
+        '''Add a worker, returns the worker_index it should use.'''
+        return self.pool._add_worker(host, pid)
+
+    def heartbeat(self, worker_index):
+        '''Returns False if the worker should register again.'''
+        return self.pool._heartbeat(worker_index)
+
+
+class RemoteWorkerPool(WorkerPool):
+    '''
+        A WorkerPool whose workers run on other machines (or other users'
+    sessions on this one).  start() listens on <address> ('host:port',
+    defaults to [backend] remote_address) and workers join by running
+    spikepy_worker.py --connect host:port, which can be done before or
+    after the pool is started.  Connections are authenticated with
+    <authkey> (defaults to [backend] remote_authkey).
+
+        Jobs are routed exactly as with local workers, except that shared
+    memory is never used.  Workers that stop sending heartbeats for
+    heartbeat_timeout seconds are dropped and their jobs fail with the
+    error_type 'WorkerDiedError' (so they are retried on other workers).
+    The workers open data files themselves, so the files must be at the
+    same paths on every machine.
+    '''
+    # seconds without a heartbeat before a worker is considered lost.
+    heartbeat_timeout = 10.0
+
+    def __init__(self, address=None, authkey=None, chunk_size=CHUNK_SIZE):
+        WorkerPool.__init__(self)
+        if address is None:
+            address = config_manager['backend']['remote_address']
+        self._address = parse_address(address)
+        self._authkey = authkey
+        self.chunk_size = chunk_size
+        self._server = None
+        self._server_thread = None
+        self._raw_input_queues = {}
+
+    @property
+    def address(self):
+        '''The (host, port) the pool is listening on.'''
+        if self._server is not None:
+            return self._server.address
+        return self._address
+
+    @property
+    def num_workers(self):
+        return len([w for w in self._workers if w.is_alive()])
+
+    @property
+    def is_running(self):
+        return self._server is not None
+
+    def start(self):
+        '''Start listening for workers (if not already listening).'''
+        with self._start_lock:
+            if self._server is not None:
+                return
+            raw_results_queue = Queue.Queue()
+            self._results_queue = ChunkedReceiver(raw_results_queue)
+            registry = RemoteWorkerRegistry(self)
+
+            class ServerManager(WorkerManager):
+                pass
+            ServerManager.register('get_registry', callable=lambda:registry,
+                    exposed=['register', 'heartbeat'])
+            ServerManager.register('get_results_queue',
+                    callable=lambda:raw_results_queue)
+            ServerManager.register('get_input_queue',
+                    callable=lambda i:self._raw_input_queues[i])
+            manager = ServerManager(address=self._address,
+                    authkey=get_authkey(self._authkey))
+            self._server = manager.get_server()
+            self._server_thread = threading.Thread(target=self._serve,
+                    args=(self._server,))
+            self._server_thread.daemon = True
+            self._server_thread.start()
+
+    def _serve(self, server):
+        # like server.serve_forever(), but it stops when the listener closes.
+        while self._server is server:
+            try:
+                connection = server.listener.accept()
+            except:
+                continue
+            thread = threading.Thread(target=server.handle_request,
+                    args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def _add_worker(self, host, pid):
+        with self._dispatch_lock:
+            worker_index = len(self._workers)
+            input_queue = Queue.Queue()
+            self._raw_input_queues[worker_index] = input_queue
+            self._workers.append(RemoteWorker(self, worker_index, host, pid))
+            self._input_queues.append(ChunkedSender(input_queue,
+                    self.chunk_size))
+            self._mirrors.append(OrderedDict())
+            self._running_jobs[worker_index] = None
+            self._dispatch_waiting_jobs()
+        return worker_index
+
+    def _heartbeat(self, worker_index):
+        with self._dispatch_lock:
+            if worker_index >= len(self._workers):
+                return False
+            worker = self._workers[worker_index]
+            if worker.retired:
+                return False
+            worker.last_seen = time.time()
+            return True
+
+    def _dispatch(self, job, worker_index):
+        # arrays can't be shared through memory with another machine.
+        if job['payload'].get('shared_memory_threshold', None) is not None:
+            job['payload'] = dict(job['payload'],
+                    shared_memory_threshold=None)
+        WorkerPool._dispatch(self, job, worker_index)
+
+    def _retire_worker(self, worker_index):
+        # the slot runs jobs in a child with a results queue of its own, so
+        #   it can stop the child and start another (see WorkerSlot).  The
+        #   result it sends for the cancelled job is then ignored.
+        self._workers[worker_index].terminate()
+        self._running_jobs[worker_index] = None
+        self._mirrors[worker_index] = OrderedDict()
+        for waiting_job in self._waiting_jobs:
+            if waiting_job['preferred_worker'] == worker_index:
+                waiting_job['preferred_worker'] = None
+
+    def _replace_dead_workers(self):
+        '''
+            Remote workers can't be restarted from here, so lost workers are
+        dropped instead.  Returns messages reporting the failure of the jobs
+        they were running.
+        '''
+        messages = []
+        with self._dispatch_lock:
+            for worker_index, worker in enumerate(self._workers):
+                if worker.retired or worker.is_alive():
+                    continue
+                worker.retired = True
+                self._raw_input_queues.pop(worker_index, None)
+                self._mirrors[worker_index] = OrderedDict()
+                for waiting_job in self._waiting_jobs:
+                    if waiting_job['preferred_worker'] == worker_index:
+                        waiting_job['preferred_worker'] = None
+                job = self._running_jobs.pop(worker_index)
+                if job is not None:
+                    messages.append({'channel':job['channel'],
+                            'worker':worker_index, 'job_id':job['job_id'],
+                            'retired':True,
+                            'result':make_failure_result(job,
+                                    'WorkerDiedError', 'lost contact with '
+                                    'the remote worker %s.' % worker)})
+        return messages
+
+    def _job_finished(self, message):
+        with self._dispatch_lock:
+            if message.get('retired', False):
+                self._dispatch_waiting_jobs()
+                return True
+            worker_index = message['worker']
+            if (message.get('restarted', False) and
+                    worker_index in self._running_jobs):
+                # the worker lost its cache when it was restarted.
+                self._mirrors[worker_index] = OrderedDict()
+            return WorkerPool._job_finished(self, message)
+
+    def _join_worker(self, worker):
+        pass # remote workers go back to waiting for a pool.
+
+    def _stop_workers(self):
+        WorkerPool._stop_workers(self)
+        self._raw_input_queues = {}
+
+    def shutdown(self):
+        '''
+            Release the workers (they go back to waiting for a pool) and stop
+        listening.
+        '''
+        WorkerPool.shutdown(self)
+        with self._start_lock:
+            server = self._server
+            self._server = None
+            if server is not None:
+                # wake up the thread waiting in accept() so it can exit.
+                host, port = server.address
+                if host in ['', '0.0.0.0']:
+                    host = '127.0.0.1'
+                try:
+                    socket.create_connection((host, port), 5.0).close()
+                except socket.error:
+                    pass
+                self._server_thread.join()
+                self._server_thread = None
+                server.listener.close()
+
+
+class WorkerSlot(object):
+    '''
+        Runs in a spikepy_worker.py process.  Connects to a RemoteWorkerPool,
+    runs the jobs it is sent in a child process (see pool_worker) and sends
+    back the results.  The child is restarted if it dies or the pool cancels
+    its job.  When the pool shuts down (or can't be reached) the slot waits
+    for it to come back.
+    '''
+    def __init__(self, address, authkey, poll_interval=1.0,
+            heartbeat_interval=1.0, chunk_size=CHUNK_SIZE):
+        self.address = address
+        self.authkey = authkey
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.chunk_size = chunk_size
+        self._stopped = threading.Event()
+        self._child = None
+
+    def stop(self):
+        self._stopped.set()
+
+    def serve_forever(self):
+        '''Serve pools until stop() is called.'''
+        authentication_failed = False
+        try:
+            while not self._stopped.is_set():
+                try:
+                    self._serve_pool()
+                except multiprocessing.AuthenticationError:
+                    if not authentication_failed:
+                        print 'Could not authenticate with %s:%d, check the authkey.' % self.address
+                    authentication_failed = True
+                except (EOFError, IOError, socket.error):
+                    pass # the pool went away, wait for another.
+                except:
+                    traceback.print_exc()
+                self._stopped.wait(self.poll_interval)
+        finally:
+            self._stop_child()
+
+    def _serve_pool(self):
+        # connect() keeps trying for 20 seconds, so check for a pool first.
+        socket.create_connection(self.address, self.poll_interval).close()
+        manager = WorkerManager(address=self.address, authkey=self.authkey)
+        manager.connect()
+        proxies = [manager.get_registry()]
+        try:
+            registry = proxies[0]
+            worker_index = registry.register(socket.gethostname(), os.getpid())
+            proxies.append(manager.get_input_queue(worker_index))
+            proxies.append(manager.get_results_queue())
+            self._serve_jobs(registry, worker_index, 
+                    ChunkedReceiver(proxies[1]), 
+                    ChunkedSender(proxies[2], self.chunk_size))
+        finally:
+            # proxies tell the pool when they are deleted, which blocks for
+            #   a long time if the pool has already gone away.
+            for proxy in proxies:
+                proxy._close.cancel()
+
+    def _serve_jobs(self, registry, worker_index, input_queue, results_queue):
+        self._last_heartbeat = 0.0
+        # a fresh child per pool, the pool expects an empty cache.
+        self._start_child()
+        while not self._stopped.is_set():
+            if not self._heartbeat(registry, worker_index):
+                return
+            try:
+                job = input_queue.get(timeout=self.poll_interval)
+            except Queue.Empty:
+                continue
+            if job is None: # the pool is shutting down.
+                return
+            if job['kind'] == 'cancel': # the job already finished.
+                continue
+            self._child_input.put(job)
+            result = self._wait_for_result(job, registry, worker_index,
+                    input_queue)
+            if result is None:
+                return
+            result['worker'] = worker_index
+            results_queue.put(result)
+
+    def _heartbeat(self, registry, worker_index):
+        now = time.time()
+        if now - self._last_heartbeat < self.heartbeat_interval:
+            return True
+        self._last_heartbeat = now
+        return registry.heartbeat(worker_index)
+
+    def _wait_for_result(self, job, registry, worker_index, input_queue):
+        '''
+            Return the result of <job>, a failure if the child died or the
+        job was cancelled, or None if the pool is shutting down.
+        '''
+        while True:
+            try:
+                return self._child_results.get(timeout=self.poll_interval)
+            except Queue.Empty:
+                pass
+            if self._stopped.is_set() or not self._heartbeat(registry,
+                    worker_index):
+                return None
+            if not self._child.is_alive():
+                reason = 'the worker process running this task died ' +\
+                        '(exitcode %s).' % self._child.exitcode
+            else:
+                try:
+                    control = input_queue.get_nowait()
+                except Queue.Empty:
+                    continue
+                if control is None:
+                    return None
+                reason = 'the job was cancelled.'
+            self._start_child()
+            return {'channel':job['channel'], 'job_id':job['job_id'],
+                    'restarted':True,
+                    'result':make_failure_result(job, 'WorkerDiedError',
+                            reason)}
+
+    def _start_child(self):
+        self._stop_child()
+        self._child_input = multiprocessing.Queue()
+        self._child_results = multiprocessing.Queue()
+        self._child = multiprocessing.Process(target=pool_worker,
+                args=(self._child_input, self._child_results, 0))
+        self._child.daemon = True
+        self._child.start()
+
+    def _stop_child(self):
+        if self._child is not None:
+            self._child.terminate()
+            self._child.join()
+            self._child = None
+
+
+def run_remote_workers(address, authkey=None, num_workers=None):
+    '''
+        Serve RemoteWorkerPools at <address> ('host:port') with <num_workers>
+    worker processes (defaults to config_manager.get_num_workers()) until
+    interrupted.
+    '''
+    if num_workers is None:
+        num_workers = config_manager.get_num_workers()
+    slots = [WorkerSlot(parse_address(address), get_authkey(authkey))
+            for i in xrange(num_workers)]
+    threads = []
+    for slot in slots:
+        thread = threading.Thread(target=slot.serve_forever)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    try:
+        while any(thread.is_alive() for thread in threads):
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for slot in slots:
+            slot.stop()
+        for thread in threads:
+            thread.join()
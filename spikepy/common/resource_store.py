@@ -0,0 +1,240 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
+
+import numpy
+
+class DeferredData(object):
+    '''
+        Stands in for the data of a Resource until it is first asked for 
+    (see ResourceStore.get_data), subclasses implement load().  Subclasses
+    that know the shape and dtype of the data without loading it set them.
+    '''
+    shape = None
+    dtype = None
+
+    def load(self):
+        raise NotImplementedError
+
+
+class SpilledData(DeferredData):
+    '''Stands in for the data of a Resource that was written to <filename>.'''
+    def __init__(self, filename):
+        self.filename = filename
+
+    def load(self):
+        '''
+            Memory-map the data.  It is copy-on-write, so changing it never
+        touches the file.
+        '''
+        return numpy.load(self.filename, mmap_mode='c')
+
+
+def _buffer_owner(array):
+    '''Return the array that owns the memory <array> is a view of.'''
+    while isinstance(array.base, numpy.ndarray):
+        array = array.base
+    return array
+
+
+class ResourceStore(object):
+    '''
+        Keeps the large arrays held by Resources within a memory ceiling by
+    writing the least recently used ones to .npy files (spilling them).  A
+    spilled array is memory-mapped back in the next time Resource.data is
+    asked for, after that it is backed by the file and no longer counts
+    against the ceiling.  Resources that are checked out are never spilled.
+    Arrays that are views of the same buffer (see task_manager.share_data)
+    count once, and are spilled together since that is the only way to 
+    free the buffer.
+        The store does nothing until configure() is given a ceiling (see
+    Session, which uses [backend] resource_memory_ceiling).
+    '''
+    # arrays smaller than this (in bytes) are never spilled.
+    min_size = 2**20
+
+    def __init__(self):
+        self.max_memory = None
+        self.directory = None
+        self._lock = threading.RLock()
+        self._resources = {} # resource id -> weakref, for every array
+        self._buffer_ids = {} # resource id -> id of its array's buffer
+        self._buffers = {} # buffer id -> ids of the resources sharing it
+        self._in_memory = OrderedDict() # buffer id -> nbytes, LRU first.
+        self._files = {} # resource id -> filename of its spilled data
+        self._memory = 0
+        self.num_spilled = 0
+
+    @property
+    def enabled(self):
+        return self.max_memory is not None
+
+    @property
+    def memory(self):
+        '''How many bytes of spillable arrays are in memory.'''
+        return self._memory
+
+    def configure(self, max_memory, directory=None):
+        '''
+            Keep the arrays within <max_memory> bytes (None turns spilling
+        off), spilling them into a new directory inside <directory>.
+        '''
+        with self._lock:
+            self.max_memory = max_memory
+            if max_memory is not None and self.directory is None:
+                if directory is not None and not os.path.exists(directory):
+                    os.makedirs(directory)
+                self.directory = tempfile.mkdtemp(prefix='spilled-', 
+                        dir=directory)
+                atexit.register(self.close)
+            self._evict()
+
+    def close(self):
+        '''
+            Delete the spill directory.  Only call this when the resources
+        are no longer needed (at exit).
+        '''
+        with self._lock:
+            if self.directory is not None:
+                shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+            self.max_memory = None
+            self._resources.clear()
+            self._buffer_ids.clear()
+            self._buffers.clear()
+            self._in_memory.clear()
+            self._files.clear()
+            self._memory = 0
+
+    def _is_spillable(self, data):
+        return (isinstance(data, numpy.ndarray) and 
+                not isinstance(data, numpy.memmap) and
+                data.dtype != object and data.nbytes >= self.min_size)
+
+    def _forget(self, resource_id):
+        self._resources.pop(resource_id, None)
+        buffer_id = self._buffer_ids.pop(resource_id, None)
+        if buffer_id is not None:
+            sharing = self._buffers[buffer_id]
+            sharing.remove(resource_id)
+            if not sharing:
+                del self._buffers[buffer_id]
+                self._memory -= self._in_memory.pop(buffer_id)
+        filename = self._files.pop(resource_id, None)
+        # views spilled together may share a file.
+        if (filename is not None and filename not in self._files.values() 
+                and os.path.exists(filename)):
+            os.remove(filename)
+
+    def data_changed(self, resource):
+        '''Called by <resource> when its data has been replaced.'''
+        with self._lock:
+            self._forget(resource.id)
+            if not self.enabled or not self._is_spillable(resource._data):
+                return
+            resource_id = resource.id
+            self._resources[resource_id] = weakref.ref(resource, 
+                    lambda ref:self._resource_deleted(resource_id))
+            # the owner stays alive as long as a view of it does, so its
+            #   id can't be reused while it is tracked.
+            owner = _buffer_owner(resource._data)
+            buffer_id = id(owner)
+            self._buffer_ids[resource_id] = buffer_id
+            if buffer_id in self._buffers:
+                self._buffers[buffer_id].add(resource_id)
+                self._touch(buffer_id)
+            else:
+                self._buffers[buffer_id] = set([resource_id])
+                self._in_memory[buffer_id] = owner.nbytes
+                self._memory += owner.nbytes
+            self._evict()
+
+    def _touch(self, buffer_id):
+        '''Mark the buffer <buffer_id> as the most recently used.'''
+        self._in_memory[buffer_id] = self._in_memory.pop(buffer_id)
+
+    def checked_in(self, resource):
+        '''
+            Called by <resource> when it is checked in without new data, it
+        may be spilled now.
+        '''
+        with self._lock:
+            self._evict()
+
+    def _resource_deleted(self, resource_id):
+        with self._lock:
+            self._forget(resource_id)
+
+    def get_data(self, resource):
+        '''
+            Return the data of <resource>, memory-mapping it back in if it
+        was spilled (or loading it, if it was deferred).  Used by 
+        Resource.data.
+        '''
+        with self._lock:
+            data = resource._data
+            if isinstance(data, DeferredData):
+                data = data.load()
+                resource._data = data
+                if resource.id not in self._files: # loaded the first time.
+                    self.data_changed(resource)
+            elif resource.id in self._buffer_ids:
+                self._touch(self._buffer_ids[resource.id])
+            return data
+
+    def _evict(self):
+        if not self.enabled:
+            return
+        for buffer_id in self._in_memory.keys():
+            if self._memory <= self.max_memory:
+                break
+            resources = [self._resources[resource_id]() 
+                    for resource_id in self._buffers[buffer_id]]
+            if any(resource is None or resource.is_locked 
+                    for resource in resources):
+                continue
+            self._spill(buffer_id, resources)
+
+    def _spill(self, buffer_id, resources):
+        '''
+            Spill the <resources>, whose arrays share the buffer <buffer_id>.
+        Arrays that are the same view of it are written to one file.
+        '''
+        filenames = {} # (address, shape, strides, dtype) -> filename
+        for resource in resources:
+            data = resource._data
+            view = (data.__array_interface__['data'][0], data.shape, 
+                    data.strides, data.dtype.str)
+            if view not in filenames:
+                filenames[view] = os.path.join(self.directory, 
+                        '%s.npy' % uuid.uuid4())
+                numpy.save(filenames[view], data)
+            self._files[resource.id] = filenames[view]
+            resource._data = SpilledData(filenames[view])
+            del self._buffer_ids[resource.id]
+        del self._buffers[buffer_id]
+        self._memory -= self._in_memory.pop(buffer_id)
+        self.num_spilled += len(resources)
+
+resource_store = ResourceStore()
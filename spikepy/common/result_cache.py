@@ -0,0 +1,175 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import cPickle
+import os
+import Queue
+import threading
+import time
+import uuid
+
+from spikepy.common.run_telemetry import get_serialized_size
+
+class ResultCache(object):
+    '''
+        An on-disk, size-limited cache of task results.  Entries are keyed
+    on Task.cache_key and evicted least-recently-used first once the total
+    size of the cache exceeds <max_size> bytes.  Results can be written
+    by a background thread (see store_later), so storing them doesn't hold
+    up the run.
+    '''
+    suffix = '.result'
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._index = {} # key -> [size, last_used]
+        self._total_size = 0
+        self._pending = {} # key -> result, waiting to be written.
+        self._write_queue = Queue.Queue()
+        self._writer = None
+        self._load_index()
+
+    def _load_index(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        for filename in os.listdir(self.directory):
+            if filename.endswith(self.suffix):
+                key = filename[:-len(self.suffix)]
+                stat = os.stat(os.path.join(self.directory, filename))
+                self._index[key] = [stat.st_size, stat.st_mtime]
+                self._total_size += stat.st_size
+            elif filename.endswith('.tmp'): # left over from a failed store.
+                os.remove(os.path.join(self.directory, filename))
+
+    def _get_filename(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    @property
+    def total_size(self):
+        return self._total_size
+
+    def __contains__(self, key):
+        return key in self._index or key in self._pending
+
+    def __len__(self):
+        return len(self._index)
+
+    def lookup(self, key):
+        '''Return the result stored under <key> or None if there isn't one.'''
+        with self._lock:
+            if key in self._pending:
+                return self._pending[key]
+            if key not in self._index:
+                return None
+            filename = self._get_filename(key)
+            try:
+                with open(filename, 'rb') as infile:
+                    result = cPickle.load(infile)
+            except (IOError, EOFError, cPickle.UnpicklingError):
+                self._remove(key)
+                return None
+            now = time.time()
+            self._index[key][1] = now
+            try:
+                os.utime(filename, (now, now))
+            except OSError:
+                pass
+            return result
+
+    def store(self, key, result):
+        '''
+            Store <result> under <key>, evicting old entries if needed.  
+        Results that (roughly, see get_serialized_size) won't fit in the 
+        cache are not written at all.
+        '''
+        if get_serialized_size(result) > self.max_size:
+            return
+        filename = self._get_filename(key)
+        tmp_filename = os.path.join(self.directory,
+                '%s.tmp' % uuid.uuid4().hex)
+        with open(tmp_filename, 'wb') as ofile:
+            cPickle.dump(result, ofile, protocol=-1)
+        size = os.path.getsize(tmp_filename)
+        with self._lock:
+            if size > self.max_size:
+                os.remove(tmp_filename)
+                return
+            if key in self._index:
+                self._remove(key)
+            if os.path.exists(filename): # os.rename won't replace on windows.
+                os.remove(filename)
+            os.rename(tmp_filename, filename)
+            self._index[key] = [size, time.time()]
+            self._total_size += size
+            self._evict()
+
+    def store_later(self, key, result):
+        '''
+            Store <result> under <key> from a background thread.  Until it
+        is written lookup returns it from memory.
+        '''
+        with self._lock:
+            is_queued = key in self._pending
+            self._pending[key] = result
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_pending)
+                self._writer.daemon = True
+                self._writer.start()
+        if not is_queued:
+            self._write_queue.put(key)
+
+    def _write_pending(self):
+        while True:
+            key = self._write_queue.get()
+            with self._lock:
+                result = self._pending[key]
+            try:
+                self.store(key, result)
+            except (IOError, OSError, cPickle.PicklingError):
+                pass # it's only a cache.
+            finally:
+                with self._lock:
+                    self._pending.pop(key, None)
+                self._write_queue.task_done()
+
+    def flush(self):
+        '''Wait until the results given to store_later are written.'''
+        self._write_queue.join()
+
+    def _evict(self):
+        if self._total_size <= self.max_size:
+            return
+        by_age = sorted(self._index.items(), key=lambda item:item[1][1])
+        for key, (size, last_used) in by_age:
+            if self._total_size <= self.max_size:
+                break
+            self._remove(key)
+
+    def _remove(self, key):
+        size, last_used = self._index.pop(key)
+        self._total_size -= size
+        try:
+            os.remove(self._get_filename(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        '''Remove all entries from the cache.'''
+        with self._lock:
+            for key in self._index.keys():
+                self._remove(key)
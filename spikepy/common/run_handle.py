@@ -0,0 +1,251 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+import traceback
+from collections import defaultdict
+
+from spikepy.common.errors import *
+
+class Future(object):
+    '''
+        The eventual result of some work, in the style of
+    concurrent.futures.Future.  Functions added with add_done_callback are
+    called (with the future as the only argument) once the future is done,
+    from the thread that finished it.
+    '''
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._state = 'pending' # 'finished' or 'cancelled' when done.
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def __repr__(self):
+        return '<Future %s>' % self._state
+
+    def done(self):
+        return self._state != 'pending'
+
+    def cancelled(self):
+        return self._state == 'cancelled'
+
+    def cancel(self):
+        '''
+            Cancel the future (if it isn't done already).  Returns True if
+        the future is cancelled.
+        '''
+        with self._condition:
+            if self._state == 'finished':
+                return False
+            if self._state == 'cancelled':
+                return True
+            self._state = 'cancelled'
+            self._condition.notify_all()
+        self._call_callbacks()
+        return True
+
+    def _wait(self, timeout):
+        with self._condition:
+            if self._state == 'pending':
+                self._condition.wait(timeout)
+            if self._state == 'pending':
+                raise RuntimeError('Timed out waiting for the result.')
+
+    def result(self, timeout=None):
+        '''
+            Wait (at most <timeout> seconds) for the future to be done and
+        return its result.  Raises RunCancelledError if it was cancelled, or
+        the exception it was finished with.
+        '''
+        self._wait(timeout)
+        if self._state == 'cancelled':
+            raise RunCancelledError('The work was cancelled.')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        '''Like result, but returns the exception (or None) instead.'''
+        self._wait(timeout)
+        if self._state == 'cancelled':
+            raise RunCancelledError('The work was cancelled.')
+        return self._exception
+
+    def add_done_callback(self, fn):
+        with self._condition:
+            if self._state == 'pending':
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_result(self, result):
+        self._finish(result=result)
+
+    def set_exception(self, exception):
+        self._finish(exception=exception)
+
+    def _finish(self, result=None, exception=None):
+        with self._condition:
+            if self._state != 'pending':
+                return
+            self._result = result
+            self._exception = exception
+            self._state = 'finished'
+            self._condition.notify_all()
+        self._call_callbacks()
+
+    def _call_callbacks(self):
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except:
+                traceback.print_exc()
+
+
+class RunHandle(object):
+    '''
+        A handle on a run started with Session.submit.  There is a Future
+    for every (trial, stage) pair the run processes (see get_future), which
+    is done once all of that trial's tasks for the stage are done.  Its
+    result is the trial.  If one of the tasks failed the future's exception
+    is a TaskFailedError, and if the tasks were cancelled (because the run
+    was cancelled or something they depend on failed) the future is
+    cancelled.  The handle itself behaves like the Future of the whole run.
+    '''
+    def __init__(self, process_manager, tasks, message_queue, 
+            task_manager=None):
+        self.process_manager = process_manager
+        self.task_manager = task_manager # None for process_manager's own.
+        self.message_queue = message_queue
+        self.futures = {} # (trial_id, stage_name) -> Future
+        self._trials = {}
+        self._num_remaining = defaultdict(int)
+        self._errors = defaultdict(list)
+        self._lock = threading.Lock()
+        self._run_future = Future()
+        self._cancel_event = threading.Event()
+        for task in tasks:
+            for key, trial in self._get_keys(task):
+                if key not in self.futures:
+                    self.futures[key] = Future()
+                    self._trials[key] = trial
+                self._num_remaining[key] += 1
+
+    @staticmethod
+    def _get_keys(task):
+        for step in task.steps:
+            for trial in step.trials:
+                yield (trial.trial_id, step.plugin_category), trial
+
+    def get_future(self, trial, stage_name):
+        '''
+            Return the Future for <trial> (a Trial or trial_id) and
+        <stage_name>.  Raises KeyError if this run doesn't process them.
+        '''
+        trial_id = getattr(trial, 'trial_id', trial)
+        return self.futures[(trial_id, stage_name)]
+
+    def task_done(self, task, error=None):
+        '''
+            Called by ProcessManager.run_tasks as each task is done. <error>
+        is None if the task succeeded and a description of the failure
+        otherwise (see ProcessManager.run_tasks).
+        '''
+        finished = []
+        with self._lock:
+            for key, trial in self._get_keys(task):
+                if error is not None:
+                    self._errors[key].append(error)
+                self._num_remaining[key] -= 1
+                if self._num_remaining[key] == 0:
+                    finished.append(key)
+        for key in finished:
+            self._resolve(key)
+
+    def _resolve(self, key):
+        future = self.futures[key]
+        errors = self._errors.get(key, [])
+        failures = [e for e in errors if not e.startswith('Cancelled')]
+        if failures:
+            future.set_exception(TaskFailedError('\n'.join(failures)))
+        elif errors:
+            future.cancel()
+        else:
+            future.set_result(self._trials[key])
+
+    def run(self):
+        '''Run the tasks (see ProcessManager.run_tasks) in this thread.'''
+        try:
+            self.process_manager.run_tasks(message_queue=self.message_queue,
+                    on_task_done=self.task_done, 
+                    task_manager=self.task_manager, 
+                    cancel_event=self._cancel_event)
+        except Exception as exception:
+            traceback.print_exc()
+            self._finish_run(exception=exception)
+        else:
+            self._finish_run()
+
+    def _finish_run(self, exception=None):
+        # anything still pending was left out of the run.
+        for key, future in self.futures.items():
+            if not future.done():
+                if exception is not None:
+                    future.set_exception(exception)
+                else:
+                    future.cancel()
+        if exception is not None:
+            self._run_future.set_exception(exception)
+        else:
+            self._run_future.set_result(sorted(set(self._trials.values()),
+                    key=lambda trial:trial.trial_id))
+
+    def cancel(self):
+        '''
+            Cancel the run.  Tasks that haven't started are dropped and the
+        others are abandoned (see ProcessManager.cancel_run).  If the run
+        hasn't started yet it is cancelled as soon as it does.  Returns 
+        False if the run is already done.
+        '''
+        if self._run_future.done():
+            return False
+        self._cancel_event.set()
+        self.process_manager.cancel_run(self.task_manager)
+        return True
+
+    def done(self):
+        return self._run_future.done()
+
+    def result(self, timeout=None):
+        '''
+            Wait for the run to finish and return the trials it processed.
+        Raises any exception that stopped the run.
+        '''
+        return self._run_future.result(timeout=timeout)
+
+    def wait(self, timeout=None):
+        '''Wait for the run to finish, returning True if it did.'''
+        try:
+            self._run_future.exception(timeout=timeout)
+        except RuntimeError:
+            return False
+        return True
+
+    def add_done_callback(self, fn):
+        '''Call fn(<future of the run>) once the run is done.'''
+        self._run_future.add_done_callback(fn)
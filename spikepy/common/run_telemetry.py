@@ -0,0 +1,355 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import cPickle
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+
+import numpy
+
+try:
+    import resource
+except ImportError: # not available on windows.
+    resource = None
+
+def _read_proc_status(key):
+    try:
+        with open('/proc/self/status') as infile:
+            for line in infile:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1])*1024 # reported in kB.
+    except (IOError, ValueError, IndexError):
+        pass
+    return None
+
+def get_current_rss():
+    '''
+        Return the resident set size (in bytes) of this process right now,
+    or None if it can't be determined on this platform.
+    '''
+    try:
+        with open('/proc/self/statm') as infile:
+            return int(infile.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (IOError, ValueError, IndexError, AttributeError, OSError):
+        return None
+
+def reset_peak_rss():
+    '''
+        Reset the peak resident set size (see get_peak_rss) to the current
+    size, so that the peak of a single task can be measured.  Returns False
+    if that isn't supported on this platform (only linux supports it).
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as ofile:
+            ofile.write('5')
+    except (IOError, OSError):
+        return False
+    return _read_proc_status('VmHWM') is not None
+
+def get_peak_rss():
+    '''
+        Return the peak resident set size (in bytes) of this process so far
+    (or since reset_peak_rss was called), or None if it can't be determined
+    on this platform.
+    '''
+    peak_rss = _read_proc_status('VmHWM')
+    if peak_rss is not None:
+        return peak_rss
+    if resource is None:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin': # bytes on osx, kilobytes elsewhere.
+        return peak_rss
+    return peak_rss*1024
+
+def get_serialized_size(value):
+    '''
+        Return (roughly) how many bytes <value> takes up when it is pickled
+    and sent between processes.  Arrays are counted by their size instead of
+    pickling them.
+    '''
+    if isinstance(value, numpy.ndarray) and value.dtype != object:
+        return value.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(get_serialized_size(v) for v in value)
+    if isinstance(value, dict):
+        return sum(get_serialized_size(k) + get_serialized_size(v)
+                for k, v in value.items())
+    if value is None:
+        return 0
+    try:
+        return len(cPickle.dumps(value, protocol=-1))
+    except:
+        return 0
+
+
+class TaskRecord(object):
+    '''The telemetry recorded for a single task (or fused task) of a run.'''
+    def __init__(self, task, enqueue_time):
+        self.name = task.name
+        self.description = str(task)
+        self.plugin_names = [step.plugin.name for step in task.steps]
+        self.num_trials = len(task.trials)
+        self.enqueue_time = enqueue_time
+        self.dispatch_time = None
+        self.start_time = None
+        self.end_time = None
+        self.step_runtimes = None
+        self.pid = None
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.peak_rss = None
+        self.start_rss = None
+        self.cached = False
+        self.aliased = False
+        self.failed = False
+
+    @property
+    def queue_wait(self):
+        '''Seconds between being enqueued and starting on a worker.'''
+        if self.start_time is None:
+            return 0.0
+        return max(self.start_time - self.enqueue_time, 0.0)
+
+    @property
+    def runtime(self):
+        if self.start_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+    @property
+    def memory_growth(self):
+        '''
+            How many bytes the worker's memory grew by while running the
+        task, or None if that wasn't measured.
+        '''
+        if self.start_rss is None or self.peak_rss is None:
+            return None
+        return max(self.peak_rss - self.start_rss, 0)
+
+
+class RunTelemetry(object):
+    '''
+        Timing, data-transfer and memory measurements for every task of a
+    run (see ProcessManager.run_tasks).  The records can be exported as a
+    Chrome-trace (also read by Perfetto) with save_trace() or summarized per
+    plugin with get_summary() and format_summary().
+    '''
+    def __init__(self):
+        self.base_time = time.time()
+        self.end_time = None
+        self.parent_pid = os.getpid()
+        self.records = {} # task_id -> TaskRecord
+        self._order = []
+
+    def task_enqueued(self, task):
+        '''Record that <task> was handed to the worker pool.'''
+        record = TaskRecord(task, time.time())
+        if task.task_id not in self.records: # a retry replaces the record.
+            self._order.append(task.task_id)
+        self.records[task.task_id] = record
+        return record
+
+    def task_cached(self, task):
+        '''Record that the results of <task> were found in the result cache.'''
+        record = self.task_enqueued(task)
+        record.cached = True
+        return record
+
+    def task_aliased(self, task):
+        '''
+            Record that <task> was completed without a worker, since its 
+        results are aliases of its inputs (counted as cached in the summary).
+        '''
+        record = self.task_cached(task)
+        record.aliased = True
+        return record
+
+    def task_finished(self, task, result):
+        '''
+            Record the measurements made by the worker (result['telemetry'],
+        see worker_pool.pool_worker) for <task>.
+        '''
+        record = self.records.get(task.task_id)
+        if record is None:
+            record = self.task_enqueued(task)
+        measurements = result.get('telemetry', {})
+        record.dispatch_time = measurements.get('dispatch_time')
+        record.start_time = measurements.get('start_time')
+        record.end_time = measurements.get('end_time')
+        record.pid = measurements.get('pid')
+        record.input_bytes = measurements.get('input_bytes', 0)
+        record.output_bytes = measurements.get('output_bytes', 0)
+        record.peak_rss = measurements.get('peak_rss')
+        record.start_rss = measurements.get('start_rss')
+        record.step_runtimes = result.get('step_runtimes')
+        record.failed = result.get('result') is None
+        return record
+
+    def finish(self):
+        '''Mark the end of the run.'''
+        self.end_time = time.time()
+
+    def get_summary(self):
+        '''
+            Return a list of dictionaries (one per plugin, sorted by total
+        runtime) with the keys: plugin, num_tasks, num_cached, total_runtime,
+        mean_runtime, mean_queue_wait, input_bytes, output_bytes and peak_rss.
+        The steps of a fused task are counted under their own plugins.  The
+        queue wait and input are counted against the first step and the
+        output against the last, since that is where they happened.
+        '''
+        rows = defaultdict(lambda: {'num_tasks':0, 'num_cached':0,
+                'total_runtime':0.0, 'total_queue_wait':0.0, 'input_bytes':0,
+                'output_bytes':0, 'peak_rss':None})
+        for task_id in self._order:
+            record = self.records[task_id]
+            if record.cached:
+                for plugin_name in record.plugin_names:
+                    rows[plugin_name]['num_cached'] += 1
+                continue
+            runtimes = record.step_runtimes
+            if runtimes is None or len(runtimes) != len(record.plugin_names):
+                runtimes = [record.runtime/len(record.plugin_names)]*\
+                        len(record.plugin_names)
+            for i, plugin_name in enumerate(record.plugin_names):
+                row = rows[plugin_name]
+                row['num_tasks'] += 1
+                row['total_runtime'] += runtimes[i]
+                if i == 0:
+                    row['total_queue_wait'] += record.queue_wait
+                    row['input_bytes'] += record.input_bytes
+                if i == len(record.plugin_names)-1:
+                    row['output_bytes'] += record.output_bytes
+                if record.peak_rss is not None:
+                    row['peak_rss'] = max(row['peak_rss'], record.peak_rss)
+
+        summary = []
+        for plugin_name, row in rows.items():
+            num_tasks = max(row['num_tasks'], 1)
+            row['plugin'] = plugin_name
+            row['mean_runtime'] = row['total_runtime']/num_tasks
+            row['mean_queue_wait'] = row.pop('total_queue_wait')/num_tasks
+            summary.append(row)
+        return sorted(summary, key=lambda row:row['total_runtime'],
+                reverse=True)
+
+    def format_summary(self):
+        '''Return the summary (see get_summary) as a text table.'''
+        megabyte = float(2**20)
+        header = '%-24s %6s %6s %10s %10s %10s %9s %9s %9s' % ('plugin',
+                'tasks', 'cached', 'total(s)', 'mean(s)', 'wait(s)',
+                'in(MB)', 'out(MB)', 'rss(MB)')
+        lines = [header, '-'*len(header)]
+        for row in self.get_summary():
+            if row['peak_rss'] is None:
+                peak_rss = '-'
+            else:
+                peak_rss = '%.1f' % (row['peak_rss']/megabyte)
+            lines.append('%-24s %6d %6d %10.4f %10.4f %10.4f %9.2f %9.2f %9s' %
+                    (row['plugin'][:24], row['num_tasks'], row['num_cached'],
+                    row['total_runtime'], row['mean_runtime'],
+                    row['mean_queue_wait'], row['input_bytes']/megabyte,
+                    row['output_bytes']/megabyte, peak_rss))
+        if self.end_time is not None:
+            lines.append('Total run time: %.4f seconds' %
+                    (self.end_time - self.base_time))
+        return '\n'.join(lines)
+
+    def _to_microseconds(self, t):
+        return int(round((t - self.base_time)*1e6))
+
+    def get_trace_events(self):
+        '''
+            Return the records as a list of Chrome-trace events.  Each worker
+        is shown as a process, with a slice for every task (and nested slices
+        for the steps of fused tasks).  The time each task spent waiting to
+        be run is shown as an async slice on the parent process.
+        '''
+        events = [{'name':'process_name', 'ph':'M', 'pid':self.parent_pid,
+                'tid':0, 'args':{'name':'spikepy (scheduler)'}}]
+        worker_pids = set()
+        for index, task_id in enumerate(self._order):
+            record = self.records[task_id]
+            args = {'task':record.description, 'trials':record.num_trials}
+            if record.cached:
+                category = 'aliased' if record.aliased else 'cached'
+                events.append({'name':record.name, 'cat':category, 'ph':'i',
+                        's':'p', 'pid':self.parent_pid, 'tid':0,
+                        'ts':self._to_microseconds(record.enqueue_time),
+                        'args':args})
+                continue
+            if record.start_time is None:
+                continue
+
+            # time spent waiting in the queue.
+            for phase, t in [('b', record.enqueue_time),
+                    ('e', record.start_time)]:
+                events.append({'name':record.name, 'cat':'queue', 'ph':phase,
+                        'id':index, 'pid':self.parent_pid, 'tid':0,
+                        'ts':self._to_microseconds(t)})
+
+            pid = record.pid if record.pid is not None else self.parent_pid
+            worker_pids.add(pid)
+            args.update({'input_bytes':record.input_bytes,
+                    'output_bytes':record.output_bytes,
+                    'peak_rss':record.peak_rss,
+                    'queue_wait':record.queue_wait,
+                    'failed':record.failed})
+            events.append({'name':record.name, 'cat':'task', 'ph':'X',
+                    'pid':pid, 'tid':0,
+                    'ts':self._to_microseconds(record.start_time),
+                    'dur':int(round(record.runtime*1e6)), 'args':args})
+            if record.step_runtimes is not None and\
+                    len(record.plugin_names) > 1:
+                step_start = record.start_time
+                for plugin_name, runtime in zip(record.plugin_names,
+                        record.step_runtimes):
+                    events.append({'name':plugin_name, 'cat':'step',
+                            'ph':'X', 'pid':pid, 'tid':0,
+                            'ts':self._to_microseconds(step_start),
+                            'dur':int(round(runtime*1e6))})
+                    step_start += runtime
+            if record.peak_rss is not None:
+                events.append({'name':'peak_rss', 'ph':'C', 'pid':pid,
+                        'tid':0, 'ts':self._to_microseconds(record.end_time),
+                        'args':{'bytes':record.peak_rss}})
+
+        for pid in sorted(worker_pids):
+            if pid != self.parent_pid:
+                events.append({'name':'process_name', 'ph':'M', 'pid':pid,
+                        'tid':0, 'args':{'name':'worker %d' % pid}})
+        return events
+
+    def save_trace(self, filename):
+        '''Write a Chrome-trace/Perfetto JSON file to <filename>.'''
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(filename, 'w') as ofile:
+            json.dump({'traceEvents':self.get_trace_events(),
+                    'displayTimeUnit':'ms'}, ofile)
+
+    def save_summary(self, filename):
+        '''Write the summary table (see format_summary) to <filename>.'''
+        directory = os.path.dirname(filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(filename, 'w') as ofile:
+            ofile.write(self.format_summary() + '\n')
@@ -0,0 +1,89 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import os
+import threading
+
+class RuntimeEstimates(object):
+    '''
+        Per-plugin estimates of how long a task takes to run, learned from
+    the runtimes of earlier tasks.  Estimates are kept per-trial so that
+    pooling tasks (which run on many trials at once) can be estimated too.
+    If a <filename> is given the estimates are loaded from it and save()
+    writes them back, so they survive between sessions.
+    '''
+    # the mean is over (at most) this many of the latest runs, so that the
+    # estimates follow changes in the data being processed.
+    max_history = 10
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._estimates = {} # plugin_name -> [seconds per trial, num_runs]
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename, 'r') as infile:
+                    self._estimates = dict((str(key), list(value))
+                            for key, value in json.load(infile).items())
+            except (IOError, ValueError):
+                self._estimates = {}
+
+    def __contains__(self, plugin_name):
+        return plugin_name in self._estimates
+
+    def update(self, plugin_name, runtime, num_trials=1):
+        '''Record that <plugin_name> took <runtime> seconds on <num_trials>.'''
+        per_trial = float(runtime)/max(num_trials, 1)
+        with self._lock:
+            if plugin_name not in self._estimates:
+                self._estimates[plugin_name] = [per_trial, 1]
+                return
+            mean, num_runs = self._estimates[plugin_name]
+            num_runs = min(num_runs + 1, self.max_history)
+            mean += (per_trial - mean)/num_runs
+            self._estimates[plugin_name] = [mean, num_runs]
+
+    def estimate(self, plugin_name, num_trials=1):
+        '''
+            Return the estimated runtime (in seconds) of <plugin_name> on
+        <num_trials>.  Plugins that have never been run are assumed to take
+        as long as the average plugin.
+        '''
+        with self._lock:
+            if plugin_name in self._estimates:
+                per_trial = self._estimates[plugin_name][0]
+            elif self._estimates:
+                per_trial = (sum(v[0] for v in self._estimates.values())/
+                        len(self._estimates))
+            else:
+                per_trial = 1.0
+        return per_trial*num_trials
+
+    def save(self):
+        '''Write the estimates to self.filename (if it isn't None).'''
+        if self.filename is None:
+            return
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with self._lock:
+            tmp_filename = self.filename + '.tmp'
+            with open(tmp_filename, 'w') as ofile:
+                json.dump(self._estimates, ofile)
+            if os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(tmp_filename, self.filename)
@@ -16,16 +16,27 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 import copy
 import uuid
+import random
+import heapq
 from collections import defaultdict
 import itertools
 from exceptions import Exception
 
 import numpy
 
+from spikepy.plotting_utils.plot_operations import apply_operation_states
+
 class OperationError(Exception):
     pass
 
 
+class SchedulerError(Exception):
+    pass
+
+
+SCHEDULING_POLICIES = ['critical_path', 'fifo', 'random']
+
+
 class Operation(object):
     '''
         This class represents nodes in the directed-graph representation
@@ -128,6 +139,32 @@ def find_xputs(operations):
     return xputs
 
 
+def iter_dependencies(xputs):
+    '''
+        Generate the (from, to) dependencies described by <xputs> one at a
+    time (see find_dependencies).  Each dependency is generated only once.
+    Inputs:
+        xputs: the output of the find_xputs() function
+    Returns:
+        a generator of tuples of Operation objects
+    '''
+    for desc in xputs.itervalues():
+        originated_by = desc['originated_by']
+        modified_by = desc['modified_by']
+        finalized_by = desc['finalized_by']
+        if modified_by:
+            for source in originated_by:
+                for target in modified_by:
+                    yield source, target
+            for source in modified_by:
+                for target in finalized_by:
+                    yield source, target
+        else:
+            for source in originated_by:
+                for target in finalized_by:
+                    yield source, target
+
+
 def find_dependencies(xputs):
     '''
         Return a list of (from, to) dependencies meaning that
@@ -137,33 +174,21 @@ def find_dependencies(xputs):
     Returns:
         dependencies: a set of tuples of Operation objects
     '''
-    dependencies = set()
-    for p, desc in xputs.items():
-        dependencies.update(list(itertools.product(desc['originated_by'], 
-                desc['modified_by'])))
-        dependencies.update(list(itertools.product(desc['modified_by'],
-                desc['finalized_by'])))
-        if len(desc['modified_by']) == 0: 
-            dependencies.update(list(itertools.product(desc['originated_by'],
-                    desc['finalized_by'])))
-    return dependencies
+    return set(iter_dependencies(xputs))
 
 
 def point_operations(operations):
     '''
         Create the links of the dependency graph by pointing the operations
     at each other.  The dependencies are determined by calling find_xputs
-    and find_dependencies.
+    and iter_dependencies.
 
     Inputs:
         operations: a set of Operation objects
     Returns:
         None (modifies the Operation objects in <operations>)
     '''
-    xputs = find_xputs(operations)
-    dependencies = find_dependencies(xputs)
-
-    for source, target in dependencies:
+    for source, target in iter_dependencies(find_xputs(operations)):
         source.point_at(target)
 
 
@@ -187,6 +212,42 @@ def find_impossible_operations(operations):
     return impossible_operations 
 
 
+def remove_impossible_xputs(xputs):
+    '''
+        Find the operations that are impossible, either directly (they have
+    inputs that are not originated by any operation) or because they depend
+    on impossible operations.  Uses a worklist of inputs/outputs that have
+    lost their originator, so each operation is visited only once.
+
+    Inputs:
+        xputs: the output of the find_xputs() function
+    Returns:
+        impossible_operations: a set of Operation objects
+    Modifies:
+        <xputs>: the impossible operations are removed from it.
+    '''
+    worklist = [info for info in xputs.itervalues() 
+            if not info['originated_by']]
+    impossible_operations = set()
+    while worklist:
+        info = worklist.pop()
+        for op in itertools.chain(info['modified_by'], info['finalized_by']):
+            if op in impossible_operations:
+                continue
+            impossible_operations.add(op)
+            for p in op.originates:
+                xputs[p]['originated_by'].discard(op)
+                if not xputs[p]['originated_by']:
+                    worklist.append(xputs[p])
+
+    for op in impossible_operations:
+        for p in op.modifies:
+            xputs[p]['modified_by'].discard(op)
+        for p in op.finalizes:
+            xputs[p]['finalized_by'].discard(op)
+    return impossible_operations
+
+
 def clear_impossible_operations(operations):
     '''
         Removes impossible operations and return the set of removed operations.
@@ -196,18 +257,34 @@ def clear_impossible_operations(operations):
         impossible_operations: the list of operations removed from <operations>
                 because they were impossible
     '''
-    impossible_operations = set()
-    while True:
-        tio = find_impossible_operations(operations)
-        impossible_operations.update(tio)
-        if tio:
-            for io in tio:
-                operations.remove(io)
-        else:
-            break
+    impossible_operations = remove_impossible_xputs(find_xputs(operations))
+    for io in impossible_operations:
+        operations.remove(io)
     return impossible_operations 
 
 
+def build_graph(operations):
+    '''
+        Remove the impossible operations from <operations> and point the 
+    rest at each other.  This is the same as calling 
+    clear_impossible_operations and then point_operations, but the inputs 
+    and outputs are only indexed once.
+
+    Inputs:
+        operations: a set of Operation objects
+    Returns:
+        impossible_operations: the set of operations removed from 
+                <operations> because they were impossible
+    '''
+    xputs = find_xputs(operations)
+    impossible_operations = remove_impossible_xputs(xputs)
+    for io in impossible_operations:
+        operations.remove(io)
+    for source, target in iter_dependencies(xputs):
+        source.point_at(target)
+    return impossible_operations
+
+
 def find_ready_operations(operations):
     '''
         Return the set of ready operations.  In order for an
@@ -220,6 +297,59 @@ def find_ready_operations(operations):
     return set([op for op in operations if len(op.is_pointed_at_by) == 0])
 
 
+def find_downstream_operations(operation):
+    '''
+        Return the set of operations that depend (directly or indirectly) on
+    <operation>, following the links made by point_operations.
+    Inputs:
+        operation: an Operation object
+    Returns:
+        downstream: a set of operations (not including <operation>)
+    '''
+    downstream = set()
+    to_visit = list(operation.points_at)
+    while to_visit:
+        op = to_visit.pop()
+        if op not in downstream:
+            downstream.add(op)
+            to_visit.extend(op.points_at)
+    return downstream
+
+
+def find_critical_path_lengths(operations, cost=None):
+    '''
+        Return the length of the longest path from each operation to the
+    end of the graph, including the operation itself.  Operations on the
+    critical path should be run first to minimize the total runtime.
+
+    Inputs:
+        operations: a set or list of (pointed) Operation objects
+        *kwargs*
+        cost: a function that takes an operation and returns the (estimated)
+                time it takes to run.  If None, every operation costs 1.0.
+    Returns:
+        lengths: a dictionary keyed on the operations with the path lengths 
+                as values.
+    '''
+    if cost is None:
+        cost = lambda op: 1.0
+
+    # walk the graph backwards, starting with operations that point nowhere.
+    num_unvisited = dict((op, len(op.points_at)) for op in operations)
+    worklist = [op for op, num in num_unvisited.items() if num == 0]
+    lengths = {}
+    while worklist:
+        op = worklist.pop()
+        longest = max([lengths[other] for other in op.points_at] + [0.0])
+        lengths[op] = cost(op) + longest
+        for other in op.is_pointed_at_by:
+            if other in num_unvisited:
+                num_unvisited[other] -= 1
+                if num_unvisited[other] == 0:
+                    worklist.append(other)
+    return lengths
+
+
 def remove_operations(operations, to_be_removed):
     '''
         Remove a set of operations from the list (or set) of operations 
@@ -336,20 +466,51 @@ class Scheduler(object):
         s.set_root_outputs(<outputs>)
 
         while s.operations:
-            ready_operation = random.choice(s.ready_operations)
-            s.start_operation(ready_operation)
+            ready_operation = s.get_next_operation()
+            while ready_operation is not None:
+                s.start_operation(ready_operation)
+                ready_operation = s.get_next_operation()
 
             finished_operations = some_fn()
             for op in finished_operations:
                 s.finish_operation(op)
+
+    The ready operations are ordered according to the scheduling policy:
+        'critical_path': operations with the longest remaining path through
+                the graph (weighted by <cost>) come first.
+        'fifo': operations come in the order in which they became ready.
+        'random': operations come in random order.
+
+    Ready operations are kept in a priority queue that is updated as 
+    operations finish, so that the cost of starting and finishing an 
+    operation depends only on how many operations directly depend on it, not
+    on the size of the whole graph.  An operation that is ready is still held
+    back while a started operation has any of its inputs or outputs as an
+    output (e.g. two operations that modify the same thing).
     '''
-    def __init__(self):
+    def __init__(self, policy='critical_path', cost=None):
+        '''
+        Inputs:
+            *kwargs*
+            policy: one of SCHEDULING_POLICIES
+            cost: a function that takes an operation and returns the
+                    (estimated) time it takes to run.  Used by the 
+                    'critical_path' policy, if None every operation 
+                    costs 1.0.
+        '''
+        if policy not in SCHEDULING_POLICIES:
+            raise SchedulerError('Unknown scheduling policy "%s", choose from %s' % (policy, SCHEDULING_POLICIES))
+        self.policy = policy
+        self.cost = cost
         self.reset()
 
     def reset(self):
         self._operations = set()
         self._graph = None
-        self._display_graph = None
+        self._graph_operations = None
+        self._plot_layout = None
+        self._layout_index = {} # graph operation -> index in the plot layout
+        self._state_changes = {} # operation -> state, see pop_state_changes
         self._started_operations = set()
         self._finished_operations = set()
         self._impossible_operations = None
@@ -357,12 +518,73 @@ class Scheduler(object):
         self._root_operation = RootOperation([])
         self._originated_outputs = set()
 
+        self._added_order = {}
+        self._priorities = {}
+        self._in_degree = {}    # op -> number of unfinished predecessors
+        self._ready_queue = []  # heap of (sort_key, op)
+        self._ready_keys = {}   # op -> sort_key, for ops that became ready
+        self._num_readied = 0
+        self._busy = defaultdict(int) # xput -> number of started ops making it
+        self._held_back = defaultdict(list) # busy xput -> ready ops
+
+    def _make_ready(self, operation):
+        if self.policy == 'critical_path':
+            key = (-self._priorities.get(operation, 0.0), self._num_readied)
+        elif self.policy == 'fifo':
+            key = (self._num_readied,)
+        else:
+            key = (random.random(),)
+        self._num_readied += 1
+        self._ready_keys[operation] = key
+        heapq.heappush(self._ready_queue, (key, operation))
+
+    def _find_busy_xput(self, operation):
+        '''Return an input or output that is being output right now, or None.'''
+        for xput in itertools.chain(operation.inputs, operation.outputs):
+            if self._busy.get(xput, 0):
+                return xput
+        return None
+
+    def get_next_operation(self):
+        '''
+            Return the ready operation that should be started next according
+        to the scheduling policy, or None if no operation can be started.
+        The operation stays ready until it is passed to start_operation.
+        '''
+        if self._graph is None:
+            self._construct_graph()
+        queue = self._ready_queue
+        while queue:
+            key, op = queue[0]
+            if op in self._started_operations or op not in self._graph:
+                heapq.heappop(queue)
+                continue
+            busy_xput = self._find_busy_xput(op)
+            if busy_xput is not None:
+                heapq.heappop(queue)
+                self._held_back[busy_xput].append(op)
+                continue
+            return op
+        return None
+
     def get_ready_operations(self):
+        '''
+            Return a list of the operations that can be started, in the order
+        they should be started according to the scheduling policy.
+        '''
         if self._graph is None:
             self._construct_graph()
-        potentials = find_ready_operations(self._graph)
-        potentials.difference_update(self._started_operations)
-        return list(potentials)
+        # move any operations that are held back out of the queue first.
+        self.get_next_operation()
+        return [op for key, op in sorted(self._ready_queue)
+                if op not in self._started_operations and op in self._graph
+                and self._find_busy_xput(op) is None]
+
+    def get_downstream_operations(self, operation):
+        '''Return the operations that depend (directly or not) on <operation>.'''
+        if self._graph is None:
+            self._construct_graph()
+        return find_downstream_operations(operation)
 
     @property
     def impossible_operations(self):
@@ -374,26 +596,52 @@ class Scheduler(object):
         
     def start_operation(self, operation):
         self._started_operations.add(operation)
+        self._state_changes[operation] = 'started'
+        for xput in operation.outputs:
+            self._busy[xput] += 1
 
     def finish_operation(self, operation):
+        '''
+            Mark <operation> as finished.  Only the operations that depend on
+        it (and any held back by it) are visited.
+        '''
         self._started_operations.remove(operation)
         self._finished_operations.add(operation)
-        operation.unpoint()
+        self._state_changes[operation] = 'finished'
+        for xput in operation.outputs:
+            self._busy[xput] -= 1
+            if not self._busy[xput]:
+                del self._busy[xput]
+                for op in self._held_back.pop(xput, []):
+                    heapq.heappush(self._ready_queue, 
+                            (self._ready_keys[op], op))
+
+        successors = sorted(operation.points_at, 
+                key=lambda op:self._added_order.get(op, 0))
+        for other in successors:
+            if other in self._in_degree:
+                self._in_degree[other] -= 1
+                if self._in_degree[other] == 0:
+                    self._make_ready(other)
         if operation in self._operations:
             self._operations.remove(operation)
             self._graph.remove(operation)
 
-    def get_plot_dict(self):
+    def get_plot_layout(self):
         '''
-            Return a dictionary that can be used to plot the scheduled 
-        operations.  The dictionary is keyed on the operations and has 
-        dictionaries as the values which describe how the operations and 
-        the links should be plotted.
+            Return a dictionary that can be used to plot the scheduled
+        operations, with every operation in the 'default' state (see 
+        plot_operations.apply_operation_states).  Operations are identified
+        by their index in plot_dict['operation_names'].  The layout is only
+        computed once per graph.
         '''
-        fill_colors = {'started':'cyan', 'finished':'black', 'default':'white'}
-        edge_colors = {'started':'black', 'finished':'cyan', 'default':'black'}
-
-        positions = layout_operations(self._display_graph)
+        if self._graph is None:
+            self._construct_graph()
+        if self._plot_layout is not None:
+            return self._plot_layout
+        display_graph, display_index, graph_index =\
+                copy_operation_set(self._graph_operations)
+        positions = layout_operations(display_graph)
 
         verts = numpy.array([(0.0, 0.0), (1.0, -1.0), (8.0, -1.0), 
                              (9.0, 0.0), (9.0, 3.0), (8.0, 4.0), 
@@ -401,45 +649,84 @@ class Scheduler(object):
         verts -= numpy.average(verts, axis=0)
         verts = [v for v in verts]
 
+        node_index = dict((op, i) for i, op in enumerate(positions.keys()))
         plot_dict = {}
         links = []
+        link_sources = []
         xs = []
         ys = []
-        edgecolors = []
-        facecolors = []
         labels = []
-        for op in positions.keys():
-            graph_op = self._graph_index[op]
-            state = 'default'
-            if graph_op in self._started_operations:
-                state = 'started'
-            if graph_op in self._finished_operations:
-                state = 'finished'
-            color = edge_colors[state]
-            edgecolors.append(color)
-            facecolors.append(fill_colors[state])
+        for op, i in sorted(node_index.items(), key=lambda item:item[1]):
+            self._layout_index[graph_index[op]] = i
             xs.append(positions[op][0])
             ys.append(positions[op][1])
             labels.append((xs[-1], ys[-1], op.name, 
-                    {'color':color, 'zorder':3, 
+                    {'zorder':3, 
                      'horizontalalignment':'center',
                      'verticalalignment':'center'}))
             for other in op.points_at:
                 x = (positions[op][0], positions[other][0])
                 y = (positions[op][1], positions[other][1])
-                kwargs = {'color':color, 'linewidth':1, 'zorder':1}
-                links.append((x, y, kwargs))
+                links.append((x, y, {'linewidth':1, 'zorder':1}))
 
                 mid_x = (numpy.average(x), x[1])
                 mid_y = (numpy.average(y), y[1])
-                kwargs = {'color':color, 'linewidth':3, 'zorder':1}
-                links.append((mid_x, mid_y, kwargs))
+                links.append((mid_x, mid_y, {'linewidth':3, 'zorder':1}))
+                link_sources.extend([i, i])
+        plot_dict['operation_names'] = [label[2] for label in labels]
         plot_dict['link_list'] = links
-        
-        plot_dict['node_info'] = {'xs':xs, 'ys':ys, 'kwargs':{'verts':verts, 'marker':None, 'edgecolors':edgecolors, 'facecolors':facecolors, 's':600, 'zorder':2}}
+        plot_dict['link_sources'] = link_sources
+        plot_dict['node_info'] = {'xs':xs, 'ys':ys, 'kwargs':{'verts':verts, 'marker':None, 's':600, 'zorder':2}}
         plot_dict['label_list'] = labels
-        return plot_dict 
+        self._plot_layout = plot_dict
+        return plot_dict
 
+    def _get_operation_state(self, operation):
+        if operation in self._finished_operations:
+            return 'finished'
+        if operation in self._started_operations:
+            return 'started'
+        return 'default'
+
+    def get_operation_states(self):
+        '''
+            Return a dictionary mapping the index of every operation in the
+        plot layout (see get_plot_layout) that isn't in the 'default' state to
+        its state ('started' or 'finished').
+        '''
+        layout_index = self._layout_index
+        if self._plot_layout is None:
+            self.get_plot_layout()
+        states = {}
+        for op in itertools.chain(self._started_operations, 
+                self._finished_operations):
+            if op in layout_index:
+                states[layout_index[op]] = self._get_operation_state(op)
+        return states
+
+    def pop_state_changes(self):
+        '''
+            Return the states (see get_operation_states) of the operations 
+        that were started or finished since the last call.  Only the latest
+        state of each operation is returned.
+        '''
+        if self._plot_layout is None:
+            self.get_plot_layout()
+        layout_index = self._layout_index
+        changes = {}
+        for op, state in self._state_changes.items():
+            if op in layout_index:
+                changes[layout_index[op]] = state
+        self._state_changes = {}
+        return changes
+
+    def get_plot_dict(self):
+        '''
+            Return a dictionary that can be used to plot the scheduled 
+        operations in their current states.
+        '''
+        return apply_operation_states(self.get_plot_layout(), 
+                self.get_operation_states())
 
     def add_operation(self, new_op):
         # enforce the one-originator rule.
@@ -449,11 +736,12 @@ class Scheduler(object):
 
         self._operations.add(new_op)
         self._originated_outputs.update(new_op.originates)
+        self._added_order[new_op] = len(self._added_order)
 
     def _construct_graph(self):
         '''
             Point the operations at one another according to their
-        dependencies(see point_operations).  This may result in impossible 
+        dependencies(see build_graph).  This may result in impossible 
         operations which are then stored in self._impossible_operations.
         
         Inputs:
@@ -466,17 +754,28 @@ class Scheduler(object):
             self._impossible_operations: see <impossible_ops> above
             self._graph: a subset of self._operations that are included in
                     the dependency graph.
-            self._display_graph: a copy of self._graph but also includes
-                    a copy of the RootOperation. (used for visualization)
+            self._graph_operations: self._graph (without the impossible 
+                    operations) and the RootOperation.  A copy of these is
+                    made for visualization the first time get_plot_layout is
+                    called.
         '''
         self._graph = copy.copy(self._operations)
         operations = self._operations.union(set([self._root_operation]))
 
-        impossible_operations = clear_impossible_operations(operations)
-        point_operations(operations)
+        impossible_operations = build_graph(operations)
+        self._priorities = find_critical_path_lengths(operations, 
+                cost=self.cost)
+
+        self._graph_operations = operations
+        self._plot_layout = None
+        self._layout_index = {}
 
-        self._display_graph, self._display_index, self._graph_index =\
-                copy_operation_set(operations)
+        # operations with no incomming links are ready right away.
+        for op in sorted(self._graph.union(operations), 
+                key=lambda op:self._added_order.get(op, -1)):
+            self._in_degree[op] = len(op.is_pointed_at_by)
+            if op is not self._root_operation and self._in_degree[op] == 0:
+                self._make_ready(op)
         self.start_operation(self._root_operation)
         self.finish_operation(self._root_operation)
 
@@ -0,0 +1,422 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import base64
+import cPickle
+import datetime
+import io
+import json
+import os
+import shutil
+import uuid
+
+import numpy
+
+from spikepy.common.trial_manager import Trial, Resource
+from spikepy.common.strategy import Strategy
+from spikepy.common.resource_store import DeferredData
+from spikepy.common.lazy_traces import LazyTraces, materialize
+from spikepy.common.config_manager import config_manager
+from spikepy.common.block_compression import map_in_threads, compress,\
+        decompress, get_codec_name, get_suffix, find_codec_name
+from spikepy.common.errors import *
+
+MANIFEST_NAME = 'manifest.json'
+BLOCK_DIRECTORY = 'blocks'
+FORMAT_NAME = 'spikepy-session-directory'
+FORMAT_VERSION = 1
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def encode_value(value, add_block):
+    '''
+        Return <value> as something json can write.  Arrays are handed to 
+    <add_block>, which stores them and returns the name of their block.
+    Things json has no type for are tagged with a '__<tag>__' key, anything
+    else is pickled.  Blocks are tagged with their shape and dtype too, so 
+    they are known without reading the block.
+    '''
+    if value is None or isinstance(value, (bool, int, long, float, 
+            basestring)):
+        return value
+    if isinstance(value, numpy.ndarray):
+        if value.dtype == object:
+            return {'__objects__':[encode_value(v, add_block) 
+                    for v in value.ravel()], 'shape':list(value.shape)}
+        return {'__block__':add_block(value), 'shape':list(value.shape),
+                'dtype':value.dtype.str}
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, list):
+        return [encode_value(v, add_block) for v in value]
+    if isinstance(value, tuple):
+        return {'__tuple__':[encode_value(v, add_block) for v in value]}
+    if isinstance(value, dict):
+        keys = value.keys()
+        if all(isinstance(k, basestring) and not k.startswith('__') 
+                for k in keys):
+            return dict((k, encode_value(value[k], add_block)) for k in keys)
+        return {'__dict__':[[encode_value(k, add_block), 
+                encode_value(v, add_block)] for k, v in value.items()]}
+    if isinstance(value, uuid.UUID):
+        return {'__uuid__':str(value)}
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__':value.strftime(DATETIME_FORMAT)}
+    return {'__pickle__':base64.b64encode(cPickle.dumps(value, 
+            cPickle.HIGHEST_PROTOCOL))}
+
+def decode_value(encoded, get_block):
+    '''The inverse of encode_value, <get_block> returns a block's array.'''
+    if isinstance(encoded, list):
+        return [decode_value(v, get_block) for v in encoded]
+    if not isinstance(encoded, dict):
+        return encoded
+    if '__block__' in encoded:
+        return get_block(encoded['__block__'])
+    if '__objects__' in encoded:
+        result = numpy.empty(len(encoded['__objects__']), dtype=object)
+        for i, v in enumerate(encoded['__objects__']):
+            result[i] = decode_value(v, get_block)
+        return result.reshape(encoded['shape'])
+    if '__tuple__' in encoded:
+        return tuple(decode_value(v, get_block) 
+                for v in encoded['__tuple__'])
+    if '__dict__' in encoded:
+        return dict((decode_value(k, get_block), 
+                decode_value(v, get_block)) for k, v in encoded['__dict__'])
+    if '__uuid__' in encoded:
+        return uuid.UUID(encoded['__uuid__'])
+    if '__datetime__' in encoded:
+        return datetime.datetime.strptime(encoded['__datetime__'],
+                DATETIME_FORMAT)
+    if '__pickle__' in encoded:
+        return cPickle.loads(base64.b64decode(encoded['__pickle__']))
+    return dict((str(k), decode_value(v, get_block)) 
+            for k, v in encoded.items())
+
+def has_blocks(encoded):
+    '''Return True if decoding <encoded> would read any files.'''
+    if isinstance(encoded, list):
+        return any(has_blocks(v) for v in encoded)
+    if isinstance(encoded, dict):
+        return True
+    return False
+
+def load_block(directory, block_name):
+    '''
+        Return the array in block <block_name>.  Uncompressed blocks are
+    memory-mapped copy-on-write, so changing them never touches the file.
+    '''
+    fullpath = os.path.join(directory, BLOCK_DIRECTORY, block_name)
+    codec_name = find_codec_name(block_name)
+    if codec_name is None:
+        return numpy.load(fullpath, mmap_mode='c')
+    with open(fullpath, 'rb') as infile:
+        data = decompress(infile.read(), codec_name)
+    return numpy.load(io.BytesIO(data))
+
+def load_blocks(directory, names, num_threads=None):
+    '''
+        Return a dictionary with the arrays of the blocks <names>, they are
+    read (and decompressed) in <num_threads> threads (defaults to 
+    ConfigManager.get_num_workers).
+    '''
+    if num_threads is None:
+        num_threads = config_manager.get_num_workers()
+    arrays = map_in_threads(lambda name:load_block(directory, name), names,
+            num_threads)
+    return dict(zip(names, arrays))
+
+
+class ArchivedData(DeferredData):
+    '''
+        Stands in for the data of a Resource that is stored in the session
+    archive at <directory> (see load_session_archive).  <encoded> is its entry
+    in the manifest.  If that is a single block its shape and dtype are
+    known without loading it (unless it was saved by an older version).
+    '''
+    def __init__(self, directory, encoded):
+        self.directory = directory
+        self.encoded = encoded
+        if (isinstance(encoded, dict) and '__block__' in encoded and 
+                'shape' in encoded):
+            self.shape = tuple(encoded['shape'])
+            self.dtype = numpy.dtype(str(encoded['dtype']))
+
+    def load(self):
+        blocks = load_blocks(self.directory, block_names(self.encoded))
+        return decode_value(self.encoded, blocks.__getitem__)
+
+
+def block_names(encoded):
+    '''Return the names of the blocks that <encoded> refers to.'''
+    if isinstance(encoded, list):
+        result = []
+        for value in encoded:
+            result.extend(block_names(value))
+        return result
+    if isinstance(encoded, dict):
+        if '__block__' in encoded:
+            return [encoded['__block__']]
+        return block_names(encoded.values())
+    return []
+
+def _replace(source, destination):
+    '''Rename <source> to <destination>, replacing it if it exists.'''
+    try:
+        os.rename(source, destination)
+    except OSError:
+        # windows won't rename onto an existing file.
+        os.remove(destination)
+        os.rename(source, destination)
+
+
+class BlockWriter(object):
+    '''
+        Writes arrays as .npy blocks in <directory>, compressed with 
+    <codec_name> at <level> unless <codec_name> is None (see 
+    block_compression).  Blocks are collected with get_adder and then 
+    written, each in a thread of its own, by write.  Each is written to a
+    temporary file first and then renamed, so memory-maps of a block it 
+    replaces keep their data.
+    '''
+    def __init__(self, directory, codec_name=None, level=6):
+        self.directory = directory
+        self.codec_name = codec_name
+        self.level = level
+        self.pending = [] # (block_name, array)
+
+    def get_adder(self, prefix):
+        '''
+            Return a function that adds an array as the next block named 
+        after <prefix>, and returns its name (see encode_value).
+        '''
+        names = []
+        def add_block(array):
+            block_name = '%s-%d.npy%s' % (prefix, len(names), 
+                    get_suffix(self.codec_name))
+            names.append(block_name)
+            self.pending.append((block_name, array))
+            return block_name
+        return add_block
+
+    def _write_block(self, pending_block):
+        block_name, array = pending_block
+        fullpath = os.path.join(self.directory, block_name)
+        with open(fullpath + '.partial', 'wb') as ofile:
+            if self.codec_name is None:
+                numpy.save(ofile, array)
+            else:
+                npy_file = io.BytesIO()
+                numpy.save(npy_file, array)
+                ofile.write(compress(npy_file.getvalue(), self.codec_name,
+                        self.level))
+        _replace(fullpath + '.partial', fullpath)
+
+    def write(self, num_threads):
+        map_in_threads(self._write_block, self.pending, num_threads)
+        self.pending = []
+
+
+def reuse_blocks(encoded, source_path, fullpath):
+    '''
+        Make the blocks that <encoded> refers to in the archive at 
+    <source_path> part of the archive at <fullpath>, hard-linking them (or 
+    copying them, across devices) if the archives differ.  Returns False if
+    that isn't possible.
+    '''
+    names = block_names(encoded)
+    for name in names:
+        source = os.path.join(source_path, BLOCK_DIRECTORY, name)
+        destination = os.path.join(fullpath, BLOCK_DIRECTORY, name)
+        if not os.path.exists(source):
+            return False
+        if os.path.exists(destination):
+            if not os.path.samefile(source, destination):
+                return False
+            continue
+        try:
+            os.link(source, destination)
+        except (OSError, AttributeError): # AttributeError: no os.link
+            shutil.copyfile(source, destination)
+    return True
+
+def _read_previous_entries(fullpath):
+    '''
+        Return the resource entries of the archive at <fullpath> (if there
+    is one) keyed on (trial id, resource name).
+    '''
+    try:
+        manifest = read_manifest(fullpath)
+    except (IOError, ValueError, FileInterpretationError):
+        return {}
+    result = {}
+    for trial_entry in manifest['trials']:
+        for resource_entry in trial_entry['resources']:
+            result[(trial_entry['id'], resource_entry['name'])] = \
+                    resource_entry
+    return result
+
+def _is_compressed_with(encoded, codec_name):
+    for name in block_names(encoded):
+        if find_codec_name(name) != codec_name:
+            return False
+    return True
+
+def _encode_data(resource, trial_id, previous_entries, fullpath, 
+        block_writer, traces_by_reference=False):
+    '''
+        Return the manifest entry for the data of <resource>.  Only data that
+    changed since it was last saved or loaded (or that was compressed 
+    differently) is written, other data refers to the blocks that already 
+    hold it.  LazyTraces are read and written as a block, unless 
+    <traces_by_reference> is True.
+    '''
+    change_id = str(resource.change_id)
+    codec_name = block_writer.codec_name
+    previous_entry = previous_entries.get((trial_id, resource.name))
+    # traces saved by reference before have no blocks, they're read now.
+    must_read = (isinstance(resource._data, LazyTraces) and 
+            not traces_by_reference)
+    if (previous_entry is not None and 
+            previous_entry.get('change_id') == change_id and
+            not (must_read and not block_names(previous_entry['data'])) and
+            _is_compressed_with(previous_entry['data'], codec_name) and
+            reuse_blocks(previous_entry['data'], fullpath, fullpath)):
+        return previous_entry['data']
+    archived_data = resource._data
+    if (isinstance(archived_data, ArchivedData) and 
+            _is_compressed_with(archived_data.encoded, codec_name) and
+            reuse_blocks(archived_data.encoded, archived_data.directory, 
+                fullpath)):
+        return archived_data.encoded
+
+    add_block = block_writer.get_adder('%s-%s-%s' % (trial_id, change_id, 
+            resource.name))
+    data = resource.data
+    if not traces_by_reference:
+        data = materialize(data)
+    return encode_value(data, add_block)
+
+def save_session_archive(fullpath, trials, strategy, compression='none', 
+        level=6, num_threads=1, traces_by_reference=False):
+    '''
+        Save the <trials> and <strategy> as a session archive: a directory
+    at <fullpath> holding a json manifest and a .npy block for every array.
+    Blocks are compressed with <compression> ('none', 'zlib', 'lz4' or 
+    'zstd') at <level> (1 is fastest, 9 smallest) in <num_threads> threads.
+    Uncompressed blocks can be memory-mapped, so load_session_archive only
+    has to read the manifest.  Traces that are still in the file they were
+    opened from (see LazyTraces) are read and saved too, unless 
+    <traces_by_reference> is True.  Then only their filename is saved and
+    that file has to stay where it is.
+        Saving is incremental.  Blocks are named after the change_id of 
+    their resource, and those whose change_id is the same as when they were
+    last saved (or loaded, from another archive) are kept or hard-linked 
+    rather than written again.  The manifest is replaced in one rename, so
+    the archive is never left half-saved, and blocks it no longer refers to
+    are then removed.
+    '''
+    fullpath = os.path.abspath(fullpath)
+    block_path = os.path.join(fullpath, BLOCK_DIRECTORY)
+    if not os.path.exists(block_path):
+        os.makedirs(block_path)
+    previous_entries = _read_previous_entries(fullpath)
+    block_writer = BlockWriter(block_path, get_codec_name(compression), 
+            level)
+
+    trial_entries = []
+    for trial in trials:
+        trial_id = str(trial.trial_id)
+        resource_entries = []
+        for resource in trial.resources:
+            change_id = str(resource.change_id)
+            add_block = block_writer.get_adder('%s-%s-%s-info' % 
+                    (trial_id, change_id, resource.name))
+            resource_entries.append({'name':resource.name,
+                    'change_id':change_id,
+                    'change_info':encode_value(resource.change_info, 
+                        add_block),
+                    'data':_encode_data(resource, trial_id, 
+                        previous_entries, fullpath, block_writer,
+                        traces_by_reference)})
+        trial_entries.append({'id':trial_id,
+                'display_name':trial.display_name, 
+                'origin':trial.origin,
+                'resources':resource_entries})
+    manifest = {'format':FORMAT_NAME, 'version':FORMAT_VERSION,
+            'strategy':strategy.as_dict, 'trials':trial_entries}
+    block_writer.write(num_threads)
+
+    manifest_path = os.path.join(fullpath, MANIFEST_NAME)
+    with open(manifest_path + '.partial', 'w') as ofile:
+        json.dump(manifest, ofile, indent=1)
+        ofile.flush()
+        os.fsync(ofile.fileno())
+    _replace(manifest_path + '.partial', manifest_path)
+
+    # remove the blocks (and leftovers of failed saves) no longer needed.
+    referenced = set(block_names(manifest['trials']))
+    for name in os.listdir(block_path):
+        if name not in referenced:
+            os.remove(os.path.join(block_path, name))
+    return fullpath
+
+def read_manifest(fullpath):
+    '''Return the manifest of the session archive at <fullpath>.'''
+    with open(os.path.join(fullpath, MANIFEST_NAME), 'r') as infile:
+        manifest = json.load(infile)
+    if manifest.get('format') != FORMAT_NAME:
+        raise FileInterpretationError('%s is not a spikepy session archive.' 
+                % fullpath)
+    if manifest.get('version', 0) > FORMAT_VERSION:
+        raise FileInterpretationError('%s was saved by a newer version of spikepy (format version %s).' % (fullpath, manifest['version']))
+    return manifest
+
+def load_session_archive(fullpath, preload=False):
+    '''
+        Return the trials and strategy saved in the session archive at 
+    <fullpath> (see save_session_archive).  Only the manifest is read, the 
+    data of each resource is loaded the first time it is asked for, unless
+    <preload> is True.  Then all the blocks are read (and decompressed) 
+    right away, in as many threads as there are workers.
+    '''
+    fullpath = os.path.abspath(fullpath)
+    manifest = read_manifest(fullpath)
+    if preload:
+        blocks = load_blocks(fullpath, block_names(manifest['trials']))
+        get_block = blocks.__getitem__
+    else:
+        get_block = lambda name:load_block(fullpath, name)
+
+    results = []
+    for trial_entry in manifest['trials']:
+        trial = Trial(origin=trial_entry['origin'], 
+                display_name=trial_entry['display_name'])
+        trial._id = uuid.UUID(trial_entry['id'])
+        for resource_entry in trial_entry['resources']:
+            encoded = resource_entry['data']
+            if has_blocks(encoded) and not preload:
+                data = ArchivedData(fullpath, encoded)
+            else:
+                data = decode_value(encoded, get_block)
+            resource = Resource(str(resource_entry['name']), data=data)
+            resource._change_info = decode_value(
+                    resource_entry['change_info'], get_block)
+            trial.add_resource(resource)
+        results.append(trial)
+    results.append(Strategy.from_dict(manifest['strategy']))
+    return results
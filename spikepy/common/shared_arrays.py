@@ -0,0 +1,146 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import tempfile
+import uuid
+
+import numpy
+
+def get_shared_memory_dir():
+    '''
+        Return the directory where shared arrays are stored.  /dev/shm is
+    used if it is available (so the arrays never touch the disk), otherwise
+    the system's temporary directory is used.
+    '''
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+
+class SharedArray(object):
+    '''
+        A small, picklable descriptor of a numpy array that lives in a
+    memory-mapped file.  Only this descriptor needs to be sent between
+    processes, the data itself is never pickled.
+    '''
+    def __init__(self, filename, dtype, shape):
+        self.filename = filename
+        self.dtype = numpy.dtype(dtype)
+        self.shape = tuple(shape)
+
+    @property
+    def nbytes(self):
+        return int(numpy.prod(self.shape))*self.dtype.itemsize
+
+    @classmethod
+    def from_array(cls, array):
+        '''Copy <array> into a new shared segment and return its descriptor.'''
+        filename = os.path.join(get_shared_memory_dir(),
+                'spikepy_%s.shm' % uuid.uuid4().hex)
+        shared = cls(filename, array.dtype, array.shape)
+        if shared.nbytes == 0:
+            # numpy can't memory-map an empty file.
+            open(filename, 'wb').close()
+            return shared
+        mapped = numpy.memmap(filename, dtype=shared.dtype, mode='w+',
+                shape=shared.shape)
+        mapped[...] = array
+        mapped.flush()
+        del mapped
+        return shared
+
+    def attach(self, mode='r'):
+        '''
+            Return a numpy array backed by the shared segment.  The default
+        mode ('r') gives a read-only view.
+        '''
+        if self.nbytes == 0:
+            return numpy.empty(self.shape, dtype=self.dtype)
+        return numpy.memmap(self.filename, dtype=self.dtype, mode=mode,
+                shape=self.shape)
+
+    def adopt(self):
+        '''
+            Return the data as an array that no longer depends on the
+        shared segment, and remove the segment.  Where the platform allows a
+        mapped file to be removed the mapping is kept (copy-on-write), so no 
+        copy is made.
+        '''
+        if os.name == 'posix':
+            result = self.attach(mode='c').view(numpy.ndarray)
+        else:
+            result = numpy.array(self.attach(mode='r'))
+        self.unlink()
+        return result
+
+    def unlink(self):
+        '''Remove the shared segment.'''
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+    def __repr__(self):
+        return 'SharedArray(%s, %s, %s)' % (self.filename, self.dtype,
+                str(self.shape))
+
+
+def share_arrays(value, threshold):
+    '''
+        Return a copy of <value> where every numpy array with at least
+    <threshold> bytes has been moved into shared memory and replaced by a
+    SharedArray.  Lists and tuples are searched recursively, anything else is
+    returned unchanged (and will be pickled as usual).
+    '''
+    if isinstance(value, numpy.ndarray):
+        if value.dtype != object and value.nbytes >= threshold:
+            return SharedArray.from_array(value)
+        return value
+    if isinstance(value, (list, tuple)):
+        return type(value)([share_arrays(v, threshold) for v in value])
+    return value
+
+def attach_arrays(value, mode='r'):
+    '''Inverse of share_arrays, returns views on the shared segments.'''
+    if isinstance(value, SharedArray):
+        return value.attach(mode=mode)
+    if isinstance(value, (list, tuple)):
+        return type(value)([attach_arrays(v, mode=mode) for v in value])
+    return value
+
+def adopt_arrays(value):
+    '''Like attach_arrays, but the shared segments are adopted and removed.'''
+    if isinstance(value, SharedArray):
+        return value.adopt()
+    if isinstance(value, (list, tuple)):
+        return type(value)([adopt_arrays(v) for v in value])
+    return value
+
+def find_shared_arrays(value):
+    '''Return a list of all the SharedArrays found in <value>.'''
+    if isinstance(value, SharedArray):
+        return [value]
+    result = []
+    if isinstance(value, (list, tuple)):
+        for v in value:
+            result.extend(find_shared_arrays(v))
+    return result
+
+def unlink_arrays(value):
+    '''Remove all the shared segments found in <value>.'''
+    for shared in find_shared_arrays(value):
+        shared.unlink()
@@ -17,20 +17,209 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import datetime
 import copy
 import uuid
+import hashlib
+
+from collections import defaultdict
 
 import numpy
 
-from spikepy.common.scheduler import Scheduler, Operation
+from spikepy.common.scheduler import Scheduler, Operation, point_operations
+from spikepy.common.memory_estimates import MemoryEstimates, get_input_bytes
+from spikepy.common.resource_store import resource_store, SpilledData,\
+        DeferredData
+
+def change_info_list(resource):
+    '''Return the change_info of <resource> as a list of dicts.'''
+    change_info = resource.change_info
+    if isinstance(change_info, dict):
+        return [change_info]
+    return change_info
+
+def share_data(data):
+    '''
+        Return <data> in a form that can be given to a second resource
+    without copying it (a read-only view for numpy arrays).
+    '''
+    if isinstance(data, numpy.ndarray):
+        data = data.view()
+        data.flags.writeable = False
+    return data
+
+def _flatten_using(using):
+    if using is None:
+        return None
+    return set([tuple(item) for sublist in using for item in sublist])
+
+def change_info_matches(old_change_info, new_change_info):
+    '''
+        Return True if the two change_info dictionaries describe the same
+    change.  That is, they were made by the same plugin with the same kwargs
+    using the same resources, as they were when they had the same 
+    change_ids.  ('at' and 'change_id' are ignored)
+    '''
+    if old_change_info['by'] != new_change_info['by']:
+        return False
+    if old_change_info['with'] != new_change_info['with']:
+        return False
+    if (old_change_info.get('using_change_ids') != 
+            new_change_info.get('using_change_ids')):
+        return False
+    return (_flatten_using(old_change_info['using']) == 
+            _flatten_using(new_change_info['using']))
+
+def resource_is_current(resource, providing_tasks):
+    '''
+        Return True if <resource> holds the result of running exactly the
+    <providing_tasks> (with their current settings).
+    '''
+    # not resource.data, which would load deferred (saved or spilled) data.
+    if resource._data is None:
+        return False
+    old_change_infos = change_info_list(resource)
+    if len(old_change_infos) != len(providing_tasks):
+        return False
+    for task in providing_tasks:
+        new_change_info = task.change_info
+        checks = [change_info_matches(oci, new_change_info)
+                for oci in old_change_infos]
+        if True not in checks:
+            return False
+    return True
+
+def find_stale_tasks(tasks):
+    '''
+        Return the tasks (in the order given) that need to be run because
+    the resources they provide are out of date.  A task is stale if any 
+    resource it provides doesn't match the provenance it would produce, or if
+    any task that provides a resource it requires (or also provides) is stale.
+    '''
+    resources = {}
+    providers = defaultdict(list)
+    consumers = defaultdict(list)
+    for task in tasks:
+        for resource in task.provides:
+            resources[resource.id] = resource
+            providers[resource.id].append(task)
+        for resource in task.requires:
+            consumers[resource.id].append(task)
+
+    stale = set()
+    for resource_id, providing_tasks in providers.items():
+        if not resource_is_current(resources[resource_id], providing_tasks):
+            stale.update(providing_tasks)
+
+    # everything downstream of a stale task is stale too, and so are the
+    #   other tasks that provide the same resources (a modification can only
+    #   be redone by also redoing what it modified).
+    worklist = list(stale)
+    while worklist:
+        task = worklist.pop()
+        for resource in task.provides:
+            for other in providers[resource.id] + consumers[resource.id]:
+                if other not in stale:
+                    stale.add(other)
+                    worklist.append(other)
+    return [task for task in tasks if task in stale]
+
+def fuse_tasks(tasks):
+    '''
+        Return a list of tasks where the non-pooling tasks of each trial have
+    been merged into FusedTasks, so that each chain runs in a single worker
+    without sending intermediate results back and forth.  Tasks that come 
+    after a pooling task are only fused with tasks that also come after it,
+    so the merged tasks never depend on each other in a cycle.  Alias tasks
+    (see Task.is_alias) are left alone and treated the same way, since they
+    are completed without a worker.
+    '''
+    operations = []
+    operation_index = {}
+    for task in tasks:
+        operation = Operation(task.required_ids, task.provided_ids, 
+                name=task.task_id)
+        operations.append(operation)
+        operation_index[operation] = task
+    point_operations(operations)
+
+    # visit in dependency order, counting the pooling (and alias) tasks
+    #   upstream.
+    num_pooled_before = {}
+    num_waiting = dict((op, len(op.is_pointed_at_by)) for op in operations)
+    worklist = [op for op in operations if num_waiting[op] == 0]
+    worklist.reverse()
+    groups = defaultdict(list)
+    group_order = []
+    result = []
+    while worklist:
+        op = worklist.pop()
+        task = operation_index[op]
+        num_pooled_before[op] = max([num_pooled_before[other] + 
+                int(operation_index[other].plugin.is_pooling or
+                    operation_index[other].is_alias)
+                for other in op.is_pointed_at_by] + [0])
+        if (task.plugin.is_pooling or task.is_alias or 
+                len(task.trials) != 1):
+            result.append(task)
+        else:
+            group_key = (task.trials[0].trial_id, num_pooled_before[op])
+            if group_key not in groups:
+                group_order.append(group_key)
+            groups[group_key].append(task)
+        for other in op.points_at:
+            num_waiting[other] -= 1
+            if num_waiting[other] == 0:
+                worklist.append(other)
+
+    for group_key in group_order:
+        group = groups[group_key]
+        if len(group) == 1:
+            result.append(group[0])
+        else:
+            result.append(FusedTask(group))
+    return result
 
 class TaskManager(object):
     '''
         Manages a number of Tasks and allows you to get the ones
     ready to be run.
     '''
-    def __init__(self):
-        self._scheduler = Scheduler()
+    def __init__(self, policy='critical_path', runtime_estimates=None,
+            memory_estimates=None, memory_budget=None):
+        '''
+        Inputs:
+            *kwargs*
+            policy: The scheduling policy that determines the order of
+                    the ready tasks (see scheduler.SCHEDULING_POLICIES).
+            runtime_estimates: A RuntimeEstimates object, used to weight
+                    the tasks when the policy is 'critical_path'.  If None,
+                    every task is assumed to take the same time per trial.
+            memory_estimates: A MemoryEstimates object, used to estimate
+                    how much memory each task needs.  If None, every plugin
+                    is assumed to need MemoryEstimates.default_multiplier
+                    times the size of its inputs.
+            memory_budget: The most memory (in bytes) the checked out 
+                    tasks may need together (see get_next_task), or None
+                    for no limit.
+        '''
+        self._scheduler = Scheduler(policy=policy, cost=self._operation_cost)
         self._task_to_operation_index = {}
         self._operation_name_to_task_index = {}
+        self._num_named = defaultdict(lambda:1) # operation name prefix -> num
+        self.runtime_estimates = runtime_estimates
+        if memory_estimates is None:
+            memory_estimates = MemoryEstimates()
+        self.memory_estimates = memory_estimates
+        self.memory_budget = memory_budget
+        self._admitted_memory = {} # checked out task -> estimated bytes
+        self._input_bytes = {} # task -> bytes of input, see get_input_bytes
+
+    def _operation_cost(self, operation):
+        if operation.name not in self._operation_name_to_task_index:
+            return 0.0 # the root operation
+        task = self._operation_name_to_task_index[operation.name]
+        if self.runtime_estimates is None:
+            return float(len(task.steps)*len(task.trials))
+        return sum([self.runtime_estimates.estimate(step.plugin.name, 
+                len(step.trials)) for step in task.steps])
 
     @property
     def tasks(self):
@@ -38,14 +227,35 @@ class TaskManager(object):
 
     @property
     def num_tasks(self):
-        return len(self.tasks)
+        return len(self._task_to_operation_index)
 
     def remove_all_tasks(self):
         self._task_to_operation_index = {}
         self._operation_name_to_task_index = {}
+        self._input_bytes = {}
+
+    def remove_dependent_tasks(self, task):
+        '''
+            Remove the tasks that depend (directly or indirectly) on <task>
+        and return them.  Used to cancel the work that can't be done because
+        <task> failed, without touching the tasks of other trials.
+        '''
+        if task not in self._task_to_operation_index:
+            raise TaskError('Task not under management: %s' % 
+                    str(task))
+        operation = self._task_to_operation_index[task]
+        removed_tasks = []
+        for op in self._scheduler.get_downstream_operations(operation):
+            if op.name in self._operation_name_to_task_index:
+                removed_task = self._operation_name_to_task_index[op.name]
+                self.remove_task(removed_task)
+                removed_tasks.append(removed_task)
+        return removed_tasks
 
     def remove_task(self, task):
-        if task in self._task_to_operation_index.keys():
+        self._admitted_memory.pop(task, None)
+        self._input_bytes.pop(task, None)
+        if task in self._task_to_operation_index:
             operation = self._task_to_operation_index[task]
             del self._operation_name_to_task_index[operation.name]
             del self._task_to_operation_index[task]
@@ -66,12 +276,11 @@ class TaskManager(object):
         # 3. add task and operation to indecies
 
         # find a unique name for this operation.
-        operation_name = new_task.plugin.name[:1] # TODO make shorter 
-        if operation_name in self._operation_name_to_task_index.keys():
-            operation_name += '_2'
-        while operation_name in self._operation_name_to_task_index.keys():
-            num = int(operation_name.split('_')[-1])
-            operation_name = operation_name.replace('_%d' % num, '_%d' % (num+1))
+        prefix = new_task.name[:1] # TODO make shorter 
+        operation_name = prefix
+        while operation_name in self._operation_name_to_task_index:
+            self._num_named[prefix] += 1
+            operation_name = '%s_%d' % (prefix, self._num_named[prefix])
             
         operation = Operation(new_task.required_ids, new_task.provided_ids,
                 name=operation_name)
@@ -82,32 +291,87 @@ class TaskManager(object):
     
     def get_ready_tasks(self):
         '''
-            Return a list of runnable tasks. 
+            Return a list of runnable tasks, ordered so that the task that
+        should be run first (according to the scheduling policy) is first.
         '''
         potentials = self._scheduler.get_ready_operations()
+        return [self._operation_name_to_task_index[op.name] 
+                for op in potentials
+                if op.name in self._operation_name_to_task_index]
+
+    @property
+    def admitted_memory(self):
+        '''The estimated memory (in bytes) the checked out tasks need.'''
+        return sum(self._admitted_memory.values())
+
+    def get_input_bytes(self, task):
+        '''
+            Return the size (in bytes) of the resources <task> requires.  It
+        is measured once, the first time the task is ready, since measuring
+        may mean pickling (or loading) the data.
+        '''
+        if task not in self._input_bytes:
+            self._input_bytes[task] = get_input_bytes(task)
+        return self._input_bytes[task]
 
-        ready_tasks = []
-        for op in potentials:
-            task = self._operation_name_to_task_index[op.name]
-            if task.is_ready:
-                ready_tasks.append(task)
+    def estimate_memory(self, task):
+        '''Return the estimated memory (in bytes) <task> needs.'''
+        return self.memory_estimates.estimate_task(task, 
+                self.get_input_bytes(task))
 
-        return ready_tasks 
+    def _fits_in_memory(self, task):
+        if self.memory_budget is None or not self._admitted_memory:
+            return True # at least one task is admitted, however big.
+        return (self.admitted_memory + self.estimate_memory(task) <= 
+                self.memory_budget)
+
+    def get_next_task(self):
+        '''
+            Return the task that should be run next, or None if no task is
+        ready to be run.  The scheduler keeps track of which tasks have become
+        ready (and holds back tasks whose resources are locked by running
+        tasks), so this doesn't depend on the number of tasks under 
+        management.
+            If there is a memory budget, None is also returned while the
+        next task would take the estimated memory of the checked out tasks
+        over it.  The task is returned once enough of them are completed (or
+        when none are checked out) so the run always makes progress.
+        '''
+        while True:
+            operation = self._scheduler.get_next_operation()
+            if operation is None:
+                return None
+            if operation.name in self._operation_name_to_task_index:
+                task = self._operation_name_to_task_index[operation.name]
+                if not self._fits_in_memory(task):
+                    return None
+                return task
+            # the task was removed (see remove_all_tasks), drop it.
+            self._scheduler.start_operation(operation)
+            self._scheduler.finish_operation(operation)
 
     def get_plot_dict(self):
         return self._scheduler.get_plot_dict()
 
+    def get_plot_layout(self):
+        return self._scheduler.get_plot_layout()
+
+    def pop_state_changes(self):
+        return self._scheduler.pop_state_changes()
+
     def checkout_task(self, task):
-        if task not in self.tasks:
+        if task not in self._task_to_operation_index:
             raise TaskError('Task not under management: %s' % 
                     str(task))
         else:
             operation = self._task_to_operation_index[task]
             self._scheduler.start_operation(operation)
+            if self.memory_budget is not None:
+                self._admitted_memory[task] = self.estimate_memory(task)
             return task.checkout()
 
     def complete_task(self, task, result=None):
-        if task not in self.tasks:
+        if task not in self._task_to_operation_index:
             raise TaskError('Task not under management: %s' % 
                     str(task))
         else:
@@ -165,6 +429,36 @@ class StageRootTask(object):
         return [r.id for r in self.provides]
 
 
+class IncrementalRootTask(object):
+    '''
+        Root for a pruned set of tasks (see find_stale_tasks).  It provides
+    every resource the tasks require that none of them originate, so the
+    dependency graph starts at the first stale resources.
+    '''
+    def __init__(self, tasks):
+        self.tasks = tasks
+
+    @property
+    def provides(self):
+        originated_ids = set()
+        for task in self.tasks:
+            required_ids = set(task.required_ids)
+            for resource in task.provides:
+                if resource.id not in required_ids:
+                    originated_ids.add(resource.id)
+
+        result = {}
+        for task in self.tasks:
+            for resource in task.requires:
+                if resource.id not in originated_ids:
+                    result[resource.id] = resource
+        return result.values()
+
+    @property
+    def provided_ids(self):
+        return [r.id for r in self.provides]
+
+
 class RootTask(object):
     def __init__(self, trials):
         self.trials = trials
@@ -187,6 +481,8 @@ class Task(object):
         Task objects combine a list of trials with a plugin and
     the kwargs that the plugin needs to run.
     '''
+    job_kind = 'task' # how the worker_pool runs it.
+
     def __init__(self, trials, plugin, plugin_category, plugin_kwargs={}):
         self.trials = trials
         trial_ids = [t.trial_id for t in trials]
@@ -195,6 +491,7 @@ class Task(object):
         self.plugin_category = plugin_category
         self.plugin_kwargs = plugin_kwargs
         self.locking_keys = {}
+        self.change_ids = {} # resource id -> change_id, decided at checkout.
         self._prepare_trials_for_task()
         self.trial_packing_index = {}
 
@@ -204,6 +501,15 @@ class Task(object):
             str_list.append('        trial="%s"' % trial.display_name)
         return '\n'.join(str_list)
 
+    @property
+    def name(self):
+        return self.plugin.name
+
+    @property
+    def steps(self):
+        '''The tasks that are run when this task is run (see FusedTask).'''
+        return [self]
+
     @property
     def provides(self):
         '''Return the Resource(s) this task provides after running.'''
@@ -230,6 +536,31 @@ class Task(object):
     def required_ids(self):
         return [r.id for r in self.requires]
 
+    @property
+    def is_alias(self):
+        '''
+            Return True if each resource this task provides is just one of 
+        the resources it requires (see SpikepyMethod.aliases), so the task can
+        be completed without running the plugin (see alias_result).
+        '''
+        aliases = getattr(self.plugin, 'aliases', None)
+        if aliases is None or self.plugin.is_pooling:
+            return False
+        return (len(aliases) == len(self.plugin.provides) and 
+                None not in aliases)
+
+    def alias_result(self):
+        '''
+            Return the result running the plugin would give, for a task that
+        is_alias.  Arrays are shared with the resources they alias as
+        read-only views, so neither resource can change the other's data in
+        place.  Checking in new data replaces the view, leaving the other 
+        resource as it was (copy-on-write).
+        '''
+        trial = self.trials[0]
+        return [share_data(getattr(trial, alias).data) 
+                for alias in self.plugin.aliases]
+
     def _prepare_trials_for_task(self):
         '''
             If the trials do not have any of the Resources that the plugin
@@ -250,27 +581,83 @@ class Task(object):
         '''
         if self.plugin.is_stochastic:
             return True
-        else:
-            old_results = self.provides
-            new_change_info = self.change_info
-            for old_result in old_results:
-                for old_change_info in old_result.change_info:
-                    checks = [change_info_matches(oci, new_change_info) 
-                            for oci in old_result.change_info]
-                    if True not in checks:
-                        return True
+        new_change_info = self.change_info
+        for old_result in self.provides:
+            checks = [change_info_matches(oci, new_change_info) 
+                    for oci in change_info_list(old_result)]
+            if True not in checks:
+                return True
         return False
 
+    @property
+    def cache_key(self):
+        '''
+            Return a string identifying the results of this task.  It is a
+        hash of the plugin name, its kwargs, the trials and the change_ids of 
+        the resources the task requires.  Returns None for stochastic plugins,
+        since their results cannot be reused.
+        '''
+        return self.get_cache_key()
+
+    def predict_change_ids(self, change_ids={}):
+        '''
+            Return the change_ids (keyed on resource id) the resources this 
+        task provides will get, once the resources it requires have the 
+        <change_ids> given (see get_cache_key).  Deterministic tasks always 
+        give the same change_ids for the same inputs and settings, so results
+        downstream of this task can be found in a cache too.  Each resource 
+        gets a change_id of its own, the trials of a pooling task don't share
+        one.
+        '''
+        cache_key = self.get_cache_key(change_ids)
+        result = {}
+        for trial in self.trials:
+            for resource_name in self.plugin.provides:
+                resource = getattr(trial, resource_name)
+                if cache_key is None:
+                    result[resource.id] = uuid.uuid4()
+                else:
+                    result[resource.id] = uuid.uuid5(uuid.NAMESPACE_OID, 
+                            '%s-%s-%s' % (cache_key, trial.trial_id, 
+                            resource_name))
+        return result
+
+    def get_cache_key(self, change_ids={}):
+        '''
+            Return the cache_key this task will have once the resources it 
+        requires have the <change_ids> given (a dictionary keyed on resource 
+        id).  Resources not in <change_ids> use their current change_id.
+        '''
+        if self.plugin.is_stochastic:
+            return None
+        key_hash = hashlib.sha1()
+        key_hash.update(repr((self.plugin.name, list(self.plugin.provides),
+                sorted(self.plugin_kwargs.items()),
+                [str(trial.trial_id) for trial in self.trials])))
+        for resource in self.requires:
+            key_hash.update(str(change_ids.get(resource.id, 
+                    resource.change_id)))
+        return key_hash.hexdigest()
+
     @property
     def change_info(self):
         return_dict = {}
         return_dict['by'] = self.plugin.name
         return_dict['with'] = self.plugin_kwargs
         u = []
+        c = []
         for rname in self.plugin.requires:
             pu = [(trial.trial_id, rname) for trial in self.trials]
             u.append(pu)
+            # a resource this task modifies only changes when an earlier
+            #   task that provides it does (see find_stale_tasks).
+            if rname in self.plugin.provides:
+                c.append(None)
+            else:
+                c.append([getattr(trial, rname).change_id 
+                        for trial in self.trials])
         return_dict['using'] = u
+        return_dict['using_change_ids'] = c
         return return_dict
 
     @property
@@ -298,6 +685,8 @@ class Task(object):
         appropriate resources as well as update the data-provenance.
         '''
         change_info = self.change_info
+        if not self.change_ids:
+            self.change_ids = self.predict_change_ids()
         for pname, presult in zip(self.plugin.provides, result):
             # unpack/unpool the results (if needed)
             if self.plugin.is_pooling: 
@@ -320,7 +709,8 @@ class Task(object):
                 preserve_provenance = pname in self.plugin.requires and\
                                       pname in self.plugin.provides
                 data_dict = {'data':tresult,
-                             'change_info':change_info}
+                             'change_info':dict(change_info, 
+                                     change_id=self.change_ids[item.id])}
                 item.checkin(data_dict, key=key, 
                         preserve_provenance=preserve_provenance) 
 
@@ -335,6 +725,17 @@ class Task(object):
         run_info['args'] = self._get_args()
         run_info['kwargs'] = self.plugin_kwargs
 
+        # identify the arguments and results, so workers can cache them.
+        self.change_ids = self.predict_change_ids()
+        if self.plugin.is_pooling:
+            run_info['arg_keys'] = None
+            run_info['result_keys'] = None
+        else:
+            run_info['arg_keys'] = [(r.id, r.change_id) 
+                    for r in self.requires]
+            run_info['result_keys'] = [(r.id, self.change_ids[r.id])
+                    for r in self.provides]
+
         # check out and keep track of locking keys for what task provides.
         for item in self.provides:
             co = item.checkout()
@@ -432,6 +833,158 @@ class Task(object):
         return results
 
 
+class FusedTask(object):
+    '''
+        A chain of non-pooling tasks on a single trial that is run as one job
+    by a single worker (see fuse_tasks).  The results of each step stay in the
+    worker, only the final value of each resource the steps provide is sent
+    back.  The steps are completed in order, so the resources end up with the
+    same data and provenance as if they had been run one by one.
+    '''
+    job_kind = 'fused_task'
+    is_alias = False
+
+    def __init__(self, tasks):
+        '''
+        Inputs:
+            tasks: a list of Task objects (all on the same single trial) in
+                    the order they should be run.
+        '''
+        self.tasks = tasks
+        self.trials = tasks[0].trials
+        self.task_id = uuid.uuid4()
+
+    def __str__(self):
+        str_list = ['Task: plugins="%s"' % 
+                ', '.join([task.plugin.name for task in self.tasks])]
+        for trial in self.trials:
+            str_list.append('        trial="%s"' % trial.display_name)
+        return '\n'.join(str_list)
+
+    @property
+    def name(self):
+        return 'Fused %s' % '+'.join([task.plugin.name for task in self.tasks])
+
+    @property
+    def steps(self):
+        return self.tasks
+
+    @property
+    def provides(self):
+        '''Return the Resource(s) provided by any of the steps.'''
+        result = {}
+        for task in self.tasks:
+            for resource in task.provides:
+                result[resource.id] = resource
+        return result.values()
+
+    @property
+    def provided_ids(self):
+        return [r.id for r in self.provides]
+
+    @property
+    def requires(self):
+        '''
+            Return the Resource(s) the steps require that aren't provided by
+        an earlier step.
+        '''
+        result = {}
+        provided_ids = set()
+        for task in self.tasks:
+            for resource in task.requires:
+                if resource.id not in provided_ids:
+                    result[resource.id] = resource
+            provided_ids.update(task.provided_ids)
+        return result.values()
+
+    @property
+    def required_ids(self):
+        return [r.id for r in self.requires]
+
+    @property
+    def cache_key(self):
+        '''
+            Return a string identifying the results of all the steps, or None
+        if any of them is stochastic.  The change_ids that earlier steps will
+        give their resources are predicted (see Task.complete), so this can be
+        computed before any step has run.
+        '''
+        key_hash = hashlib.sha1()
+        change_ids = {}
+        for task in self.tasks:
+            cache_key = task.get_cache_key(change_ids)
+            if cache_key is None:
+                return None
+            key_hash.update(cache_key)
+            change_ids.update(task.predict_change_ids(change_ids))
+        return key_hash.hexdigest()
+
+    @property
+    def returned_names(self):
+        '''The names of the resources whose final values are returned.'''
+        result = []
+        for task in self.tasks:
+            for resource_name in task.plugin.provides:
+                if resource_name not in result:
+                    result.append(resource_name)
+        return result
+
+    def _checkout_step(self, task):
+        # an earlier step may have already checked in a resource this step 
+        #   also provides (e.g. a modification), so check it out again.
+        for item in task.provides:
+            if not item.is_locked:
+                task.locking_keys[item] = item.checkout()['locking_key']
+
+    def checkout(self):
+        '''
+            Return a dictionary with the stuff needed to run all the steps.
+        '''
+        trial = self.trials[0]
+        run_info = {}
+        run_info['task_id'] = self.task_id
+        run_info['steps'] = [{'plugin_info':{'stage':task.plugin_category,
+                                             'name':task.plugin.name},
+                              'kwargs':task.plugin_kwargs,
+                              'requires':list(task.plugin.requires),
+                              'provides':list(task.plugin.provides)}
+                             for task in self.tasks]
+        requires = self.requires
+        run_info['arg_names'] = [r.name for r in requires]
+        run_info['args'] = [r.data for r in requires]
+        run_info['returns'] = self.returned_names
+
+        # decide the change_ids up front, so workers can cache the results.
+        change_ids = {}
+        for task in self.tasks:
+            task.change_ids = task.predict_change_ids(change_ids)
+            change_ids.update(task.change_ids)
+        run_info['arg_keys'] = [(r.id, r.change_id) for r in requires]
+        run_info['result_keys'] = [(getattr(trial, name).id, 
+                change_ids[getattr(trial, name).id]) 
+                for name in run_info['returns']]
+
+        for task in self.tasks:
+            self._checkout_step(task)
+        return run_info
+
+    def complete(self, result):
+        '''
+            Complete each of the steps, <result> holds the final value of 
+        each of the resources in self.returned_names.
+        '''
+        final_values = dict(zip(self.returned_names, result))
+        for task in self.tasks:
+            self._checkout_step(task)
+            task.complete([final_values[resource_name] 
+                    for resource_name in task.plugin.provides])
+
+    def skip(self):
+        for task in self.tasks:
+            self._checkout_step(task)
+            task.skip()
+
+
 class Resource(object):
     """
         The Resource class handles locking(checkout) and unlocking(checkin)
@@ -459,6 +1012,18 @@ class Resource(object):
         self._change_info = {'by':'Manually', 'at':datetime.datetime.now(), 
                 'with':None, 'using':None, 'change_id':uuid.uuid4()}
         self._data = data
+        resource_store.data_changed(self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if isinstance(self._data, SpilledData):
+            # the spilled file belongs to this process's store.
+            state['_data'] = self.data
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        resource_store.data_changed(self)
 
     @classmethod
     def from_dict(cls, info_dict):
@@ -487,7 +1052,7 @@ class Resource(object):
             self._locking_key = uuid.uuid4()
             self._locked = True
             return {'name':self.name, 
-                    'data':self._data, 
+                    'data':self.data, 
                     'locking_key':self._locking_key}
 
     def checkin(self, data_dict=None, key=None, preserve_provenance=False):
@@ -510,6 +1075,10 @@ class Resource(object):
                     self._data = data_dict['data']
                 self._locking_key = None
                 self._locked = False
+                if data_dict is not None:
+                    resource_store.data_changed(self)
+                else:
+                    resource_store.checked_in(self)
             else:
                 raise ResourceError(pt.RESOURCE_KEY_INVALID % 
                         (str(key), self.name))
@@ -523,7 +1092,8 @@ class Resource(object):
         change_info['with'] = copy.copy(change_info['with']) 
 
         change_info['at'] = datetime.datetime.now()
-        change_info['change_id'] = uuid.uuid4()
+        if 'change_id' not in change_info:
+            change_info['change_id'] = uuid.uuid4()
 
         if preserve_provenance:
             if isinstance(self._change_info, list):
@@ -537,9 +1107,33 @@ class Resource(object):
     def is_locked(self):
         return self._locked
 
+    @property
+    def change_id(self):
+        '''The change_id of the most recent change to this resource.'''
+        change_info = self.change_info
+        if isinstance(change_info, list):
+            change_info = change_info[-1]
+        return change_info['change_id']
+
     @property
     def data(self):
-        return self._data
+        '''
+            The data of this resource.  Large arrays may have been spilled to
+        disk (see resource_store.ResourceStore), they're memory-mapped back
+        in transparently.
+        '''
+        return resource_store.get_data(self)
+
+    @property
+    def shape(self):
+        '''
+            The shape of the data of this resource (None if it has none).
+        Deferred data isn't loaded if its shape is known without it.
+        '''
+        if (isinstance(self._data, DeferredData) and 
+                self._data.shape is not None):
+            return self._data.shape
+        return getattr(self.data, 'shape', None)
 
     @property
     def change_info(self):
@@ -552,6 +1146,8 @@ class Resource(object):
             with : dict, a dictionary of keyword args for the <by> function.
             using : list, a list of (trial_id, resource_name) that 
                     were used as arguments to the <by> function.
+            using_change_ids : list, the change_ids those resources had
+                    (None for resources the <by> function modified).
             change_id : a uuid generated when this resource was last changed.
         '''
         return self._change_info
@@ -34,14 +34,24 @@ from spikepy.common import program_text as pt
 from spikepy.utils.substring_dict import SubstringDict 
 from spikepy.utils.cluster_data import cluster_data
 from spikepy.common.errors import *
+from spikepy.common.config_manager import config_manager
 from spikepy.common.task_manager import Resource
+from spikepy.common.lazy_traces import LazyTraces
 
 def zero_mean(a):
     return a - numpy.average(a)
 
-def format_traces(trace_list):
-    result = numpy.empty((len(trace_list), len(trace_list[0])), 
-            dtype=numpy.float64)
+def format_traces(trace_list, dtype=None):
+    '''
+        Return the traces as a 2D array of <dtype> (defaults to the
+    processing dtype, see ConfigManager.get_processing_dtype) with each
+    channel centred on zero.  The means are found in float64.
+    '''
+    if dtype is None:
+        dtype = config_manager.get_processing_dtype()
+    if isinstance(trace_list, LazyTraces):
+        return trace_list.astype(dtype) # centred as it is read.
+    result = numpy.empty((len(trace_list), len(trace_list[0])), dtype=dtype)
     for i, trace in enumerate(trace_list):
         result[i,:] = zero_mean(numpy.array(trace, dtype=numpy.float64))
     return result
@@ -50,22 +60,31 @@ class TrialManager(object):
     """
         The TrialManager keeps track of all the trials currently in the
     session.  It handles marking/unmarking, adding/removing trials, and 
-    assigning unique display names to trials.
+    assigning unique display names to trials.  The trials are indexed by
+    id, by display name and by whether they are marked, so none of these 
+    need to look at every trial.
     """
     def __init__(self):
         self._trial_index = {}
+        self._trial_name_index = SubstringDict() # display_name -> trial
+        self._marked_index = {} # trial_id -> trial, the marked trials.
         self._display_names = set()
+        self._next_name_count = {} # proposed display_name -> count
 
     def mark_trial(self, name, status):
         """Mark trial with display_name=<name> according to <status>."""
         trial = self.get_trial_with_name(name)
         assert type(status) is bool
 
-        if self.marked_trials:
-            num_channels = self.marked_trials[0].num_channels
-            if trial.num_channels != num_channels and status:
+        if self._marked_index and status:
+            num_channels = self._marked_index.itervalues().next().num_channels
+            if trial.num_channels != num_channels:
                 raise CannotMarkTrialError('Cannot mark a trial with %d channels, since trials with %d channels are already marked.' % (trial.num_channels, num_channels))
         trial.mark(status=status)
+        if status:
+            self._marked_index[trial.trial_id] = trial
+        else:
+            self._marked_index.pop(trial.trial_id, None)
         return trial.trial_id, trial.is_marked
 
     @supports_callbacks 
@@ -76,12 +95,15 @@ class TrialManager(object):
         """
         new_names = []
         for trial in trial_list:
-            if trial.trial_id in self._trial_index.keys():
+            if trial.trial_id in self._trial_index:
                 trial.reset_trial_id()
             new_name = self._get_unique_display_name(trial.display_name)
             trial.display_name = new_name
             new_names.append(new_name)
             self._trial_index[trial.trial_id] = trial
+            self._trial_name_index[new_name] = trial
+            if trial.is_marked:
+                self._marked_index[trial.trial_id] = trial
 
         for name in new_names:
             try:
@@ -91,16 +113,28 @@ class TrialManager(object):
         return trial_list
 
     def remove_trial(self, trial):
-        self._display_names.remove(trial.display_name)
+        self._forget_display_name(trial.display_name)
         del self._trial_index[trial.trial_id]
+        self._marked_index.pop(trial.trial_id, None)
         return trial.trial_id
 
+    def _forget_display_name(self, display_name):
+        self._display_names.remove(display_name)
+        del self._trial_name_index[display_name]
+        # the freed name may be the first free one again.
+        self._next_name_count = {}
+
     def _get_unique_display_name(self, proposed_display_name):
-        count = 1
+        # start counting where the last name made from this one left off.
+        count = self._next_name_count.get(proposed_display_name, 1)
         new_display_name = proposed_display_name
-        while new_display_name in self._display_names:
+        if new_display_name in self._display_names:
             new_display_name = '%s(%d)' % (proposed_display_name, count)
+        while new_display_name in self._display_names:
             count += 1
+            new_display_name = '%s(%d)' % (proposed_display_name, count)
+        if new_display_name != proposed_display_name:
+            self._next_name_count[proposed_display_name] = count + 1
         self._display_names.add(new_display_name)
         return new_display_name
 
@@ -111,21 +145,20 @@ class TrialManager(object):
     def rename_trial(self, old_name, proposed_name):
         """Find trial named <old_name> and rename it to <proposed_name>."""
         trial = self.get_trial_with_name(old_name)
-        self._display_names.remove(trial.display_name)
+        self._forget_display_name(trial.display_name)
         trial.display_name = self._get_unique_display_name(proposed_name)
+        self._trial_name_index[trial.display_name] = trial
         return trial
 
     @property
     def marked_trials(self):
         '''Return all currently marked trials.'''
-        return [trial for trial in self._trial_index.values()
-                if trial.is_marked]
+        return self._marked_index.values()
 
     @property
     def marked_trial_ids(self):
         """Return the trial_ids for all currently marked trials"""
-        marked_ids = [trial.trial_id for trial in self.get_marked_trials()]
-        return marked_ids
+        return self._marked_index.keys()
 
     @property
     def trials(self):
@@ -143,18 +176,14 @@ class TrialManager(object):
             raise MissingTrialError('No trial with id "%s" found.' % 
                     str(trial_id))
 
-    @property
-    def _trial_name_index(self):
-        tni = SubstringDict()
-        for trial in self._trial_index.values():
-            tni[trial.display_name] = trial
-        return tni
-
     def get_trial_with_name(self, name):
         """
-        Find the trial with display_name=<name> and return it.
-        Raises MissingTrialError if trial cannot be found.
+        Find the trial with display_name=<name> (or a unique part of it) and
+        return it.  Raises MissingTrialError if trial cannot be found.
         """
+        trial = self._trial_name_index.get(name)
+        if trial is not None:
+            return trial
         try:
             return self._trial_name_index[name]
         except KeyError:
@@ -184,27 +213,41 @@ class Trial(object):
         self.origin = origin
         self.originates = [] # list of resources the trial originally has.
 
+    @property
+    def raw_traces(self):
+        '''
+            The (formatted) traces the trial was created from.  They are the
+        data of the pf_traces resource, not a second reference that would
+        keep them in memory (see resource_store).
+        '''
+        if not hasattr(self, 'pf_traces'):
+            raise AttributeError('This trial has no raw traces.')
+        return self.pf_traces.data
+
     @property
     def num_channels(self):
-        if hasattr(self, 'raw_traces'):
-            return self.raw_traces.shape[0]
+        # the shape is known without loading traces of a saved session.
+        if hasattr(self, 'pf_traces') and self.pf_traces.shape is not None:
+            return self.pf_traces.shape[0]
         else:
             return 0
 
     def get_times(self, signal, sampling_freq):
+        # always float64, float32 can't tell samples apart after a few
+        #   minutes of recording.
         return numpy.arange(0, signal.shape[1], 
-                dtype=signal.dtype)/sampling_freq*1000.0
+                dtype=numpy.float64)/sampling_freq*1000.0
 
     def _setup_basic_attributes(self, raw_traces, sampling_freq):
-        self.raw_traces = format_traces(raw_traces)
-        self.raw_times = self.get_times(self.raw_traces, sampling_freq)
+        raw_traces = format_traces(raw_traces)
+        self.raw_times = self.get_times(raw_traces, sampling_freq)
         self.sampling_freq = sampling_freq
 
         # -------------------------------------
         # -- main processing stage resources --
         # pf_traces is a 2D numpy array where (pre-filtering)
         #    len(pf_traces) == num_channels
-        self.add_resource(Resource('pf_traces', data=self.raw_traces))
+        self.add_resource(Resource('pf_traces', data=raw_traces))
         self.add_resource(Resource('pf_sampling_freq', data=self.sampling_freq))
         
         # df_traces is a 2D numpy array where (detection-filtering)
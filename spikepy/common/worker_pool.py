@@ -0,0 +1,630 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import sys
+import uuid
+import threading
+import multiprocessing
+import traceback
+import time
+import Queue
+import itertools
+from collections import defaultdict, OrderedDict
+
+import numpy
+
+from spikepy.common.open_data_file import open_data_file
+from spikepy.common.config_manager import config_manager
+from spikepy.common.plugin_manager import plugin_manager
+from spikepy.common.shared_arrays import attach_arrays, share_arrays,\
+        unlink_arrays
+from spikepy.common.run_telemetry import get_peak_rss, get_serialized_size,\
+        get_current_rss, reset_peak_rss
+
+class WorkerResourceCache(object):
+    '''
+        The resources a worker keeps between jobs, keyed by 
+    (resource id, change_id).  The parent decides what is stored and what
+    is evicted (see WorkerPool._dispatch), so it always knows what is here and
+    can send a reference instead of the data.  Cached arrays are read-only, 
+    so that a plugin cannot change them for the tasks that come later.
+    '''
+    def __init__(self):
+        self._resources = {}
+
+    def __len__(self):
+        return len(self._resources)
+
+    def _store(self, key, value):
+        if isinstance(value, numpy.ndarray):
+            value = value.view()
+            value.flags.writeable = False
+        self._resources[key] = value
+        return value
+
+    def prepare_args(self, task_info):
+        '''
+            Return task_info['args'] with references replaced by the data.
+        Arguments that are stored are given to the plugin as the same 
+        read-only arrays that are cached, whether they were just sent or not.
+        '''
+        args = list(attach_arrays(task_info['args']))
+        for i, key in task_info.get('store_args', []):
+            args[i] = self._store(key, args[i])
+        for i, key in task_info.get('cached_args', []):
+            args[i] = self._resources[key]
+        return args
+
+    def store_results(self, task_info, result):
+        for i, key in task_info.get('store_results', []):
+            self._store(key, result[i])
+
+    def evict(self, keys):
+        for key in keys:
+            self._resources.pop(key, None)
+
+    def forget_results(self, task_info):
+        '''Forget the results of a failed task (the parent won't have them).'''
+        self.evict([key for i, key in task_info.get('store_results', [])])
+
+
+def run_task(task_info, resource_cache=None):
+    '''
+        Run a single task (see Task.checkout) and return the results_dict.
+    Arguments that arrive as SharedArrays are given to the plugin as read-only
+    views.  If task_info['shared_memory_threshold'] is not None, large arrays
+    in the result are placed in shared memory before being sent back.
+    '''
+    if resource_cache is None:
+        resource_cache = WorkerResourceCache()
+    args = resource_cache.prepare_args(task_info)
+    kwargs = task_info['kwargs']
+    stage_name = task_info['plugin_info']['stage']
+    plugin_name = task_info['plugin_info']['name']
+    plugin = plugin_manager.find_plugin(stage_name, plugin_name)
+
+    results_dict = {}
+    begin_time = time.time()
+    try:
+        results_dict['result'] = plugin.run(*args, **kwargs)
+        resource_cache.store_results(task_info, results_dict['result'])
+        threshold = task_info.get('shared_memory_threshold', None)
+        if threshold is not None:
+            results_dict['result'] = share_arrays(results_dict['result'], 
+                    threshold)
+    except:
+        resource_cache.forget_results(task_info)
+        results_dict['result'] = None
+        results_dict['error_type'] = sys.exc_info()[0].__name__
+        results_dict['traceback'] = traceback.format_exc()
+        traceback.print_exc()
+    end_time = time.time()
+    results_dict['task_id'] = task_info['task_id']
+    results_dict['runtime'] = end_time - begin_time
+    return results_dict
+
+def run_fused_task(task_info, resource_cache=None):
+    '''
+        Run the steps of a FusedTask (see FusedTask.checkout) one after the
+    other, keeping intermediate results in this process.  The result is the 
+    list of the final values of the resources in task_info['returns'].
+    '''
+    if resource_cache is None:
+        resource_cache = WorkerResourceCache()
+    resources = dict(zip(task_info['arg_names'], 
+            resource_cache.prepare_args(task_info)))
+
+    results_dict = {'step_runtimes':[]}
+    begin_time = time.time()
+    try:
+        for step in task_info['steps']:
+            step_begin_time = time.time()
+            plugin = plugin_manager.find_plugin(step['plugin_info']['stage'],
+                    step['plugin_info']['name'])
+            args = [resources[name] for name in step['requires']]
+            step_result = plugin.run(*args, **step['kwargs'])
+            resources.update(zip(step['provides'], step_result))
+            results_dict['step_runtimes'].append(
+                    time.time() - step_begin_time)
+        results_dict['result'] = [resources[name] 
+                for name in task_info['returns']]
+        resource_cache.store_results(task_info, results_dict['result'])
+        threshold = task_info.get('shared_memory_threshold', None)
+        if threshold is not None:
+            results_dict['result'] = share_arrays(results_dict['result'], 
+                    threshold)
+    except:
+        resource_cache.forget_results(task_info)
+        results_dict['result'] = None
+        results_dict['error_type'] = sys.exc_info()[0].__name__
+        results_dict['traceback'] = traceback.format_exc()
+        traceback.print_exc()
+    end_time = time.time()
+    results_dict['task_id'] = task_info['task_id']
+    results_dict['runtime'] = end_time - begin_time
+    return results_dict
+
+def run_open_file(open_info, resource_cache=None):
+    '''Open a single data file, returning the list of trials created.'''
+    file_interpreters = plugin_manager.file_interpreters
+    if 'processing_dtype' in open_info:
+        # the parent's setting wins (see Session.processing_dtype).
+        config_manager['backend']['processing_dtype'] = \
+                open_info['processing_dtype']
+    try:
+        results = open_data_file(open_info['fullpath'], file_interpreters,
+                **open_info['kwargs'])
+    except:
+        results = []
+        traceback.print_exc()
+    return results
+
+job_runners = {'task':run_task,
+               'fused_task':run_fused_task,
+               'open_file':run_open_file}
+
+# failures that may not happen again if the job is simply run again.
+TRANSIENT_ERRORS = ['MemoryError', 'WorkerDiedError']
+
+def is_transient_failure(results_dict):
+    '''Return True if a failed task (see run_task) is worth retrying.'''
+    return results_dict.get('error_type', None) in TRANSIENT_ERRORS
+
+def make_failure_result(job, error_type, reason):
+    '''Return the result of a <job> that could not be run to completion.'''
+    if job['kind'] == 'open_file':
+        return []
+    return {'task_id':job['payload']['task_id'], 'result':None, 
+            'runtime':0.0, 'error_type':error_type,
+            'traceback':'%s: %s' % (error_type, reason)}
+
+def pool_worker(input_queue, results_queue, worker_index):
+    '''
+        Worker process owned by a WorkerPool.  Handles jobs until it
+    recieves None.
+    '''
+    # pre-warm: make sure the plugins are loaded before the first job.
+    plugin_manager.loaded_plugins
+
+    resource_cache = WorkerResourceCache()
+    pid = os.getpid()
+    for job in iter(input_queue.get, None):
+        start_time = time.time()
+        resource_cache.evict(job.get('evict', []))
+        # the growth from here to the peak is what the job needed.
+        start_rss = None
+        if reset_peak_rss():
+            start_rss = get_current_rss()
+        result = job_runners[job['kind']](job['payload'], 
+                resource_cache=resource_cache)
+        if isinstance(result, dict):
+            result['telemetry'] = {'start_time':start_time,
+                    'end_time':time.time(), 'pid':pid,
+                    'peak_rss':get_peak_rss(), 'start_rss':start_rss,
+                    'output_bytes':get_serialized_size(result['result'])}
+        results_queue.put({'channel':job['channel'], 'result':result,
+                'worker':worker_index, 'job_id':job['job_id']})
+
+def create_worker_pool(num_workers=None):
+    '''
+        Return a new WorkerPool, or a RemoteWorkerPool (see remote_workers) if
+    [backend] executor is 'remote'.
+    '''
+    if config_manager['backend']['executor'] == 'remote':
+        from spikepy.common.remote_workers import RemoteWorkerPool
+        return RemoteWorkerPool()
+    return WorkerPool(num_workers=num_workers)
+
+def get_nbytes(value):
+    '''Return the size of <value> in bytes (0 if it isn't an array).'''
+    return getattr(value, 'nbytes', 0)
+
+
+class WorkerPool(object):
+    '''
+        A long-lived set of worker processes.  Workers import the plugins
+    once, when they start, and are then reused for every job submitted until
+    shutdown() is called.  Results are routed back by channel, so more than
+    one caller (a run and an open_files call for example) may share the pool.
+
+        Jobs wait in the parent until a worker is free, and each worker runs
+    one job at a time.  Each worker keeps the resources it has been sent (and
+    the ones it has produced) in a bounded LRU cache, keyed by the 
+    'arg_keys' and 'result_keys' of the tasks (see Task.checkout).  The pool
+    keeps a mirror of every worker's cache, prefers to run a job on the worker
+    that already holds most of its arguments and then sends references 
+    instead of the data.  If that worker is busy, a free worker takes the job
+    (with the data) instead of waiting.
+
+        Workers that die (killed by the OS for using too much memory, for
+    example) are replaced.  The job they were running gets a result with
+    the error_type 'WorkerDiedError' (see make_failure_result).  Workers
+    are never killed though, they share the results queue and one killed
+    while writing to it could corrupt it (see cancel).
+    '''
+    # how often (in seconds) to check on the workers while waiting for results
+    poll_interval = 1.0
+
+    def __init__(self, num_workers=None, cache_size=None):
+        '''
+        Inputs:
+            *kwargs*
+            num_workers: The number of worker processes.  If None,
+                    config_manager.get_num_workers() is consulted each time
+                    the pool is started.
+            cache_size: The size (in bytes) of each worker's resource cache.
+                    If None, [backend] worker_cache_size is used.  0 disables
+                    the caches.
+        '''
+        self._num_workers = num_workers
+        self._cache_size = cache_size
+        self._workers = []
+        self._input_queues = []
+        self._results_queue = None
+
+        self._start_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._reading = False
+        self._pending = defaultdict(list)
+
+        self._dispatch_lock = threading.RLock()
+        self._job_ids = itertools.count()
+        self._waiting_jobs = []
+        self._running_jobs = {} # worker_index -> job (or None if idle)
+        self._mirrors = []      # worker_index -> OrderedDict(key->nbytes)
+        self._retired = []      # (worker, cancelled job it is finishing)
+
+    @property
+    def num_workers(self):
+        if self._num_workers is None:
+            return config_manager.get_num_workers()
+        return self._num_workers
+
+    @property
+    def cache_size(self):
+        if self._cache_size is None:
+            return config_manager['backend']['worker_cache_size']*2**20
+        return self._cache_size
+
+    @property
+    def is_running(self):
+        return bool(self._workers)
+
+    def start(self):
+        '''
+            Start the worker processes (if they aren't running already).  If
+        the number of workers requested has changed since the pool was
+        started, the pool is restarted with the new number of workers.
+        '''
+        with self._start_lock:
+            if self._workers and len(self._workers) != self.num_workers:
+                self._stop_workers()
+            if not self._workers:
+                self._results_queue = multiprocessing.Queue()
+                for i in xrange(self.num_workers):
+                    self._workers.append(None)
+                    self._input_queues.append(None)
+                    self._mirrors.append(None)
+                    self._start_worker(i)
+
+    def _start_worker(self, worker_index):
+        input_queue = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=pool_worker,
+                args=(input_queue, self._results_queue, worker_index))
+        worker.daemon = True
+        worker.start()
+        self._workers[worker_index] = worker
+        self._input_queues[worker_index] = input_queue
+        self._running_jobs[worker_index] = None
+        self._mirrors[worker_index] = OrderedDict()
+
+    def _replace_dead_workers(self):
+        '''
+            Start new workers in place of any that have died and return the
+        messages reporting the failure of the jobs they were running.
+        '''
+        messages = []
+        with self._start_lock:
+            with self._dispatch_lock:
+                self._reap_retired_workers()
+                for worker_index, worker in enumerate(self._workers):
+                    if worker.is_alive():
+                        continue
+                    job = self._running_jobs[worker_index]
+                    self._restart_worker(worker_index)
+                    if job is not None:
+                        self._running_jobs[worker_index] = job
+                        messages.append({'channel':job['channel'],
+                                'worker':worker_index, 'job_id':job['job_id'],
+                                'result':make_failure_result(job, 
+                                        'WorkerDiedError', 'the worker '
+                                        'process running this task died '
+                                        '(exitcode %s).' % worker.exitcode)})
+        return messages
+
+    def _restart_worker(self, worker_index):
+        # the new worker starts with an empty cache.
+        for waiting_job in self._waiting_jobs:
+            if waiting_job['preferred_worker'] == worker_index:
+                waiting_job['preferred_worker'] = None
+        self._start_worker(worker_index)
+
+    def _retire_worker(self, worker_index):
+        '''
+            Replace the worker <worker_index> with a new one right away.  The
+        old one is told to exit once it has finished its (cancelled) job, 
+        the result it sends then is ignored (see _job_finished).
+        '''
+        self._input_queues[worker_index].put(None)
+        self._retired.append((self._workers[worker_index], 
+                self._running_jobs[worker_index]))
+        self._restart_worker(worker_index)
+
+    def _reap_retired_workers(self):
+        '''
+            Forget the retired workers that have exited, freeing the shared
+        memory of their jobs.
+        '''
+        for worker, job in list(self._retired):
+            if worker.is_alive():
+                continue
+            worker.join()
+            self._retired.remove((worker, job))
+            if job['shared_args'] is not None:
+                unlink_arrays(job['shared_args'])
+
+    def new_channel(self):
+        '''Return a new channel id, used to route results to the caller.'''
+        return uuid.uuid4()
+
+    def submit(self, kind, payload, channel):
+        '''
+            Queue up a job of the given <kind> (see job_runners).  The
+        result can be retrieved with get_result(<channel>).
+        '''
+        self.start()
+        job = {'kind':kind, 'payload':payload, 'channel':channel}
+        with self._dispatch_lock:
+            job['job_id'] = next(self._job_ids)
+            job['preferred_worker'] = self._find_preferred_worker(payload)
+            self._waiting_jobs.append(job)
+            self._dispatch_waiting_jobs()
+
+    def _find_preferred_worker(self, payload):
+        '''Return the worker holding most of the job's arguments (or None).'''
+        arg_keys = payload.get('arg_keys', None)
+        if not arg_keys or self.cache_size <= 0:
+            return None
+        best_worker = None
+        best_score = (0, 0)
+        for worker_index, mirror in enumerate(self._mirrors):
+            cached = [mirror[key] for key in arg_keys if key in mirror]
+            score = (sum(cached), len(cached))
+            if score > best_score:
+                best_worker = worker_index
+                best_score = score
+        return best_worker
+
+    def _dispatch_waiting_jobs(self):
+        for worker_index in sorted(self._running_jobs.keys()):
+            if not self._waiting_jobs:
+                return
+            if self._running_jobs[worker_index] is not None:
+                continue
+            # prefer jobs whose data is here, otherwise take the first job
+            #   that has no preference or is waiting on a busy worker.
+            chosen = None
+            for job in self._waiting_jobs:
+                preferred_worker = job['preferred_worker']
+                if preferred_worker == worker_index:
+                    chosen = job
+                    break
+                if chosen is None and (preferred_worker is None or
+                        self._running_jobs.get(preferred_worker) is not None):
+                    chosen = job
+            if chosen is not None:
+                self._waiting_jobs.remove(chosen)
+                self._dispatch(chosen, worker_index)
+
+    def _dispatch(self, job, worker_index):
+        '''
+            Send <job> to the worker, replacing arguments the worker already
+        has with references and telling it what to cache and what to evict.
+        '''
+        payload = job['payload']
+        message = {'kind':job['kind'], 'channel':job['channel'], 
+                'job_id':job['job_id']}
+        job['shared_args'] = None
+        job['worker'] = worker_index
+        if 'args' in payload:
+            payload = dict(payload)
+            args = list(payload['args'])
+            mirror = self._mirrors[worker_index]
+            if self.cache_size > 0:
+                used_keys = set()
+                payload['cached_args'] = []
+                payload['store_args'] = []
+                for i, key in enumerate(payload.get('arg_keys', None) or []):
+                    if key is None:
+                        continue
+                    if key in mirror:
+                        mirror[key] = mirror.pop(key) # most recently used.
+                        args[i] = None
+                        payload['cached_args'].append((i, key))
+                    else:
+                        mirror[key] = get_nbytes(args[i])
+                        payload['store_args'].append((i, key))
+                    used_keys.add(key)
+                payload['store_results'] = []
+                for i, key in enumerate(payload.get('result_keys', None) or []):
+                    if key is not None:
+                        used_keys.add(key)
+                        mirror[key] = 0 # the size is updated when it's done.
+                        payload['store_results'].append((i, key))
+                message['evict'] = self._evict(mirror, used_keys)
+            threshold = payload.get('shared_memory_threshold', None)
+            if threshold is not None:
+                args = share_arrays(args, threshold)
+                job['shared_args'] = args
+            payload['args'] = args
+            job['input_bytes'] = get_serialized_size(args)
+        message['payload'] = payload
+        job['dispatch_time'] = time.time()
+        job['store_results'] = payload.get('store_results', [])
+        self._running_jobs[worker_index] = job
+        self._input_queues[worker_index].put(message)
+
+    def _evict(self, mirror, used_keys):
+        '''Return the least-recently-used keys to remove to fit the cache.'''
+        evicted = []
+        total_size = sum(mirror.values())
+        for key in mirror.keys():
+            if total_size <= self.cache_size:
+                break
+            if key not in used_keys:
+                total_size -= mirror.pop(key)
+                evicted.append(key)
+        return evicted
+
+    def _job_finished(self, message):
+        '''
+            Free the worker that sent <message> and give it the next job.
+        Returns False if <message> is for a job that is no longer running
+        (one that was cancelled, see cancel) and should be ignored.  The
+        shared memory of an ignored result is freed, nobody else will.
+        '''
+        with self._dispatch_lock:
+            worker_index = message['worker']
+            job = self._running_jobs.get(worker_index, None)
+            if job is None or job['job_id'] != message['job_id']:
+                if isinstance(message['result'], dict):
+                    unlink_arrays(message['result'].get('result', None))
+                self._reap_retired_workers()
+                return False
+            self._running_jobs[worker_index] = None
+            if isinstance(message['result'], dict):
+                if job['shared_args'] is not None:
+                    unlink_arrays(job['shared_args'])
+                if 'telemetry' in message['result']:
+                    message['result']['telemetry'].update(
+                            {'dispatch_time':job['dispatch_time'],
+                             'input_bytes':job.get('input_bytes', 0)})
+                mirror = self._mirrors[worker_index]
+                result = message['result'].get('result', None)
+                for i, key in job['store_results']:
+                    if result is None:
+                        mirror.pop(key, None)
+                    elif key in mirror:
+                        mirror[key] = get_nbytes(result[i])
+            self._dispatch_waiting_jobs()
+            return True
+
+    def get_result(self, channel):
+        '''Block until a result is available on <channel> and return it.'''
+        while True:
+            with self._condition:
+                while True:
+                    if self._pending[channel]:
+                        result = self._pending[channel].pop(0)
+                        if not self._pending[channel]:
+                            del self._pending[channel]
+                        return result
+                    if not self._reading:
+                        self._reading = True
+                        break
+                    self._condition.wait()
+
+            # only one thread reads from the results queue at a time.
+            messages = []
+            try:
+                try:
+                    received = [self._results_queue.get(
+                            timeout=self.poll_interval)]
+                except Queue.Empty:
+                    received = self._replace_dead_workers()
+                messages = [message for message in received
+                        if self._job_finished(message)]
+            finally:
+                with self._condition:
+                    self._reading = False
+                    for message in messages:
+                        self._pending[message['channel']].append(
+                                message['result'])
+                    self._condition.notify_all()
+
+    def cancel(self, channel):
+        '''
+            Cancel the jobs submitted on <channel>, they all get a result 
+        with the error_type 'CancelledError' right away.  Jobs that are
+        waiting are dropped.  The workers running the others are replaced
+        by new ones, and exit once they have finished their job.  Killing
+        them instead could leave the results queue they share with the other
+        workers corrupted or locked.
+        '''
+        with self._start_lock:
+            with self._dispatch_lock:
+                cancelled_jobs = [job for job in self._waiting_jobs 
+                        if job['channel'] == channel]
+                for job in cancelled_jobs:
+                    self._waiting_jobs.remove(job)
+                for worker_index, job in sorted(self._running_jobs.items()):
+                    if job is not None and job['channel'] == channel:
+                        self._retire_worker(worker_index)
+                        cancelled_jobs.append(job)
+                self._dispatch_waiting_jobs()
+
+        with self._condition:
+            for job in cancelled_jobs:
+                self._pending[channel].append(make_failure_result(job,
+                        'CancelledError', 'the job was cancelled.'))
+            self._condition.notify_all()
+
+    def _join_worker(self, worker):
+        '''
+            Wait for <worker> to exit.  It can't until the results it sent 
+        are read, so they are read and dropped meanwhile.
+        '''
+        while worker.is_alive():
+            try:
+                while True:
+                    message = self._results_queue.get_nowait()
+                    if isinstance(message['result'], dict):
+                        unlink_arrays(message['result'].get('result', None))
+            except Queue.Empty:
+                pass
+            worker.join(0.05)
+        worker.join()
+
+    def _stop_workers(self):
+        for input_queue in self._input_queues:
+            input_queue.put(None)
+        for worker in self._workers + [w for w, job in self._retired]:
+            self._join_worker(worker)
+        self._reap_retired_workers()
+        self._workers = []
+        self._input_queues = []
+        self._results_queue = None
+        self._running_jobs = {}
+        self._mirrors = []
+        for job in self._waiting_jobs:
+            job['preferred_worker'] = None
+
+    def shutdown(self):
+        '''Stop all the worker processes, waiting for them to exit.'''
+        with self._start_lock:
+            if self._workers:
+                self._stop_workers()
@@ -38,6 +38,12 @@ class SpikepyMethod(SpikepyPlugin):
     # to all trials.
     # Note: unpool_as is ignored if silent_pooling is False
     unpool_as = None # if None then no unpooling will be done
+    #     aliases is a list of 'requires' resource names or None equal in
+    # length to the 'provides' list.  Each element says that the provided
+    # resource is just the named required resource, passed along unchanged.
+    # If every provided resource is an alias the method is never run, the 
+    # resources share their data instead (see Task.is_alias).
+    aliases = None
     #     Is this method stochastic in nature (generally gives different results
     # with the same inputs)?
     is_stochastic = False
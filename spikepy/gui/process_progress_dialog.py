@@ -25,7 +25,8 @@ import wx.grid as gridlib
 
 from spikepy.common.config_manager import config_manager as config
 from spikepy.plotting_utils.plot_panel import PlotPanel
-from spikepy.plotting_utils.plot_operations import plot_operations
+from spikepy.plotting_utils.plot_operations import plot_operations,\
+        apply_operation_states
 from spikepy.common import program_text as pt
 from spikepy.utils.wrap import wrap
 
@@ -67,6 +68,8 @@ class GraphArea(wx.Panel):
         self.end_button = end_button
         self.plot_panel = plot_panel 
         self.shown = 0
+        self._layout = None
+        self._states = {}
         self._plot_data = []
         self._has_plotted = False
 
@@ -82,6 +85,21 @@ class GraphArea(wx.Panel):
     def on_end(self, event):
         self.show_data(len(self._plot_data)-1)
 
+    def set_layout(self, layout):
+        '''Set the plot layout (see Scheduler.get_plot_layout).'''
+        self._layout = layout
+        self._states = {}
+        self._plot_data = []
+        self.add_plot_data(({}, 0.0))
+
+    def update_states(self, changes, t):
+        '''
+            Apply <changes> (see Scheduler.pop_state_changes) to the states
+        of the operations and add the result at time <t> to the history.
+        '''
+        self._states.update(changes)
+        self.add_plot_data((dict(self._states), t))
+
     def add_plot_data(self, data):
         self._plot_data.append(data)
 
@@ -99,8 +117,8 @@ class GraphArea(wx.Panel):
         self.end_button.Enable(last_two)
 
     def show_data(self, i):
-        plot_dict, t = self._plot_data[i]
-        self.plot(plot_dict, t)
+        states, t = self._plot_data[i]
+        self.plot(apply_operation_states(self._layout, states), t)
         self.shown = i
         self.enable_navigation_buttons()
 
@@ -223,6 +241,14 @@ class ProcessProgressDialog(wx.Dialog):
                 if statement == 'TASKS':
                     self._num_tasks = len(data)
                     self._update_messages('Created %d tasks.' % len(data))
+                if statement == 'CACHED_TASK':
+                    self._num_tasks_competed += 1
+                    self._update_messages('Reused cached results for %s' % 
+                            data)
+                if statement == 'ALIASED_TASK':
+                    self._num_tasks_competed += 1
+                    self._update_messages('Passed along the inputs of %s' % 
+                            data)
                 if statement == 'SKIPPED_TASK':
                     self._num_tasks_competed += 1
                     self._update_messages('Skipped %s' % data)
@@ -234,18 +260,39 @@ class ProcessProgressDialog(wx.Dialog):
                 if statement == 'TASK_ERROR':
                     self._update_messages('ERROR on %s:\n\n %s' % 
                             (data['task'], wrap(data['traceback'], 80)))
-                    self._num_tasks_competed = self._num_tasks
-                    self.close_button.SetLabel('ABORT')
                     self.info_text.SetLabel('An ERROR occured in a plugin!')
+                    if data.get('aborted', True):
+                        self._num_tasks_competed = self._num_tasks
+                        self.close_button.SetLabel('ABORT')
+                    else:
+                        self._num_tasks_competed += 1
+                if statement == 'TASK_RETRY':
+                    self._update_messages('Retrying %s (attempt %d):\n\n %s'
+                            % (data['task'], data['attempt'] + 1,
+                            wrap(data['traceback'], 80)))
+                if statement == 'CANCELLED_TASK':
+                    self._num_tasks_competed += 1
+                    self._update_messages('Cancelled %s' % data)
+                if statement == 'CANCELLED_RUN':
+                    self._update_messages('The run was cancelled.')
+                    self.info_text.SetLabel('Processing was cancelled.')
                 if statement == 'FINISHED_TASK':
                     self._num_tasks_competed += 1
                     self._update_messages(
                             'Finished %s\n    Runtime:%8.4f seconds' % 
                             (data['task'], data['runtime']))
                     self._plugin_runtime += data['runtime']
-                if statement == 'DISPLAY_GRAPH':
-                    plot_dict = data
-                    self.graph_area.add_plot_data(plot_dict)
+                if statement == 'RUN_TELEMETRY':
+                    message = 'Run summary:\n%s' % data['summary']
+                    if data['trace_filename'] is not None:
+                        message += '\n    Trace saved to %s' %\
+                                data['trace_filename']
+                    self._update_messages(message)
+                if statement == 'GRAPH_LAYOUT':
+                    self.graph_area.set_layout(data)
+                if statement == 'OPERATION_STATES':
+                    changes, t = data
+                    self.graph_area.update_states(changes, t)
 
                 progress = int((self._num_tasks_competed/
                         float(self._num_tasks))*100.0)
@@ -259,7 +306,8 @@ class ProcessProgressDialog(wx.Dialog):
             if self._just_once:
                 self._just_once = False
                 self.close_button.Enable()
-                if 'ERROR' not in self.info_text.GetLabel():
+                if ('ERROR' not in self.info_text.GetLabel() and
+                        'cancelled' not in self.info_text.GetLabel()):
                     self.info_text.SetLabel('Finished Processing')
                 total_runtime = time.time()-self._start_time
                 self._update_messages('Finished Processing:\n    Total Runtime = %f seconds (real time)\n    Time spent in plugins = %f seconds (cpu time, not real time)' % (total_runtime, self._plugin_runtime))
@@ -16,6 +16,46 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 import time
 
+operation_fill_colors = {'started':'cyan', 'finished':'black', 
+        'default':'white'}
+operation_edge_colors = {'started':'black', 'finished':'cyan', 
+        'default':'black'}
+
+def apply_operation_states(layout, states):
+    '''
+        Return a copy of the plot <layout> (see Scheduler.get_plot_layout)
+    colored according to <states>, a dictionary mapping operation indexes to
+    'started' or 'finished'.  Operations not in <states> are drawn in the
+    'default' state.  The <layout> itself is not modified.
+    '''
+    node_states = [states.get(i, 'default') 
+            for i in xrange(len(layout['operation_names']))]
+    edge_colors = [operation_edge_colors[state] for state in node_states]
+
+    plot_dict = dict(layout)
+    links = []
+    for (xs, ys, kwargs), source in zip(layout['link_list'], 
+            layout['link_sources']):
+        kwargs = dict(kwargs)
+        kwargs['color'] = edge_colors[source]
+        links.append((xs, ys, kwargs))
+    plot_dict['link_list'] = links
+
+    node_info = dict(layout['node_info'])
+    node_info['kwargs'] = dict(node_info['kwargs'])
+    node_info['kwargs']['edgecolors'] = edge_colors
+    node_info['kwargs']['facecolors'] = [operation_fill_colors[state] 
+            for state in node_states]
+    plot_dict['node_info'] = node_info
+
+    labels = []
+    for (x, y, s, kwargs), color in zip(layout['label_list'], edge_colors):
+        kwargs = dict(kwargs)
+        kwargs['color'] = color
+        labels.append((x, y, s, kwargs))
+    plot_dict['label_list'] = labels
+    return plot_dict
+
 def plot_operations(plot_dict, t,  axes):
     plot_links(plot_dict['link_list'], axes)
     plot_nodes(plot_dict['node_info'], axes)
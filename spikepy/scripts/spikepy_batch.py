@@ -0,0 +1,88 @@
+#! /usr/bin/python
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# PARSE COMMAND LINE ARGUMENTS
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Process data files with a spikepy strategy and export the results, without a gui.  Files are streamed through a few at a time, so memory use doesn't grow with the number of files.")
+
+    parser.add_argument('strategy', 
+            help='a .strategy file or the name of a saved strategy')
+    parser.add_argument('inputs', nargs='+', 
+            help='data files or glob patterns (quote them) to process')
+    parser.add_argument('-d', '--data_interpreter', dest='data_interpreter',
+            required=True, 
+            help='name of the data-interpreter used to export the results')
+    parser.add_argument('-o', '--output_dir', dest='output_dir', 
+            default='.', help='directory the results are written to')
+    parser.add_argument('-n', '--trials_in_flight', dest='trials_in_flight',
+            type=int, default=None, 
+            help='number of files opened and processed together')
+    parser.add_argument('-k', '--kwarg', dest='kwargs', action='append',
+            default=[], metavar='NAME=VALUE',
+            help='keyword argument for the data-interpreter, e.g. file_format=.csv')
+    parser.add_argument('-s', '--summary', dest='summary_file', default=None,
+            help='also write the throughput summary to this file')
+    command_line_arguments = parser.parse_args()
+
+    import os
+    import sys
+
+    from spikepy.session import Session
+    from spikepy.common.strategy import Strategy
+    from spikepy.common.batch_processor import BatchProcessor,\
+            find_input_files
+
+    export_kwargs = {}
+    for kwarg in command_line_arguments.kwargs:
+        name, sep, value = kwarg.partition('=')
+        if not sep:
+            parser.error('kwargs must look like NAME=VALUE, not %s' % kwarg)
+        export_kwargs[name] = value
+
+    fullpaths = find_input_files(command_line_arguments.inputs)
+    if not fullpaths:
+        parser.error('no files match %s' % 
+                ' '.join(command_line_arguments.inputs))
+
+    session = Session()
+    if os.path.exists(command_line_arguments.strategy):
+        strategy = Strategy.from_file(command_line_arguments.strategy)
+    else:
+        strategy = session.strategy_manager.get_strategy(
+                command_line_arguments.strategy)
+
+    processor = BatchProcessor(session, strategy, 
+            command_line_arguments.data_interpreter,
+            command_line_arguments.output_dir,
+            trials_in_flight=command_line_arguments.trials_in_flight,
+            export_kwargs=export_kwargs)
+    def report(line):
+        print line
+        sys.stdout.flush()
+    try:
+        summary = processor.process(fullpaths, report=report)
+    finally:
+        session.shutdown()
+
+    print summary.format_summary()
+    if command_line_arguments.summary_file is not None:
+        with open(command_line_arguments.summary_file, 'w') as ofile:
+            ofile.write(summary.format_summary() + '\n')
+    if summary.failed_files or summary.failed_trials:
+        sys.exit(1)
@@ -0,0 +1,39 @@
+#! /usr/bin/python
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# PARSE COMMAND LINE ARGUMENTS
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Run spikepy worker processes for a session on another machine (one using [backend] executor=remote).  The workers wait for the session to start, and keep serving sessions until interrupted.")
+
+    parser.add_argument('-c', '--connect', dest='address', required=True,
+            metavar='HOST:PORT', 
+            help="address of the session, its [backend] remote_address")
+    parser.add_argument('-a', '--authkey', dest='authkey', default=None,
+            help="the session's [backend] remote_authkey (defaults to this machine's setting)")
+    parser.add_argument('-n', '--num_workers', dest='num_workers', type=int,
+            default=None, 
+            help='number of worker processes (defaults to the number of cpus, up to [backend] limit_num_processes)')
+    command_line_arguments = parser.parse_args()
+
+    from spikepy.common.remote_workers import run_remote_workers
+    print 'Serving spikepy sessions at %s, press Ctrl-C to stop.' %\
+            command_line_arguments.address
+    run_remote_workers(command_line_arguments.address, 
+            authkey=command_line_arguments.authkey,
+            num_workers=command_line_arguments.num_workers)
@@ -19,7 +19,9 @@ import multiprocessing
 import uuid
 import cPickle
 import os
-import gzip
+import atexit
+
+import numpy
 
 try:
     from callbacks import supports_callbacks
@@ -28,8 +30,14 @@ except ImportError:
 
 from spikepy.common.trial_manager import TrialManager, Trial
 from spikepy.common.process_manager import ProcessManager
+from spikepy.common.run_handle import RunHandle
+from spikepy.common.worker_pool import create_worker_pool
 from spikepy.common.plugin_manager import plugin_manager
 from spikepy.common.config_manager import config_manager
+from spikepy.common.resource_store import resource_store
+from spikepy.common.session_archive import save_session_archive
+from spikepy.common.block_compression import GzipWriter
+from spikepy.common.lazy_traces import materialize
 from spikepy.common.strategy_manager import StrategyManager, Strategy
 from spikepy.common import path_utils
 from spikepy.common.errors import *
@@ -38,6 +46,9 @@ from spikepy.common import stages
 class Session(object):
     def __init__(self, module_suffix=None):
         path_utils.setup_user_directories(app_name='spikepy')
+        resource_store.configure(config_manager.get_resource_memory_ceiling(),
+                os.path.join(path_utils.get_data_dirs(app_name='spikepy')[
+                'user']['cache'], 'spilled_resources'))
 
         self.config_manager   = config_manager
         self.trial_manager    = TrialManager()
@@ -46,7 +57,11 @@ class Session(object):
         self.strategy_manager.load_all_strategies()
         self._current_strategy = None
         self.current_strategy = self.get_default_strategy()
-        self.process_manager  = ProcessManager(self.trial_manager)
+        self.worker_pool      = create_worker_pool()
+        self.process_manager  = ProcessManager(self.trial_manager,
+                worker_pool=self.worker_pool)
+        self._runs = [] # (thread, ids of the trials it processes)
+        atexit.register(self.shutdown)
 
         # register callback for open_files
         self.process_manager.open_files.add_callback(self._files_opened,
@@ -74,24 +89,63 @@ class Session(object):
         """Open the files located at fullpaths"""
         return self.process_manager.open_files(fullpaths, **kwargs)
 
-    def save(self, filename, gzipped=True):
-        """Save this session."""
+    def save(self, filename, gzipped=True, traces_by_reference=False):
+        """
+        Save this session.  If <filename> ends with '.sesd' the session is 
+        saved as a directory of separately loadable blocks (see 
+        session_archive.save_session_archive), otherwise as a single 
+        (optionally gzipped) pickle.  Either way it is compressed in as 
+        many threads as there are workers, at [backend] compression_level 
+        (and for '.sesd' with [backend] session_compression).  Traces that
+        are still in the file they were opened from (see LazyTraces) are 
+        read and saved too, unless <traces_by_reference> is True.  Then 
+        only their filename is saved and that file has to stay where it is.
+        """
+        compression, level = config_manager.get_session_compression()
+        num_threads = config_manager.get_num_workers()
+        if filename.endswith('.sesd'):
+            return save_session_archive(filename, self.trials, 
+                    self.current_strategy, compression=compression, 
+                    level=level, num_threads=num_threads, 
+                    traces_by_reference=traces_by_reference)
         if not filename.endswith('.ses'):
             filename = '%s.ses' % filename
 
         trial_dicts = []
         for trial in self.trials:
-            trial_dicts.append(trial.as_dict)
+            trial_dict = trial.as_dict
+            if not traces_by_reference:
+                for resource in trial.resources:
+                    resource_dict = trial_dict[resource.name]
+                    resource_dict['data'] = materialize(resource_dict['data'])
+            trial_dicts.append(trial_dict)
         strategy_dict = self.current_strategy.as_dict
         session_dict = {'trials':trial_dicts, 'strategy':strategy_dict}
-        if gzipped:
-            ofile = gzip.open(filename, 'wb')
-        else:
-            ofile = open(filename, 'wb')
-        cPickle.dump(session_dict, ofile, protocol=-1)
-        ofile.close()
+        with open(filename, 'wb') as ofile:
+            if gzipped:
+                # pickled a chunk at a time, never all of it in memory.
+                with GzipWriter(ofile, level, num_threads) as writer:
+                    cPickle.dump(session_dict, writer, protocol=-1)
+            else:
+                cPickle.dump(session_dict, ofile, protocol=-1)
         return filename
 
+    @property
+    def processing_dtype(self):
+        """
+        The numpy dtype that traces, spike windows and features are
+        processed and stored in (see [backend] processing_dtype).  Setting
+        it affects the trials opened afterwards.
+        """
+        return self.config_manager.get_processing_dtype()
+
+    @processing_dtype.setter
+    def processing_dtype(self, dtype):
+        dtype_name = numpy.dtype(dtype).name
+        if dtype_name not in ('float64', 'float32'):
+            raise ConfigError('The processing dtype must be float64 or float32, not %s.' % dtype_name)
+        self.config_manager['backend']['processing_dtype'] = dtype_name
+
     # TRIAL RELATED
     def get_trial(self, name_or_id):
         """Return the trial with the given name or id"""
@@ -197,21 +251,46 @@ class Session(object):
         self.strategy_manager.save_current_strategy(strategy_name)
 
     # RUN RELATED
+    def start_workers(self):
+        """
+            Start (pre-warm) the worker processes.  This is done 
+        automatically the first time they are needed.
+        """
+        self.worker_pool.start()
+
+    def shutdown(self):
+        """Wait for any run to finish and then stop the worker processes."""
+        self.join_run()
+        self.worker_pool.shutdown()
+
     def join_run(self):
-        """Join the run thread (if there is one)."""
-        if hasattr(self, '_run_thread'):
-            self._run_thread.join()
+        """Join the run threads (if there are any)."""
+        for run_thread, trial_ids in self._runs:
+            run_thread.join()
 
     @property
     def is_running(self):
-        if hasattr(self, '_run_thread'):
-            return self._run_thread.is_alive()
-        else:
-            return False
+        return bool(self._get_running_trial_ids())
+
+    def _get_running_trial_ids(self):
+        # forget the runs that have finished.
+        self._runs = [(run_thread, trial_ids) 
+                for run_thread, trial_ids in self._runs 
+                if run_thread.is_alive()]
+        result = set()
+        for run_thread, trial_ids in self._runs:
+            result.update(trial_ids)
+        return result
+
+    def _start_run_thread(self, target, trial_ids):
+        run_thread = threading.Thread(target=target)
+        self._runs.append((run_thread, trial_ids))
+        run_thread.start()
+        return run_thread
 
     def run(self, stage_name=None, strategy=None,  
             message_queue=multiprocessing.Queue(),
-            async=False):
+            async=False, incremental=False):
         '''
             Run the given strategy (defaults to current_strategy), or a stage 
         from that strategy.  Results are placed into the appropriate 
@@ -223,6 +302,27 @@ class Session(object):
             message_queue: If passed, will be populated with run messages.
             async: If True, processing will run in a separate thread.  This 
                     thread can be joined with session.join_run()
+            incremental: If True, only the tasks whose results are out of
+                    date (because a setting changed or something they 
+                    depend on must be rerun) are run.
+        '''
+        task_manager, trial_ids = self._prepare_to_run(strategy, stage_name,
+                incremental)
+        if incremental and task_manager.num_tasks == 0:
+            message_queue.put(('FINISHED_RUN', None))
+            return # everything is already up to date.
+
+        run_thread = self._start_run_thread(
+                lambda:self.process_manager.run_tasks(
+                        message_queue=message_queue, 
+                        task_manager=task_manager), trial_ids)
+        if not async:
+            run_thread.join()
+
+    def _prepare_to_run(self, strategy, stage_name, incremental):
+        '''
+            Return the task_manager for the run and the ids of the trials it
+        processes.  Runs may overlap, but not on the same trials.
         '''
         if strategy is None or not isinstance(strategy, Strategy):
             strategy = self.current_strategy 
@@ -231,15 +331,46 @@ class Session(object):
         if strategy is None:
             raise NoCurrentStrategyError("You must supply a strategy or set the session's current strategy.")
             
+        running_trial_ids = self._get_running_trial_ids()
         self.process_manager.prepare_to_run_strategy(strategy, 
-                stage_name=stage_name)
-
-        self._run_thread = threading.Thread(
-                target=self.process_manager.run_tasks,
-                kwargs={'message_queue':message_queue})
-        self._run_thread.start()
-        if not async:
-            self._run_thread.join()
+                stage_name=stage_name, incremental=incremental)
+        task_manager = self.process_manager.task_manager
+        trial_ids = set([trial.trial_id for task in task_manager.tasks 
+                for trial in task.trials])
+        if trial_ids & running_trial_ids:
+            raise ResourceLockedError('Some of the marked trials are being processed by a run that is still in progress.')
+        return task_manager, trial_ids
+
+    def submit(self, strategy=None, stage_name=None, incremental=False,
+            message_queue=None):
+        '''
+            Like run(async=True) but returns a RunHandle, which can be used
+        to cancel the run and has a Future for each trial and stage the run
+        processes (see RunHandle.get_future).  Runs on other trials can be
+        submitted before this one is finished, each has its own tasks.
+        Inputs:
+            strategy: A Strategy object.  If not passed, 
+                    session.current_strategy will be used.
+            stage_name: If passed, only that stage will be run.
+            incremental: If True, only the tasks whose results are out of
+                    date are run.
+            message_queue: If passed, will be populated with run messages.
+        Returns:
+            A RunHandle
+        '''
+        if message_queue is None:
+            message_queue = multiprocessing.Queue()
+        task_manager, trial_ids = self._prepare_to_run(strategy, stage_name,
+                incremental)
+        handle = RunHandle(self.process_manager, task_manager.tasks, 
+                message_queue, task_manager=task_manager)
+        if incremental and task_manager.num_tasks == 0:
+            message_queue.put(('FINISHED_RUN', None))
+            handle._finish_run() # everything is already up to date.
+            return handle
+
+        self._start_run_thread(handle.run, trial_ids)
+        return handle
 
     def get_default_strategy(self):
         methods_used = {}
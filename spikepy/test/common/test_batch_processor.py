@@ -0,0 +1,128 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from spikepy.common.batch_processor import BatchProcessor, find_input_files,\
+        iter_chunks
+
+class FakeResource(object):
+    def __init__(self, data=None):
+        self.data = data
+
+class FakeTrial(object):
+    def __init__(self, origin):
+        self.origin = origin
+        self.trial_id = origin
+        self.display_name = os.path.basename(origin)
+        self.marked = True
+        self.raw = FakeResource(open(origin).read())
+        self.result = FakeResource()
+
+class FakeDataInterpreter(object):
+    def is_available(self, trials):
+        return all(trial.result.data is not None for trial in trials)
+
+    def write_data_file(self, trials, base_path):
+        fullpaths = []
+        for trial in trials:
+            fullpath = os.path.join(base_path, trial.display_name + '.out')
+            with open(fullpath, 'w') as ofile:
+                ofile.write(trial.result.data)
+            fullpaths.append(fullpath)
+        return fullpaths
+
+class FakePluginManager(object):
+    data_interpreters = {'Result':FakeDataInterpreter()}
+
+class FakeSession(object):
+    '''Opens text files as trials and "processes" them by upper-casing.'''
+    plugin_manager = FakePluginManager()
+
+    def __init__(self):
+        self.trials = []
+        self.max_trials = 0
+
+    def mark_all_trials(self, status=True):
+        for trial in self.trials:
+            trial.marked = status
+
+    def open_files(self, fullpaths):
+        new_trials = [FakeTrial(fullpath) for fullpath in fullpaths
+                if not fullpath.endswith('.bad')]
+        self.trials.extend(new_trials)
+        self.max_trials = max(self.max_trials, len(self.trials))
+        return new_trials
+
+    def run(self, strategy=None, message_queue=None):
+        for trial in self.trials:
+            if trial.marked and trial.raw.data != 'fail':
+                trial.result.data = trial.raw.data.upper()
+
+    def remove_trial(self, trial_id):
+        self.trials = [t for t in self.trials if t.trial_id != trial_id]
+
+
+class BatchProcessorTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.tmp_dir, 'input')
+        self.output_dir = os.path.join(self.tmp_dir, 'output')
+        os.makedirs(self.input_dir)
+        for i in range(7):
+            self.write_input('trial_%d.txt' % i, 'data %d' % i)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_input(self, filename, contents):
+        with open(os.path.join(self.input_dir, filename), 'w') as ofile:
+            ofile.write(contents)
+
+    def test_iter_chunks(self):
+        self.assertEqual(list(iter_chunks(iter(range(5)), 2)), 
+                [[0, 1], [2, 3], [4]])
+
+    def test_process(self):
+        self.write_input('trial_9.txt', 'fail')
+        self.write_input('trial_8.bad', 'unreadable')
+        fullpaths = find_input_files([os.path.join(self.input_dir, '*.txt'),
+                os.path.join(self.input_dir, '*')])
+        self.assertEqual(len(fullpaths), 9)
+
+        session = FakeSession()
+        processor = BatchProcessor(session, None, 'Result', self.output_dir,
+                trials_in_flight=3)
+        reports = []
+        summary = processor.process(iter(fullpaths), report=reports.append)
+        self.assertEqual(len(reports), 3)
+        self.assertEqual(session.max_trials, 3)
+        self.assertEqual(session.trials, [])
+        self.assertEqual(summary.num_files, 9)
+        self.assertEqual(summary.num_trials, 8)
+        self.assertEqual(summary.num_exported, 7)
+        self.assertEqual([f for f, reason in summary.failed_files], 
+                [os.path.join(self.input_dir, 'trial_8.bad')])
+        self.assertEqual([t for t, reason in summary.failed_trials], 
+                ['trial_9.txt'])
+        with open(os.path.join(self.output_dir, 'trial_2.txt.out')) as infile:
+            self.assertEqual(infile.read(), 'DATA 2')
+        self.assertTrue('trials/s' in summary.format_summary())
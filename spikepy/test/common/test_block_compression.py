@@ -0,0 +1,116 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import cPickle
+import gzip
+import io
+import time
+import unittest
+
+import numpy
+
+from spikepy.common import block_compression
+from spikepy.common.block_compression import codecs, compress, decompress,\
+        get_codec_name, find_codec_name, get_suffix, map_in_threads,\
+        write_gzip, GzipWriter
+
+def make_data(size):
+    # noisy traces compress about as well as recorded ones.
+    traces = numpy.cumsum(numpy.random.randint(-3, 4, size//8))
+    return traces.astype(numpy.float64).tostring()
+
+class BlockCompressionTests(unittest.TestCase):
+    def test_round_trip(self):
+        data = make_data(2**16)
+        for codec_name in codecs.keys():
+            for level in [1, 6, 9]:
+                compressed = compress(data, codec_name, level)
+                self.assertTrue(len(compressed) < len(data))
+                self.assertEqual(decompress(compressed, codec_name), data)
+
+    def test_codec_names(self):
+        self.assertEqual(get_codec_name('none'), None)
+        self.assertEqual(get_codec_name('zlib'), 'zlib')
+        self.assertEqual(get_suffix(None), '')
+        for codec_name in codecs.keys():
+            self.assertEqual(find_codec_name('a-0.npy%s' % 
+                    get_suffix(codec_name)), codec_name)
+        self.assertEqual(find_codec_name('a-0.npy'), None)
+
+    def test_missing_codec_falls_back_to_zlib(self):
+        saved_codecs = dict(codecs)
+        codecs.pop('lz4', None)
+        try:
+            self.assertEqual(get_codec_name('lz4'), 'zlib')
+        finally:
+            codecs.update(saved_codecs)
+
+    def test_map_in_threads(self):
+        for num_threads in [1, 4]:
+            self.assertEqual(map_in_threads(lambda x:x**2, xrange(10), 
+                    num_threads), [x**2 for x in range(10)])
+        self.assertEqual(map_in_threads(abs, [], 4), [])
+
+    def test_write_gzip(self):
+        saved_chunk_size = block_compression.GZIP_CHUNK_SIZE
+        block_compression.GZIP_CHUNK_SIZE = 1000
+        try:
+            for data in ['', make_data(10000)]:
+                ofile = io.BytesIO()
+                write_gzip(ofile, data, 6, 4)
+                ofile.seek(0)
+                self.assertEqual(gzip.GzipFile(fileobj=ofile).read(), data)
+        finally:
+            block_compression.GZIP_CHUNK_SIZE = saved_chunk_size
+
+    def test_gzip_writer(self):
+        saved_chunk_size = block_compression.GZIP_CHUNK_SIZE
+        block_compression.GZIP_CHUNK_SIZE = 1000
+        try:
+            value = {'data':make_data(10000), 'numbers':range(1000)}
+            for num_threads in [1, 4]:
+                ofile = io.BytesIO()
+                with GzipWriter(ofile, 6, num_threads) as writer:
+                    cPickle.dump(value, writer, protocol=-1)
+                ofile.seek(0)
+                self.assertEqual(cPickle.loads(gzip.GzipFile(
+                        fileobj=ofile).read()), value)
+        finally:
+            block_compression.GZIP_CHUNK_SIZE = saved_chunk_size
+
+def time_compression(data, codec_name, level, num_threads, block_size=2**22):
+    blocks = [data[i:i+block_size] for i in xrange(0, len(data), block_size)]
+    start = time.time()
+    compressed = map_in_threads(lambda block:compress(block, codec_name, 
+            level), blocks, num_threads)
+    compress_time = time.time() - start
+    start = time.time()
+    map_in_threads(lambda block:decompress(block, codec_name), compressed,
+            num_threads)
+    return (compress_time, time.time() - start, 
+            float(len(data))/sum(len(c) for c in compressed))
+
+if __name__ == '__main__':
+    data = make_data(2**27)
+    print '%6s %6s %8s %12s %14s %6s' % ('codec', 'level', 'threads', 
+            'compress(s)', 'decompress(s)', 'ratio')
+    for codec_name in sorted(codecs.keys()):
+        for level in [1, 6]:
+            for num_threads in [1, 4]:
+                times = time_compression(data, codec_name, level, 
+                        num_threads)
+                print '%6s %6d %8d %12.3f %14.3f %6.2f' % ((codec_name, 
+                        level, num_threads) + times)
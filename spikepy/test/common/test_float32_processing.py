@@ -0,0 +1,133 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from spikepy.common.trial_manager import Trial, format_traces
+from spikepy.common.lazy_traces import LazyTraces
+from spikepy.builtins.methods.filtering_fir.simple_fir import fir_filter
+from spikepy.builtins.methods.filtering_iir.simple_iir import butterworth
+from spikepy.builtins.methods.filtering_wavelets.wavelet import filt
+from spikepy.builtins.methods.detection_threshold.threshold_detection import\
+        threshold_detection
+from spikepy.builtins.methods.extraction_wavelet_coefficients import\
+        get_wavelet_coefficients
+from spikepy.utils.generate_spike_windows import generate_spike_windows
+
+SAMPLING_FREQ = 30000.0
+
+def make_traces(num_channels=3, num_samples=30000):
+    '''Noisy traces (in mV) with the same large spikes on every channel.'''
+    random_state = numpy.random.RandomState(1)
+    traces = random_state.normal(0.0, 0.02, size=(num_channels, num_samples))
+    spike_shape = -numpy.hanning(30)*0.5
+    for spike_index in range(1000, num_samples-1000, 2500):
+        traces[:, spike_index:spike_index+30] += spike_shape
+    return traces + 1.5 # an offset, removed by format_traces.
+
+def max_error(value_32, value_64):
+    '''The largest error relative to the largest float64 value.'''
+    value_64 = numpy.asarray(value_64)
+    return (numpy.max(numpy.abs(numpy.asarray(value_32, dtype=numpy.float64) -
+            value_64))/numpy.max(numpy.abs(value_64)))
+
+class Float32ProcessingTests(unittest.TestCase):
+    def setUp(self):
+        self.traces = make_traces()
+        self.traces_64 = format_traces(self.traces, dtype=numpy.float64)
+        self.traces_32 = format_traces(self.traces, dtype=numpy.float32)
+
+    def test_format_traces(self):
+        self.assertEqual(self.traces_32.dtype, numpy.float32)
+        self.assertTrue(max_error(self.traces_32, self.traces_64) < 1e-6)
+
+    def test_lazy_traces(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'traces.dat')
+            raw = numpy.round(self.traces*1000).astype('<i2')
+            with open(filename, 'wb') as ofile:
+                ofile.write(raw.tostring())
+            traces_64 = LazyTraces(filename, '<i2', raw.shape, scale=0.001)
+            traces_32 = format_traces(traces_64, dtype=numpy.float32)
+            self.assertEqual(traces_32.dtype, numpy.float32)
+            self.assertEqual(traces_32.nbytes, traces_64.nbytes/2)
+            self.assertEqual(numpy.asarray(traces_32).dtype, numpy.float32)
+            self.assertTrue(max_error(numpy.asarray(traces_32), 
+                    numpy.asarray(traces_64)) < 1e-6)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_times_stay_float64(self):
+        trial = Trial.from_raw_traces(SAMPLING_FREQ, self.traces_32)
+        self.assertEqual(trial.raw_times.dtype, numpy.float64)
+
+    def test_fir_filter(self):
+        kwargs = {'critical_freq':(300, 3000), 'kernel_window':'hamming',
+                'order':100, 'kind':'band pass'}
+        filtered_64 = fir_filter(self.traces_64, SAMPLING_FREQ, **kwargs)
+        filtered_32 = fir_filter(self.traces_32, SAMPLING_FREQ, **kwargs)
+        self.assertEqual(filtered_32.dtype, numpy.float32)
+        self.assertTrue(max_error(filtered_32, filtered_64) < 1e-5)
+
+    def test_iir_filter(self):
+        kwargs = {'critical_freq':(300, 3000), 'order':3, 'kind':'band',
+                'acausal':True}
+        filtered_64 = butterworth(self.traces_64, SAMPLING_FREQ, **kwargs)
+        filtered_32 = butterworth(self.traces_32, SAMPLING_FREQ, **kwargs)
+        self.assertEqual(filtered_32.dtype, numpy.float32)
+        self.assertTrue(max_error(filtered_32, filtered_64) < 1e-5)
+
+    def test_wavelet_filter(self):
+        filtered_64 = filt(self.traces_64, wavelet='db20')
+        filtered_32 = filt(self.traces_32, wavelet='db20')
+        self.assertEqual(filtered_32.dtype, numpy.float32)
+        self.assertTrue(max_error(filtered_32, filtered_64) < 1e-5)
+
+    def detect(self, traces):
+        return threshold_detection(traces, SAMPLING_FREQ, threshold_1=-5.0,
+                threshold_2=-10.0, threshold_units='standard deviation',
+                refractory_time=0.5, max_spike_duration=1.0)[0]
+
+    def test_detection(self):
+        events_64 = self.detect(self.traces_64)
+        events_32 = self.detect(self.traces_32)
+        self.assertEqual(len(events_64[0]), 12)
+        for channel_64, channel_32 in zip(events_64, events_32):
+            self.assertTrue(numpy.array_equal(channel_64, channel_32))
+
+    def test_extraction(self):
+        event_times = self.detect(self.traces_64)
+        kwargs = {'pre_padding':0.5, 'post_padding':1.0, 
+                'min_num_channels':3, 'peak_drift':0.3, 
+                'exclude_overlappers':False}
+        windows_64, times_64, _, _ = generate_spike_windows(self.traces_64,
+                SAMPLING_FREQ, event_times, **kwargs)
+        windows_32, times_32, _, _ = generate_spike_windows(self.traces_32,
+                SAMPLING_FREQ, event_times, **kwargs)
+        self.assertEqual(windows_32.dtype, numpy.float32)
+        self.assertTrue(numpy.array_equal(times_32, times_64))
+        self.assertTrue(max_error(windows_32, windows_64) < 1e-6)
+
+        coefficients_64 = get_wavelet_coefficients(windows_64, 'haar', 5)
+        coefficients_32 = get_wavelet_coefficients(windows_32, 'haar', 5)
+        self.assertEqual(coefficients_32.dtype, numpy.float32)
+        self.assertTrue(max_error(coefficients_32, coefficients_64) < 1e-5)
@@ -0,0 +1,74 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import cPickle
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from spikepy.common.lazy_traces import LazyTraces
+
+def centred(traces):
+    return traces - numpy.average(traces, axis=1)[:, numpy.newaxis]
+
+class LazyTracesTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'traces.dat')
+        # 1000 samples of 3 interleaved channels after a 7 byte header.
+        self.raw = numpy.random.randint(-2000, 2000, 
+                size=(1000, 3)).astype('<i2')
+        with open(self.filename, 'wb') as ofile:
+            ofile.write('header!')
+            ofile.write(self.raw.tostring())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_traces(self, **kwargs):
+        traces = LazyTraces(self.filename, '<i2', self.raw.shape, offset=7,
+                scale=0.5, channels_first=False, **kwargs)
+        traces.chunk_size = 64
+        return traces
+
+    def test_values(self):
+        traces = self.make_traces(channels=[2, 0], start=10, stop=910, 
+                step=3)
+        expected = centred(self.raw.T[[2, 0], 10:910:3]*0.5)
+        self.assertEqual(traces.shape, expected.shape)
+        self.assertEqual(len(traces), 2)
+        self.assertTrue(numpy.allclose(numpy.asarray(traces), expected))
+        self.assertTrue(numpy.allclose(traces[1], expected[1]))
+        self.assertTrue(numpy.allclose(traces[:, 5:20], expected[:, 5:20]))
+        self.assertAlmostEqual(traces[0, 7], expected[0, 7])
+        self.assertTrue(numpy.allclose(list(traces), expected))
+
+    def test_shape_doesnt_read(self):
+        traces = self.make_traces()
+        self.assertEqual(traces.shape, (3, 1000))
+        self.assertEqual(traces.nbytes, 3*1000*8)
+        self.assertTrue(traces._memmap is None)
+
+    def test_pickles_reference(self):
+        traces = self.make_traces(channels=[1])
+        pickled = cPickle.dumps(traces, protocol=-1)
+        self.assertTrue(len(pickled) < self.raw.nbytes/10)
+        unpickled = cPickle.loads(pickled)
+        self.assertTrue(numpy.allclose(numpy.asarray(unpickled), 
+                numpy.asarray(traces)))
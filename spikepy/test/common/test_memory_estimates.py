@@ -0,0 +1,49 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from spikepy.common.memory_estimates import MemoryEstimates
+
+class MemoryEstimatesTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'estimates.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_estimate(self):
+        estimates = MemoryEstimates()
+        self.assertEqual(estimates.estimate('a', 100), 
+                MemoryEstimates.default_multiplier*100)
+        megabyte = 2**20
+        estimates.update('a', 2*megabyte, megabyte)
+        estimates.update('a', 6*megabyte, megabyte)
+        self.assertAlmostEqual(estimates.estimate('a', 1000), 4000)
+        # tasks on tiny inputs teach nothing.
+        estimates.update('a', 500, 100)
+        self.assertAlmostEqual(estimates.multiplier('a'), 4.0)
+
+    def test_persists(self):
+        estimates = MemoryEstimates(self.filename)
+        estimates.update('a', 5*2**20, 2**20)
+        estimates.save()
+        estimates = MemoryEstimates(self.filename)
+        self.assertAlmostEqual(estimates.estimate('a', 10), 50)
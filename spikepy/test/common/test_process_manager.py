@@ -0,0 +1,111 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import Queue
+import threading
+import unittest
+
+from spikepy.common.process_manager import ProcessManager
+
+class FakePool(object):
+    def __init__(self):
+        self.cancelled_channels = []
+
+    def start(self):
+        pass
+
+    def new_channel(self):
+        return 'channel'
+
+    def cancel(self, channel):
+        self.cancelled_channels.append(channel)
+
+class BrokenTaskManager(object):
+    '''Fails when the run asks it for the first task.'''
+    num_tasks = 1
+    tasks = []
+
+    def __init__(self):
+        self.num_asked = 0
+
+    def get_plot_layout(self):
+        return {}
+
+    def pop_state_changes(self):
+        return {}
+
+    def get_next_task(self):
+        self.num_asked += 1
+        raise RuntimeError('broken')
+
+class WaitingTask(object):
+    task_id = 'waiting'
+
+class WaitingTaskManager(BrokenTaskManager):
+    '''Has one task, which never becomes ready.'''
+    def __init__(self):
+        BrokenTaskManager.__init__(self)
+        self.tasks = [WaitingTask()]
+
+    @property
+    def num_tasks(self):
+        return len(self.tasks)
+
+    def get_next_task(self):
+        self.num_asked += 1
+        return None
+
+    def remove_task(self, task):
+        self.tasks.remove(task)
+
+class RunTasksTests(unittest.TestCase):
+    def test_cleans_up_after_error(self):
+        pool = FakePool()
+        process_manager = ProcessManager(None, worker_pool=pool)
+        process_manager.task_manager = BrokenTaskManager()
+        message_queue = Queue.Queue()
+        self.assertRaises(RuntimeError, process_manager.run_tasks, 
+                message_queue)
+        self.assertEqual(process_manager._current_runs, {})
+        self.assertFalse(process_manager.cancel_run())
+        self.assertEqual(pool.cancelled_channels, ['channel'])
+        messages = []
+        while not message_queue.empty():
+            messages.append(message_queue.get())
+        self.assertEqual(messages[-1], ('FINISHED_RUN', None))
+
+    def test_run_keeps_its_task_manager(self):
+        '''A run isn't affected by preparing the next one.'''
+        process_manager = ProcessManager(None, worker_pool=FakePool())
+        process_manager.task_manager = BrokenTaskManager()
+        task_manager = BrokenTaskManager()
+        self.assertRaises(RuntimeError, process_manager.run_tasks, 
+                Queue.Queue(), task_manager=task_manager)
+        self.assertEqual(task_manager.num_asked, 1)
+        self.assertEqual(process_manager.task_manager.num_asked, 0)
+        self.assertFalse(process_manager.cancel_run(task_manager))
+
+    def test_cancelled_before_start(self):
+        process_manager = ProcessManager(None, worker_pool=FakePool())
+        task_manager = WaitingTaskManager()
+        cancel_event = threading.Event()
+        cancel_event.set()
+        done = []
+        process_manager.run_tasks(Queue.Queue(), 
+                on_task_done=lambda task, error:done.append(error),
+                task_manager=task_manager, cancel_event=cancel_event)
+        self.assertEqual(done, ['Cancelled: the run was cancelled.'])
+        self.assertEqual(task_manager.tasks, [])
@@ -0,0 +1,134 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import Queue
+import threading
+import time
+import unittest
+
+import numpy
+
+from spikepy.common import worker_pool
+from spikepy.common.remote_workers import RemoteWorkerPool, WorkerSlot,\
+        ChunkedSender, ChunkedReceiver
+
+def run_double(payload, resource_cache=None):
+    time.sleep(payload['kwargs'].get('sleep', 0.0))
+    return {'task_id':payload['task_id'], 'result':[payload['args'][0]*2],
+            'runtime':0.0}
+
+class ChunkedTransferTests(unittest.TestCase):
+    def test_chunks(self):
+        queue = Queue.Queue()
+        senders = [ChunkedSender(queue, chunk_size=100) for i in range(2)]
+        data = numpy.arange(1000)
+        senders[0].put({'data':data})
+        senders[1].put('small')
+        self.assertTrue(queue.qsize() > 2)
+        # interleave the pieces of the two messages.
+        chunks = []
+        while not queue.empty():
+            chunks.append(queue.get())
+        chunks.insert(1, chunks.pop())
+        for chunk in chunks:
+            queue.put(chunk)
+        receiver = ChunkedReceiver(queue)
+        self.assertEqual(receiver.get_nowait(), 'small')
+        self.assertTrue(numpy.all(receiver.get_nowait()['data'] == data))
+        self.assertRaises(Queue.Empty, receiver.get_nowait)
+
+
+class RemoteWorkerPoolTests(unittest.TestCase):
+    '''Runs a pool and two workers on localhost.'''
+    def setUp(self):
+        worker_pool.job_runners['double'] = run_double
+        self.pool = RemoteWorkerPool(address='127.0.0.1:0', authkey='secret',
+                chunk_size=1000)
+        self.pool.poll_interval = 0.1
+        self.pool.heartbeat_timeout = 2.0
+        self.pool.start()
+        self.slots = []
+        self.threads = []
+        for i in range(2):
+            self.add_slot()
+        deadline = time.time() + 30
+        while self.pool.num_workers < 2 and time.time() < deadline:
+            time.sleep(0.1)
+
+    def add_slot(self, authkey='secret'):
+        slot = WorkerSlot(self.pool.address, authkey, poll_interval=0.1,
+                heartbeat_interval=0.1)
+        thread = threading.Thread(target=slot.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.slots.append(slot)
+        self.threads.append(thread)
+
+    def tearDown(self):
+        self.pool.shutdown()
+        for slot in self.slots:
+            slot.stop()
+        for thread in self.threads:
+            thread.join()
+        del worker_pool.job_runners['double']
+
+    def submit(self, task_id, channel, **kwargs):
+        self.pool.submit('double', {'task_id':task_id, 
+                'args':[numpy.arange(500)*task_id], 'kwargs':kwargs,
+                'shared_memory_threshold':0}, channel)
+
+    def test_run_jobs(self):
+        self.add_slot(authkey='wrong') # can't join the pool.
+        time.sleep(0.5)
+        self.assertEqual(self.pool.num_workers, 2)
+        channel = self.pool.new_channel()
+        for task_id in range(6):
+            self.submit(task_id, channel, sleep=0.05)
+        results = [self.pool.get_result(channel) for i in range(6)]
+        self.assertEqual(sorted(r['task_id'] for r in results), range(6))
+        for result in results:
+            self.assertTrue(numpy.all(result['result'][0] ==
+                    numpy.arange(500)*result['task_id']*2))
+        self.assertEqual(len(set(r['telemetry']['pid'] for r in results)), 2)
+
+    def test_cancel(self):
+        channel = self.pool.new_channel()
+        for task_id in range(3):
+            self.submit(task_id, channel, sleep=60)
+        start_time = time.time()
+        self.pool.cancel(channel)
+        results = [self.pool.get_result(channel) for i in range(3)]
+        self.assertTrue(time.time() - start_time < 10)
+        self.assertEqual(sorted(r['error_type'] for r in results),
+                ['CancelledError']*3)
+
+        # the workers are still usable.
+        channel = self.pool.new_channel()
+        self.submit(7, channel)
+        self.assertEqual(self.pool.get_result(channel)['task_id'], 7)
+
+    def test_lost_worker(self):
+        channel = self.pool.new_channel()
+        self.submit(1, channel, sleep=60)
+        self.submit(2, channel, sleep=60)
+        for slot in self.slots:
+            slot.stop()
+        results = [self.pool.get_result(channel) for i in range(2)]
+        self.assertEqual([r['error_type'] for r in results], 
+                ['WorkerDiedError']*2)
+        self.assertEqual(self.pool.num_workers, 0)
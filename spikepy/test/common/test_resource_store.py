@@ -0,0 +1,127 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import cPickle
+import os
+import tempfile
+import shutil
+import unittest
+
+import numpy
+
+from spikepy.common.trial_manager import Resource
+from spikepy.common.task_manager import share_data
+from spikepy.common.resource_store import resource_store, SpilledData
+
+MEGABYTE = 2**20
+
+def make_array(value):
+    return numpy.ones(MEGABYTE/8)*value
+
+class ResourceStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # room for two of the arrays.
+        resource_store.configure(2.5*MEGABYTE, self.directory)
+
+    def tearDown(self):
+        resource_store.close()
+        shutil.rmtree(self.directory)
+
+    def test_spills_least_recently_used(self):
+        resources = [Resource('r%d' % i, data=make_array(i)) 
+                for i in range(3)]
+        self.assertTrue(isinstance(resources[0]._data, SpilledData))
+        self.assertEqual(resource_store.memory, 2*MEGABYTE)
+
+        resources[1].data # now r2 is the least recently used.
+        resources.append(Resource('r3', data=make_array(3)))
+        self.assertTrue(isinstance(resources[2]._data, SpilledData))
+        self.assertFalse(isinstance(resources[1]._data, SpilledData))
+
+        # spilled data is memory-mapped back in.
+        data = resources[0].data
+        self.assertTrue(isinstance(data, numpy.memmap))
+        self.assertTrue(numpy.array_equal(data, make_array(0)))
+        self.assertEqual(resource_store.memory, 2*MEGABYTE)
+
+        # small or non-array data is left alone.
+        small = Resource('small', data=numpy.ones(10))
+        other = Resource('other', data=[make_array(4)])
+        self.assertEqual(resource_store.memory, 2*MEGABYTE)
+
+    def test_locked_resources_stay(self):
+        locked = Resource('locked', data=make_array(0))
+        checkout_info = locked.checkout()
+        others = [Resource('r%d' % i, data=make_array(i)) for i in range(3)]
+        self.assertFalse(isinstance(locked._data, SpilledData))
+        self.assertTrue(checkout_info['data'] is locked._data)
+
+        # once checked in it is spilled like any other.
+        locked.checkin(key=checkout_info['locking_key'])
+        others.append(Resource('r3', data=make_array(3)))
+        self.assertTrue(isinstance(locked._data, SpilledData))
+        self.assertTrue(numpy.array_equal(locked.data, make_array(0)))
+
+    def test_checkin_replaces_spilled_file(self):
+        resource = Resource('r', data=make_array(0))
+        others = [Resource('r%d' % i, data=make_array(i)) for i in range(2)]
+        filename = resource._data.filename
+        self.assertTrue(os.path.exists(filename))
+
+        checkout_info = resource.checkout()
+        self.assertTrue(numpy.array_equal(checkout_info['data'], 
+                make_array(0)))
+        resource.checkin(data_dict={'data':make_array(5), 
+                'change_info':{'by':'test', 'with':{}, 'using':[]}},
+                key=checkout_info['locking_key'])
+        self.assertFalse(os.path.exists(filename))
+        self.assertTrue(numpy.array_equal(resource.data, make_array(5)))
+
+    def test_deleted_resources_remove_files(self):
+        resources = [Resource('r%d' % i, data=make_array(i)) 
+                for i in range(3)]
+        filename = resources[0]._data.filename
+        del resources
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(resource_store.memory, 0)
+
+    def test_shared_buffers(self):
+        array = make_array(0)
+        resource = Resource('r', data=array)
+        alias = Resource('alias', data=share_data(array))
+        self.assertEqual(resource_store.memory, MEGABYTE)
+
+        # the views are spilled together, into one file.
+        others = [Resource('r%d' % i, data=make_array(i)) 
+                for i in range(1, 3)]
+        self.assertTrue(isinstance(resource._data, SpilledData))
+        self.assertTrue(isinstance(alias._data, SpilledData))
+        filename = resource._data.filename
+        self.assertEqual(alias._data.filename, filename)
+        self.assertEqual(resource_store.memory, 2*MEGABYTE)
+        self.assertTrue(numpy.array_equal(alias.data, make_array(0)))
+
+        del resource
+        self.assertTrue(os.path.exists(filename))
+        del alias
+        self.assertFalse(os.path.exists(filename))
+
+    def test_pickle(self):
+        resources = [Resource('r%d' % i, data=make_array(i)) 
+                for i in range(3)]
+        unpickled = cPickle.loads(cPickle.dumps(resources[0], protocol=-1))
+        self.assertTrue(numpy.array_equal(unpickled.data, make_array(0)))
@@ -0,0 +1,75 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from spikepy.common.result_cache import ResultCache
+
+class ResultCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store_and_lookup(self):
+        cache = ResultCache(self.directory, 2**20)
+        self.assertEqual(cache.lookup('a'), None)
+        cache.store('a', [1, 2, 3])
+        self.assertTrue('a' in cache)
+        self.assertEqual(cache.lookup('a'), [1, 2, 3])
+
+    def test_persists(self):
+        cache = ResultCache(self.directory, 2**20)
+        cache.store('a', 'some result')
+        new_cache = ResultCache(self.directory, 2**20)
+        self.assertEqual(new_cache.lookup('a'), 'some result')
+        self.assertEqual(new_cache.total_size, cache.total_size)
+
+    def test_lru_eviction(self):
+        item = 'x'*1000
+        cache = ResultCache(self.directory, 2500)
+        cache.store('a', item)
+        cache.store('b', item)
+        cache.lookup('a') # 'b' is now the least recently used.
+        cache.store('c', item)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertTrue('c' in cache)
+        self.assertTrue(cache.total_size <= 2500)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+    def test_too_big(self):
+        cache = ResultCache(self.directory, 10)
+        cache.store('a', 'x'*1000)
+        self.assertFalse('a' in cache)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_store_later(self):
+        cache = ResultCache(self.directory, 2**20)
+        cache.store_later('a', [1, 2, 3])
+        cache.store_later('a', [1, 2, 3])
+        # found before and after it is written.
+        self.assertEqual(cache.lookup('a'), [1, 2, 3])
+        cache.flush()
+        self.assertEqual(cache.lookup('a'), [1, 2, 3])
+        self.assertEqual(ResultCache(self.directory, 2**20).lookup('a'), 
+                [1, 2, 3])
@@ -0,0 +1,125 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import threading
+import unittest
+
+from spikepy.common.run_handle import Future, RunHandle
+from spikepy.common.errors import *
+
+class FakeTrial(object):
+    def __init__(self, trial_id):
+        self.trial_id = trial_id
+
+class FakeStep(object):
+    def __init__(self, plugin_category, trials):
+        self.plugin_category = plugin_category
+        self.trials = trials
+
+class FakeTask(object):
+    def __init__(self, steps):
+        self.steps = steps
+
+class FakeProcessManager(object):
+    '''Finishes the tasks it is given with the errors it is given.'''
+    def __init__(self, tasks, errors):
+        self.tasks = tasks
+        self.errors = errors
+        self.cancelled = False
+
+    def run_tasks(self, message_queue=None, on_task_done=None, 
+            task_manager=None, cancel_event=None):
+        self.cancel_event = cancel_event
+        for task, error in zip(self.tasks, self.errors):
+            on_task_done(task, error)
+
+    def cancel_run(self, task_manager=None):
+        self.cancelled = True
+
+
+class FutureTests(unittest.TestCase):
+    def test_result(self):
+        future = Future()
+        called = []
+        future.add_done_callback(called.append)
+        self.assertFalse(future.done())
+        self.assertRaises(RuntimeError, future.result, 0.01)
+        threading.Timer(0.05, future.set_result, [5]).start()
+        self.assertEqual(future.result(timeout=5), 5)
+        self.assertEqual(called, [future])
+        # callbacks added after the future is done are called right away.
+        future.add_done_callback(called.append)
+        self.assertEqual(len(called), 2)
+
+    def test_exception(self):
+        future = Future()
+        future.set_exception(TaskFailedError('failed'))
+        self.assertRaises(TaskFailedError, future.result)
+        self.assertTrue(isinstance(future.exception(), TaskFailedError))
+        self.assertFalse(future.cancel())
+
+    def test_cancel(self):
+        future = Future()
+        self.assertTrue(future.cancel())
+        self.assertTrue(future.cancelled())
+        self.assertRaises(RunCancelledError, future.result)
+        future.set_result(5) # ignored.
+        self.assertTrue(future.cancelled())
+
+
+class RunHandleTests(unittest.TestCase):
+    def setUp(self):
+        self.trials = [FakeTrial(i) for i in range(3)]
+        self.filter_task = FakeTask([FakeStep('Detection Filter', 
+                self.trials[:2])])
+        self.detect_tasks = [FakeTask([FakeStep('Detection', [t])]) 
+                for t in self.trials]
+        self.pooled_task = FakeTask([FakeStep('Clustering', self.trials)])
+
+    def test_futures(self):
+        tasks = [self.filter_task] + self.detect_tasks + [self.pooled_task]
+        errors = [None, None, 'Traceback...', 'Cancelled: the run was '
+                'cancelled.', 'Cancelled: Detection failed.']
+        handle = RunHandle(FakeProcessManager(tasks, errors), tasks, None)
+        future = handle.get_future(self.trials[0], 'Detection Filter')
+        self.assertFalse(future.done())
+        handle.run()
+        self.assertTrue(future.result() is self.trials[0])
+        self.assertTrue(handle.get_future(0, 'Detection').result() is 
+                self.trials[0])
+        self.assertRaises(TaskFailedError, 
+                handle.get_future(1, 'Detection').result)
+        self.assertTrue(handle.get_future(2, 'Detection').cancelled())
+        self.assertTrue(handle.get_future(0, 'Clustering').cancelled())
+        self.assertRaises(KeyError, handle.get_future, 2, 'Detection Filter')
+        self.assertTrue(handle.done())
+        self.assertEqual(handle.result(), self.trials)
+        self.assertFalse(handle.cancel())
+
+    def test_unfinished_tasks_are_cancelled(self):
+        tasks = [self.filter_task, self.pooled_task]
+        process_manager = FakeProcessManager(tasks[:1], [None])
+        handle = RunHandle(process_manager, tasks, None)
+        self.assertTrue(handle.cancel())
+        self.assertTrue(process_manager.cancelled)
+        self.assertTrue(handle.wait(timeout=0.01) is False)
+        handle.run()
+        # cancelled before it started, the run is cancelled once it does.
+        self.assertTrue(process_manager.cancel_event.is_set())
+        self.assertTrue(handle.get_future(0, 'Clustering').cancelled())
+        self.assertFalse(handle.get_future(0, 'Detection Filter').cancelled())
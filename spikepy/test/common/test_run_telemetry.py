@@ -0,0 +1,109 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+from spikepy.common.run_telemetry import RunTelemetry, get_serialized_size
+
+class FakePlugin(object):
+    def __init__(self, name):
+        self.name = name
+
+class FakeTask(object):
+    def __init__(self, task_id, plugin_names, num_trials=1):
+        self.task_id = task_id
+        self.trials = range(num_trials)
+        self.steps = [FakeStep(name) for name in plugin_names]
+        self.name = '+'.join(plugin_names)
+
+    def __str__(self):
+        return 'Task: %s' % self.name
+
+class FakeStep(object):
+    def __init__(self, plugin_name):
+        self.plugin = FakePlugin(plugin_name)
+
+def make_result(telemetry, start, runtime, **kwargs):
+    measurements = {'start_time':telemetry.base_time + start,
+            'end_time':telemetry.base_time + start + runtime, 'pid':1234,
+            'peak_rss':2**20, 'input_bytes':100, 'output_bytes':10}
+    result = {'result':[1], 'telemetry':measurements}
+    result.update(kwargs)
+    return result
+
+class RunTelemetryTests(unittest.TestCase):
+    def setUp(self):
+        self.telemetry = RunTelemetry()
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_tasks(self):
+        telemetry = self.telemetry
+        single = FakeTask(1, ['filter'])
+        fused = FakeTask(2, ['filter', 'detect'])
+        cached = FakeTask(3, ['detect'])
+        for task in [single, fused]:
+            telemetry.task_enqueued(task)
+        telemetry.task_cached(cached)
+        telemetry.task_finished(single, make_result(telemetry, 0.5, 1.0))
+        telemetry.task_finished(fused, make_result(telemetry, 1.0, 3.0,
+                step_runtimes=[1.0, 2.0]))
+        telemetry.finish()
+
+    def test_serialized_size(self):
+        array = numpy.arange(10, dtype=numpy.float64)
+        self.assertEqual(get_serialized_size([array, (array, None)]), 160)
+        self.assertTrue(get_serialized_size('a string') > 0)
+
+    def test_summary(self):
+        self.run_tasks()
+        summary = dict((row['plugin'], row)
+                for row in self.telemetry.get_summary())
+        self.assertEqual(summary['filter']['num_tasks'], 2)
+        self.assertAlmostEqual(summary['filter']['total_runtime'], 2.0)
+        # the fused task's input counts against its first step only.
+        self.assertEqual(summary['filter']['input_bytes'], 200)
+        self.assertEqual(summary['detect']['input_bytes'], 0)
+        self.assertEqual(summary['detect']['output_bytes'], 10)
+        self.assertEqual(summary['detect']['num_cached'], 1)
+        self.assertEqual(summary['detect']['peak_rss'], 2**20)
+        self.assertTrue('filter' in self.telemetry.format_summary())
+
+    def test_save_trace(self):
+        self.run_tasks()
+        filename = os.path.join(self.tmp_dir, 'trace', 'run.json')
+        self.telemetry.save_trace(filename)
+        with open(filename) as infile:
+            events = json.load(infile)['traceEvents']
+        slices = [e for e in events if e['ph'] == 'X']
+        # two tasks, plus the two steps of the fused task.
+        self.assertEqual(len(slices), 4)
+        self.assertEqual(set(e['pid'] for e in slices), set([1234]))
+        self.assertEqual(len([e for e in events if e['ph'] == 'b']), 2)
+        self.assertEqual(len([e for e in events if e['ph'] == 'i']), 1)
+        single = [e for e in slices if e['name'] == 'filter' and
+                e['cat'] == 'task'][0]
+        self.assertEqual(single['dur'], 1000000)
@@ -0,0 +1,61 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from spikepy.common.runtime_estimates import RuntimeEstimates
+
+class RuntimeEstimatesTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'estimates.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_estimate(self):
+        estimates = RuntimeEstimates()
+        self.assertEqual(estimates.estimate('a'), 1.0)
+        estimates.update('a', 2.0)
+        estimates.update('a', 4.0)
+        self.assertAlmostEqual(estimates.estimate('a'), 3.0)
+        # pooled tasks are recorded per-trial.
+        estimates.update('b', 10.0, num_trials=10)
+        self.assertAlmostEqual(estimates.estimate('b', num_trials=4), 4.0)
+        # unknown plugins get the average.
+        self.assertAlmostEqual(estimates.estimate('c'), 2.0)
+
+    def test_follows_recent_runs(self):
+        estimates = RuntimeEstimates()
+        for i in range(100):
+            estimates.update('a', 1.0)
+        for i in range(RuntimeEstimates.max_history*3):
+            estimates.update('a', 5.0)
+        self.assertTrue(estimates.estimate('a') > 4.5)
+
+    def test_persists(self):
+        estimates = RuntimeEstimates(self.filename)
+        estimates.update('a', 2.0)
+        estimates.save()
+        estimates = RuntimeEstimates(self.filename)
+        self.assertTrue('a' in estimates)
+        self.assertAlmostEqual(estimates.estimate('a'), 2.0)
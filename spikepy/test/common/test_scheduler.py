@@ -1,7 +1,11 @@
 import unittest
 import uuid
+import heapq
+import random
+import time
 
-from spikepy.common.scheduler import Scheduler, Operation, OperationError
+from spikepy.common.scheduler import Scheduler, Operation, OperationError,\
+        SchedulerError
 from spikepy.common import scheduler
 
 class OperationTests(unittest.TestCase):
@@ -138,6 +142,36 @@ class OperationFunctionsTests(unittest.TestCase):
         self.assertEqual(output, desired_output)
         self.assertEqual(self.operations, cleared_input)
 
+    def test_clear_impossible_chain(self):
+        # f is impossible, so g (which needs f's output) is too.
+        f = Operation([7], [8], 'f')
+        g = Operation([8, 1], [9], 'g')
+        operations = self.operations.union([f, g])
+        output = scheduler.clear_impossible_operations(operations)
+        self.assertEqual(output, set([self.b, self.c, self.e, f, g]))
+
+    def test_build_graph(self):
+        '''build_graph is clear_impossible_operations + point_operations.'''
+        random.seed(1)
+        for i in range(20):
+            operations = build_random_operations(30)
+            expected_ops = set(Operation(op.inputs, op.outputs, op.name)
+                    for op in operations)
+            expected_impossible = reference_clear_impossible(expected_ops)
+            scheduler.point_operations(expected_ops)
+
+            impossible = scheduler.build_graph(operations)
+            self.assertEqual(sorted(op.name for op in impossible),
+                    sorted(op.name for op in expected_impossible))
+            self.assertEqual(get_edges(operations), get_edges(expected_ops))
+
+    def test_find_downstream_operations(self):
+        scheduler.point_operations(self.operations)
+        fn = scheduler.find_downstream_operations
+        self.assertEqual(fn(self.a), set([self.b, self.c, self.d, self.e]))
+        self.assertEqual(fn(self.d), set([self.e]))
+        self.assertEqual(fn(self.e), set())
+
     def test_find_ready_operations(self):
         fn = scheduler.find_ready_operations
         self.assertEqual(fn(self.operations), self.operations)
@@ -152,6 +186,19 @@ class OperationFunctionsTests(unittest.TestCase):
         self.b.point_at(self.a)
         self.assertEqual(fn(self.operations), set())
 
+    def test_find_critical_path_lengths(self):
+        scheduler.point_operations(self.operations)
+        lengths = scheduler.find_critical_path_lengths(self.operations)
+        self.assertEqual(lengths, {self.a:4.0, self.b:3.0, self.c:2.0,
+                self.d:2.0, self.e:1.0})
+
+        costs = {self.a:1.0, self.b:1.0, self.c:1.0, self.d:5.0, self.e:1.0}
+        lengths = scheduler.find_critical_path_lengths(self.operations,
+                cost=costs.get)
+        self.assertEqual(lengths[self.d], 6.0)
+        self.assertEqual(lengths[self.b], 3.0)
+        self.assertEqual(lengths[self.a], 7.0)
+
     def test_find_ready_lists(self):
         desired_output = [list(self.operations)]
         output = scheduler.find_ready_sets(self.operations)
@@ -176,3 +223,427 @@ class OperationFunctionsTests(unittest.TestCase):
 
         
 
+
+
+def reference_clear_impossible(operations):
+    '''The original clear_impossible_operations, which rescans every pass.'''
+    impossible_operations = set()
+    while True:
+        tio = scheduler.find_impossible_operations(operations)
+        impossible_operations.update(tio)
+        if not tio:
+            return impossible_operations
+        for io in tio:
+            operations.remove(io)
+
+def build_random_operations(num_operations, num_xputs=20):
+    '''Return a set of operations with random inputs and outputs.'''
+    operations = set()
+    originated = set()
+    for i in range(num_operations):
+        inputs = random.sample(range(num_xputs), random.randint(0, 3))
+        outputs = random.sample(range(num_xputs), random.randint(0, 3))
+        # at most one originator per output.
+        outputs = [o for o in outputs if o in inputs or o not in originated]
+        originated.update(o for o in outputs if o not in inputs)
+        operations.add(Operation(inputs, outputs, 'op%d' % i))
+    return operations
+
+def get_edges(operations):
+    return set((op.name, other.name) for op in operations 
+            for other in op.points_at)
+
+def build_multi_trial_operations(num_trials, aux_cost=3.0, pool_cost=None):
+    '''
+        Return (operations, costs, root_outputs) for a session with
+    <num_trials> trials.  Each trial is detected and then extracted, the 
+    extractions of all the trials are then pooled for clustering.  Every trial
+    also has an auxiliary task that nothing else depends on.  The auxiliary 
+    tasks are added first, so FIFO ordering starts them first.
+    '''
+    if pool_cost is None:
+        pool_cost = float(num_trials)
+    operations = []
+    costs = {}
+    root_outputs = []
+    for i in range(num_trials):
+        root_outputs.append(('raw', i))
+        op = Operation([('raw', i)], [('aux', i)], 'a%d' % i)
+        operations.append(op)
+        costs[op] = aux_cost
+    for i in range(num_trials):
+        op = Operation([('raw', i)], [('det', i)], 'd%d' % i)
+        operations.append(op)
+        costs[op] = 1.0
+        op = Operation([('det', i)], [('ext', i)], 'e%d' % i)
+        operations.append(op)
+        costs[op] = 1.0
+    op = Operation([('ext', i) for i in range(num_trials)], ['clusters'], 'c')
+    operations.append(op)
+    costs[op] = pool_cost
+    return operations, costs, root_outputs
+
+def simulate_makespan(num_trials, num_workers, policy):
+    '''
+        Run the operations of a session with <num_trials> trials (see 
+    build_multi_trial_operations) through a Scheduler using <num_workers> 
+    simulated workers and return the time at which the last one finished.
+    '''
+    operations, costs, root_outputs = build_multi_trial_operations(
+            num_trials)
+    s = Scheduler(policy=policy, cost=lambda op:costs.get(op, 0.0))
+    for op in operations:
+        s.add_operation(op)
+    s.set_root_outputs(root_outputs)
+
+    now = 0.0
+    running = [] # heap of (finish_time, name, operation)
+    while s.operations:
+        op = s.get_next_operation()
+        while op is not None and len(running) < num_workers:
+            s.start_operation(op)
+            heapq.heappush(running, (now + costs[op], op.name, op))
+            op = s.get_next_operation()
+        now, name, op = heapq.heappop(running)
+        s.finish_operation(op)
+    return now
+
+
+class SchedulingPolicyTests(unittest.TestCase):
+    def setUp(self):
+        self.operations, self.costs, self.root_outputs =\
+                build_multi_trial_operations(2)
+
+    def ready_names(self, policy):
+        s = Scheduler(policy=policy, cost=lambda op:self.costs.get(op, 0.0))
+        for op in self.operations:
+            s.add_operation(op)
+        s.set_root_outputs(self.root_outputs)
+        return [op.name for op in s.get_ready_operations()]
+
+    def test_unknown_policy(self):
+        self.assertRaises(SchedulerError, Scheduler, policy='lifo')
+
+    def test_fifo(self):
+        self.assertEqual(self.ready_names('fifo'), ['a0', 'a1', 'd0', 'd1'])
+
+    def test_critical_path(self):
+        # d -> e -> c is 1 + 1 + 2, longer than the auxiliary tasks.
+        self.assertEqual(self.ready_names('critical_path'), 
+                ['d0', 'd1', 'a0', 'a1'])
+
+    def test_random(self):
+        self.assertEqual(sorted(self.ready_names('random')), 
+                ['a0', 'a1', 'd0', 'd1'])
+
+
+class CountingScheduler(Scheduler):
+    '''A Scheduler that counts the checks for busy inputs/outputs.'''
+    def __init__(self, *args, **kwargs):
+        self.num_steps = 0
+        Scheduler.__init__(self, *args, **kwargs)
+
+    def _find_busy_xput(self, operation):
+        self.num_steps += 1
+        return Scheduler._find_busy_xput(self, operation)
+
+
+class CountingHeapq(object):
+    '''Stands in for the heapq module, counting pushes and pops.'''
+    def __init__(self, counter):
+        self.counter = counter
+
+    def heappush(self, heap, item):
+        self.counter.num_steps += 1
+        heapq.heappush(heap, item)
+
+    def heappop(self, heap):
+        self.counter.num_steps += 1
+        return heapq.heappop(heap)
+
+
+class ReadyQueueTests(unittest.TestCase):
+    def test_next_operation(self):
+        a = Operation([0], [1], 'a')
+        b = Operation([1], [2], 'b')
+        c = Operation([0], [3], 'c')
+        s = Scheduler(policy='fifo')
+        for op in [a, b, c]:
+            s.add_operation(op)
+        s.set_root_outputs([0])
+
+        self.assertEqual(s.get_next_operation(), a)
+        # stays ready until it is started.
+        self.assertEqual(s.get_next_operation(), a)
+        s.start_operation(a)
+        self.assertEqual(s.get_next_operation(), c)
+        s.start_operation(c)
+        self.assertEqual(s.get_next_operation(), None)
+        s.finish_operation(a)
+        self.assertEqual(s.get_ready_operations(), [b])
+        s.start_operation(b)
+        s.finish_operation(b)
+        s.finish_operation(c)
+        self.assertEqual(s.get_next_operation(), None)
+        self.assertEqual(s.operations, set())
+
+    def test_shared_modifications_held_back(self):
+        # both modify 1, so they must not run at the same time.
+        a = Operation([1], [1], 'a')
+        b = Operation([1], [1, 2], 'b')
+        s = Scheduler(policy='fifo')
+        for op in [a, b]:
+            s.add_operation(op)
+        s.set_root_outputs([1])
+
+        self.assertEqual(s.get_ready_operations(), [a, b])
+        s.start_operation(a)
+        self.assertEqual(s.get_next_operation(), None)
+        self.assertEqual(s.get_ready_operations(), [])
+        s.finish_operation(a)
+        self.assertEqual(s.get_next_operation(), b)
+
+    def run_schedule(self, num_trials, s):
+        operations, costs, root_outputs = build_multi_trial_operations(
+                num_trials)
+        for op in operations:
+            s.add_operation(op)
+        s.set_root_outputs(root_outputs)
+        s.get_next_operation() # builds the graph.
+
+        start_time = time.time()
+        while s.operations:
+            started = []
+            op = s.get_next_operation()
+            while op is not None:
+                s.start_operation(op)
+                started.append(op)
+                op = s.get_next_operation()
+            for op in started:
+                s.finish_operation(op)
+        return len(operations), time.time() - start_time
+
+    def time_schedule(self, num_trials):
+        return self.run_schedule(num_trials, Scheduler())[1]
+
+    def count_steps_per_operation(self, num_trials):
+        '''
+            Return how many times (per operation) the ready queue is pushed
+        or popped and an operation is checked for busy inputs/outputs.
+        '''
+        counter = CountingScheduler()
+        heap = CountingHeapq(counter)
+        scheduler.heapq = heap
+        try:
+            num_operations = self.run_schedule(num_trials, counter)[0]
+        finally:
+            scheduler.heapq = heapq
+        return float(counter.num_steps)/num_operations
+
+    def test_cost_per_operation_does_not_grow(self):
+        small = self.count_steps_per_operation(50)
+        large = self.count_steps_per_operation(400)
+        # each operation is pushed, popped and checked about once.  A 
+        #   scheduler that rescans the operations does more steps for each
+        #   one as the session grows.
+        self.assertTrue(large < 4)
+        self.assertTrue(large <= 1.1*small)
+
+
+class PlotLayoutTests(unittest.TestCase):
+    def setUp(self):
+        self.a = Operation([0], [1], 'a')
+        self.b = Operation([1], [2], 'b')
+        self.s = Scheduler(policy='fifo')
+        for op in [self.a, self.b]:
+            self.s.add_operation(op)
+        self.s.set_root_outputs([0])
+
+    def test_layout_computed_once(self):
+        layout = self.s.get_plot_layout()
+        self.assertEqual(sorted(layout['operation_names']), 
+                ['Root', 'a', 'b'])
+        self.assertEqual(len(layout['link_list']), 
+                len(layout['link_sources']))
+        self.s.start_operation(self.a)
+        self.assertTrue(self.s.get_plot_layout() is layout)
+
+    def test_state_changes(self):
+        s = self.s
+        names = s.get_plot_layout()['operation_names']
+        index = dict((name, i) for i, name in enumerate(names))
+        s.pop_state_changes()
+
+        s.start_operation(self.a)
+        self.assertEqual(s.pop_state_changes(), {index['a']:'started'})
+        self.assertEqual(s.pop_state_changes(), {})
+        # only the latest state of each operation is reported.
+        s.finish_operation(self.a)
+        s.start_operation(self.b)
+        s.finish_operation(self.b)
+        self.assertEqual(s.pop_state_changes(), 
+                {index['a']:'finished', index['b']:'finished'})
+
+    def test_plot_dict(self):
+        s = self.s
+        names = s.get_plot_layout()['operation_names']
+        s.start_operation(self.a)
+        plot_dict = s.get_plot_dict()
+        facecolors = plot_dict['node_info']['kwargs']['facecolors']
+        self.assertEqual(facecolors[names.index('a')], 'cyan')
+        self.assertEqual(facecolors[names.index('b')], 'white')
+        self.assertEqual(facecolors[names.index('Root')], 'black')
+        # the layout itself isn't colored.
+        self.assertFalse('facecolors' in 
+                s.get_plot_layout()['node_info']['kwargs'])
+
+
+def build_session_operations(num_trials):
+    '''
+        Return (operations, root_outputs) resembling a full session: per-trial
+    filtering, a modifying auxiliary stage, detection and extraction, all
+    pooled into a single clustering operation.  There are 5 operations per 
+    trial.
+    '''
+    operations = []
+    root_outputs = []
+    for i in range(num_trials):
+        root_outputs.append(('pf_traces', i))
+        operations.append(Operation([('pf_traces', i)], [('df_traces', i)]))
+        operations.append(Operation([('df_traces', i)], [('df_traces', i)]))
+        operations.append(Operation([('df_traces', i)], [('events', i)]))
+        operations.append(Operation([('df_traces', i), ('events', i)], 
+                [('features', i)]))
+        operations.append(Operation([('events', i)], [('events', i), 
+                ('event_rate', i)]))
+    operations.append(Operation([('features', i) for i in range(num_trials)],
+            [('clusters', i) for i in range(num_trials)]))
+    return operations, root_outputs
+
+
+class GraphConstructionBenchmark(unittest.TestCase):
+    '''
+        Checks that constructing the dependency graph takes the same number
+    of steps per operation for large sessions as for small ones.  Run this
+    module directly to see the times for up to 10^4 operations.
+    '''
+    def time_construction(self, num_trials):
+        operations, root_outputs = build_session_operations(num_trials)
+        s = Scheduler()
+        for op in operations:
+            s.add_operation(op)
+        s.set_root_outputs(root_outputs)
+        start_time = time.time()
+        s.get_next_operation() # builds the graph.
+        return time.time() - start_time
+
+    def count_steps_per_operation(self, num_trials):
+        '''
+            Return how many operations (per operation) are indexed by 
+        find_xputs and how many dependencies are generated while the graph
+        is built.
+        '''
+        counts = {'steps':0}
+        def counting_find_xputs(operations):
+            counts['steps'] += len(operations)
+            return find_xputs(operations)
+        def counting_iter_dependencies(xputs):
+            for dependency in iter_dependencies(xputs):
+                counts['steps'] += 1
+                yield dependency
+        find_xputs = scheduler.find_xputs
+        iter_dependencies = scheduler.iter_dependencies
+        scheduler.find_xputs = counting_find_xputs
+        scheduler.iter_dependencies = counting_iter_dependencies
+        try:
+            operations, root_outputs = build_session_operations(num_trials)
+            s = Scheduler()
+            for op in operations:
+                s.add_operation(op)
+            s.set_root_outputs(root_outputs)
+            s.get_next_operation() # builds the graph.
+        finally:
+            scheduler.find_xputs = find_xputs
+            scheduler.iter_dependencies = iter_dependencies
+        return float(counts['steps'])/len(operations)
+
+    def test_construction_is_linear(self):
+        small = self.count_steps_per_operation(20)
+        large = self.count_steps_per_operation(200)
+        # a builder that rescans the operations (or compares every pair of
+        #   them) does more steps for each one as the session grows.
+        self.assertTrue(large <= 1.1*small)
+
+    def test_graph(self):
+        operations, root_outputs = build_session_operations(2)
+        s = Scheduler()
+        for op in operations:
+            s.add_operation(op)
+        s.set_root_outputs(root_outputs)
+        self.assertEqual(len(s.get_ready_operations()), 2)
+        self.assertEqual(s.impossible_operations, set())
+        # the pooled operation waits on every trial's extraction.
+        pooled = operations[-1]
+        self.assertEqual(len(pooled.is_pointed_at_by), 2)
+
+
+class MakespanBenchmark(unittest.TestCase):
+    '''
+        Compares the simulated time to run a multi-trial session for the 
+    different scheduling policies.  Run this module directly to see the
+    makespans.
+    '''
+    num_workers = 4
+
+    def get_makespans(self, num_trials, num_random_runs=20):
+        makespans = {}
+        for policy in ['critical_path', 'fifo']:
+            makespans[policy] = simulate_makespan(num_trials, 
+                    self.num_workers, policy)
+        random.seed(0)
+        random_makespans = [simulate_makespan(num_trials, self.num_workers, 
+                'random') for i in range(num_random_runs)]
+        makespans['random'] = sum(random_makespans)/len(random_makespans)
+        return makespans
+
+    def test_critical_path_is_fastest(self):
+        for num_trials in [8, 32]:
+            makespans = self.get_makespans(num_trials)
+            self.assertTrue(makespans['critical_path'] < makespans['fifo'])
+            self.assertTrue(makespans['critical_path'] < 
+                    makespans['random'])
+
+    def test_critical_path_lower_bound(self):
+        # all work spread evenly over the workers, or the longest chain.
+        num_trials = 32
+        operations, costs, root_outputs = build_multi_trial_operations(
+                num_trials)
+        lower_bound = max(sum(costs.values())/self.num_workers, 
+                2.0 + num_trials)
+        makespan = simulate_makespan(num_trials, self.num_workers, 
+                'critical_path')
+        self.assertTrue(makespan <= 1.25*lower_bound)
+
+
+if __name__ == '__main__':
+    benchmark = GraphConstructionBenchmark('test_construction_is_linear')
+    print '%10s %10s' % ('operations', 'seconds')
+    for num_trials in [20, 200, 2000]:
+        print '%10d %10.3f' % (num_trials*5 + 1, 
+                benchmark.time_construction(num_trials))
+    print
+
+    benchmark = ReadyQueueTests('test_cost_per_operation_does_not_grow')
+    print '%8s %10s' % ('trials', 'seconds')
+    for num_trials in [400, 3200]:
+        print '%8d %10.3f' % (num_trials, benchmark.time_schedule(num_trials))
+    print
+
+    benchmark = MakespanBenchmark('test_critical_path_is_fastest')
+    print 'workers=%d' % benchmark.num_workers
+    print '%8s %14s %10s %10s' % ('trials', 'critical_path', 'fifo', 'random')
+    for num_trials in [8, 32, 128]:
+        makespans = benchmark.get_makespans(num_trials)
+        print '%8d %14.1f %10.1f %10.1f' % (num_trials, 
+                makespans['critical_path'], makespans['fifo'], 
+                makespans['random'])
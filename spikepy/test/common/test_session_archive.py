@@ -0,0 +1,238 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import cPickle
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+
+import numpy
+
+from spikepy.common.trial_manager import Trial, Resource
+from spikepy.common.strategy import Strategy
+from spikepy.common.session_archive import save_session_archive,\
+        load_session_archive, ArchivedData, MANIFEST_NAME, BLOCK_DIRECTORY
+from spikepy.common.block_compression import codecs, get_suffix
+from spikepy.common.lazy_traces import LazyTraces
+from spikepy.common.errors import *
+
+def make_trial(display_name):
+    trial = Trial.from_raw_traces(1000.0, numpy.arange(20.0).reshape(2, 10),
+            origin='/data/%s.ns5' % display_name)
+    trial.display_name = display_name
+    resource = Resource('df_event_times', data=[numpy.array([0.1, 0.2]), 
+            numpy.array([], dtype=numpy.float32)])
+    resource._change_info = [{'by':'Threshold', 'with':{'threshold':4.0},
+            'using':[[(trial.trial_id, 'df_traces')]], 
+            'change_id':uuid.uuid4(), 'at':resource.change_info['at']}]
+    trial.add_resource(resource)
+    trial.add_resource(Resource('df_windows', data=numpy.array([[1, 2], [3]], 
+            dtype=object)))
+    trial.add_resource(Resource('my_clusters'))
+    return trial
+
+class SessionArchiveTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fullpath = os.path.join(self.directory, 'test.sesd')
+        self.trials = [make_trial('a'), make_trial('b')]
+        self.strategy = Strategy(methods_used={'detection':'Threshold'}, 
+                settings={'detection':{'threshold':4.0}})
+        self.strategy.name = 'Custom(custom)'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        save_session_archive(self.fullpath, self.trials, self.strategy)
+        results = load_session_archive(self.fullpath)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[-1].methods_used, 
+                self.strategy.methods_used)
+        for trial, loaded in zip(self.trials, results):
+            self.assertEqual(loaded.trial_id, trial.trial_id)
+            self.assertEqual(loaded.display_name, trial.display_name)
+            self.assertEqual(loaded.origin, trial.origin)
+            self.assertEqual(sorted(r.name for r in loaded.resources),
+                    sorted(r.name for r in trial.resources))
+            for resource in trial.resources:
+                loaded_resource = getattr(loaded, resource.name)
+                self.assertEqual(loaded_resource.change_info,
+                        resource.change_info)
+            self.assertTrue(numpy.array_equal(loaded.pf_traces.data,
+                    trial.pf_traces.data))
+            self.assertEqual(loaded.pf_sampling_freq.data, 1000.0)
+            self.assertEqual(loaded.my_clusters.data, None)
+            event_times = loaded.df_event_times.data
+            self.assertEqual(event_times[1].dtype, numpy.float32)
+            self.assertEqual(list(event_times[0]), [0.1, 0.2])
+            self.assertEqual(list(loaded.df_windows.data), [[1, 2], [3]])
+
+    def test_lazy(self):
+        save_session_archive(self.fullpath, self.trials, self.strategy)
+        loaded = load_session_archive(self.fullpath)[0]
+        # only the manifest is read until the data is asked for.
+        self.assertTrue(isinstance(loaded.pf_traces._data, ArchivedData))
+        data = loaded.pf_traces.data
+        self.assertTrue(isinstance(data, numpy.memmap))
+        self.assertFalse(isinstance(loaded.pf_traces._data, ArchivedData))
+        # copy-on-write, the file is never changed.
+        data[0, 0] = 100.0
+        self.assertEqual(load_session_archive(self.fullpath)[0].pf_traces.data[
+                0, 0], self.trials[0].pf_traces.data[0, 0])
+
+        # pickling (to send to another process) doesn't read the data.
+        copy = cPickle.loads(cPickle.dumps(loaded.df_event_times, -1))
+        self.assertTrue(isinstance(copy._data, ArchivedData))
+        self.assertEqual(len(copy.data), 2)
+
+    def test_layout(self):
+        save_session_archive(self.fullpath, self.trials, self.strategy)
+        with open(os.path.join(self.fullpath, MANIFEST_NAME)) as infile:
+            manifest = json.load(infile)
+        self.assertEqual(len(manifest['trials']), 2)
+        block_names = os.listdir(os.path.join(self.fullpath, BLOCK_DIRECTORY))
+        # pf_traces and the two event_times arrays of each trial.
+        self.assertEqual(len(block_names), 2*3)
+
+    def test_overwrite(self):
+        save_session_archive(self.fullpath, self.trials, self.strategy)
+        loaded = load_session_archive(self.fullpath)
+        save_session_archive(self.fullpath, loaded[:1], self.strategy)
+        self.assertEqual(len(load_session_archive(self.fullpath)), 2)
+        self.assertEqual(os.listdir(self.directory), ['test.sesd'])
+
+    def get_blocks(self, fullpath):
+        block_path = os.path.join(fullpath, BLOCK_DIRECTORY)
+        return dict((name, os.stat(os.path.join(block_path, name)).st_ino)
+                for name in os.listdir(block_path))
+
+    def test_incremental(self):
+        save_session_archive(self.fullpath, self.trials, self.strategy)
+        blocks = self.get_blocks(self.fullpath)
+
+        # only the changed resource is written.
+        self.trials[0].df_event_times.manually_set_data([numpy.ones(3)])
+        save_session_archive(self.fullpath, self.trials, self.strategy)
+        new_blocks = self.get_blocks(self.fullpath)
+        self.assertEqual(len(new_blocks), len(blocks) - 1)
+        added = set(new_blocks) - set(blocks)
+        self.assertEqual(len(added), 1)
+        self.assertTrue(str(self.trials[0].df_event_times.change_id) in 
+                added.pop())
+        for name in set(new_blocks) & set(blocks):
+            self.assertEqual(new_blocks[name], blocks[name])
+        self.assertFalse(os.path.exists(os.path.join(self.fullpath, 
+                MANIFEST_NAME + '.partial')))
+
+        loaded = load_session_archive(self.fullpath)
+        self.assertEqual(list(loaded[0].df_event_times.data[0]), [1.0]*3)
+        self.assertEqual(loaded[0].df_event_times.change_id, 
+                self.trials[0].df_event_times.change_id)
+
+    def test_save_loaded_elsewhere(self):
+        save_session_archive(self.fullpath, self.trials, self.strategy)
+        loaded = load_session_archive(self.fullpath)
+        # saving again, in place, leaves the blocks alone.
+        blocks = self.get_blocks(self.fullpath)
+        save_session_archive(self.fullpath, loaded[:-1], loaded[-1])
+        self.assertEqual(self.get_blocks(self.fullpath), blocks)
+
+        # blocks of data that wasn't read yet are hard-linked.
+        other_path = os.path.join(self.directory, 'other.sesd')
+        loaded[0].pf_traces.data
+        save_session_archive(other_path, loaded[:-1], loaded[-1])
+        other_blocks = self.get_blocks(other_path)
+        self.assertEqual(set(other_blocks), set(blocks))
+        linked = [name for name in blocks 
+                if other_blocks[name] == blocks[name]]
+        self.assertEqual(len(linked), len(blocks) - 1)
+        results = load_session_archive(other_path)
+        self.assertTrue(numpy.array_equal(results[1].pf_traces.data,
+                self.trials[1].pf_traces.data))
+
+    def test_compressed(self):
+        for codec_name in codecs.keys():
+            save_session_archive(self.fullpath, self.trials, self.strategy,
+                    compression=codec_name, level=1, num_threads=4)
+            for name in self.get_blocks(self.fullpath):
+                self.assertTrue(name.endswith(get_suffix(codec_name)))
+            for preload in [False, True]:
+                loaded = load_session_archive(self.fullpath, 
+                        preload=preload)[0]
+                self.assertEqual(isinstance(loaded.pf_traces._data, 
+                        ArchivedData), not preload)
+                self.assertTrue(numpy.array_equal(loaded.pf_traces.data,
+                        self.trials[0].pf_traces.data))
+                self.assertEqual(list(loaded.df_event_times.data[0]), 
+                        [0.1, 0.2])
+
+    def test_shape_without_loading(self):
+        save_session_archive(self.fullpath, self.trials, self.strategy,
+                compression='zlib')
+        loaded = load_session_archive(self.fullpath)[0]
+        self.assertEqual(loaded.num_channels, 2)
+        self.assertEqual(loaded.pf_traces.shape, (2, 10))
+        self.assertEqual(loaded.pf_traces._data.dtype, 
+                self.trials[0].pf_traces.data.dtype)
+        self.assertTrue(isinstance(loaded.pf_traces._data, ArchivedData))
+
+    def test_change_compression(self):
+        save_session_archive(self.fullpath, self.trials, self.strategy)
+        blocks = self.get_blocks(self.fullpath)
+        # blocks are rewritten when the compression changes, even if their
+        #   resources didn't.
+        save_session_archive(self.fullpath, self.trials, self.strategy, 
+                compression='zlib')
+        zlib_blocks = self.get_blocks(self.fullpath)
+        self.assertEqual(len(zlib_blocks), len(blocks))
+        self.assertEqual(sorted(name + '.zlib' for name in blocks), 
+                sorted(zlib_blocks))
+        save_session_archive(self.fullpath, self.trials, self.strategy)
+        self.assertEqual(sorted(self.get_blocks(self.fullpath)), 
+                sorted(blocks))
+
+    def make_lazy_trial(self):
+        raw_filename = os.path.join(self.directory, 'traces.dat')
+        numpy.arange(20, dtype='<i2').reshape(2, 10).tofile(raw_filename)
+        traces = LazyTraces(raw_filename, '<i2', (2, 10))
+        trial = Trial.from_raw_traces(1000.0, traces, origin=raw_filename)
+        self.assertTrue(isinstance(trial.pf_traces._data, LazyTraces))
+        return trial, raw_filename
+
+    def test_lazy_traces(self):
+        trial, raw_filename = self.make_lazy_trial()
+        expected = numpy.asarray(trial.pf_traces.data)
+        save_session_archive(self.fullpath, [trial], self.strategy, 
+                traces_by_reference=True)
+        self.assertEqual(self.get_blocks(self.fullpath), {})
+
+        # by default the traces are read and saved, so the file can go.
+        save_session_archive(self.fullpath, [trial], self.strategy)
+        self.assertEqual(len(self.get_blocks(self.fullpath)), 1)
+        os.remove(raw_filename)
+        loaded = load_session_archive(self.fullpath)[0]
+        self.assertTrue(numpy.array_equal(loaded.pf_traces.data, expected))
+
+    def test_not_an_archive(self):
+        os.mkdir(self.fullpath)
+        with open(os.path.join(self.fullpath, MANIFEST_NAME), 'w') as ofile:
+            json.dump({'format':'something else'}, ofile)
+        self.assertRaises(FileInterpretationError, load_session_archive, 
+                self.fullpath)
@@ -0,0 +1,61 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import unittest
+
+import numpy
+
+from spikepy.common.shared_arrays import SharedArray, share_arrays,\
+        attach_arrays, adopt_arrays, find_shared_arrays, unlink_arrays
+
+class SharedArrayTests(unittest.TestCase):
+    def setUp(self):
+        self.big = numpy.arange(1000, dtype=numpy.float64)
+        self.small = numpy.arange(3)
+
+    def test_threshold(self):
+        '''Only arrays at or above the threshold are shared.'''
+        packed = share_arrays([self.big, self.small, 'a string'], 1000)
+        self.assertTrue(isinstance(packed[0], SharedArray))
+        self.assertTrue(packed[1] is self.small)
+        self.assertEqual(packed[2], 'a string')
+        unlink_arrays(packed)
+
+    def test_attach_is_read_only(self):
+        packed = share_arrays([[self.big]], 0)
+        views = attach_arrays(packed)
+        self.assertTrue(numpy.all(views[0][0] == self.big))
+        self.assertRaises((ValueError, RuntimeError), 
+                views[0][0].__setitem__, 0, 5.0)
+        del views
+        unlink_arrays(packed)
+
+    def test_adopt_removes_segment(self):
+        packed = share_arrays(self.big, 0)
+        filename = packed.filename
+        self.assertTrue(os.path.exists(filename))
+        adopted = adopt_arrays(packed)
+        self.assertFalse(os.path.exists(filename))
+        self.assertTrue(numpy.all(adopted == self.big))
+        adopted[0] = 100.0 # adopted data is writeable.
+
+    def test_empty_array(self):
+        packed = share_arrays(numpy.empty((0, 4)), 0)
+        self.assertEqual(find_shared_arrays(packed), [packed])
+        self.assertEqual(adopt_arrays(packed).shape, (0, 4))
@@ -18,8 +18,15 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import unittest
 import uuid
 
+import numpy
+
 from spikepy.common.process_manager import Task
+from spikepy.common.task_manager import find_stale_tasks, fuse_tasks,\
+        FusedTask, TaskManager, IncrementalRootTask
+from spikepy.common import task_manager as task_manager_module
+from spikepy.common.memory_estimates import get_input_bytes
 from spikepy.common.trial_manager import Trial, Resource
+from spikepy.common.resource_store import DeferredData
 from spikepy.common.errors import *
 
 class FauxPlugin(object):
@@ -111,10 +118,336 @@ class TaskTests(unittest.TestCase):
         self.assertTrue(task_1.provides[1] in 
                 task_1.locking_keys.keys())
 
+    def test_cache_key(self):
+        '''cache_key depends on plugin, kwargs and input change_ids.'''
+        trial = Trial()
+        trial.add_resource(Resource('ra', data='some_data'))
+        trial.add_resource(Resource('rb'))
+        task_1 = Task([trial], plugin_1, 'plugin_category', {'a':1})
+        task_2 = Task([trial], plugin_1, 'plugin_category', {'a':1})
+        task_3 = Task([trial], plugin_1, 'plugin_category', {'a':2})
+        self.assertEqual(task_1.cache_key, task_2.cache_key)
+        self.assertNotEqual(task_1.cache_key, task_3.cache_key)
 
-        
-        
-        
-        
+        old_key = task_1.cache_key
+        trial.ra.manually_set_data('other_data')
+        self.assertNotEqual(old_key, task_1.cache_key)
+
+        stochastic_plugin = FauxPlugin(requires=['ra'], provides=['pc'])
+        stochastic_plugin.is_stochastic = True
+        task_4 = Task([trial], stochastic_plugin, 'plugin_category')
+        self.assertEqual(task_4.cache_key, None)
+
+
+class UnloadableData(DeferredData):
+    def load(self):
+        raise AssertionError('The data was loaded.')
+
+class StaleTaskTests(unittest.TestCase):
+    def setUp(self):
+        self.trial = Trial()
+        self.trial.add_resource(Resource('pf', data='raw'))
+        self.fp = FauxPlugin(requires=['pf'], provides=['df'])
+        self.fp.name = 'fp'
+        self.mp = FauxPlugin(requires=['df'], provides=['df'])
+        self.mp.name = 'mp'
+        self.dp = FauxPlugin(requires=['df'], provides=['ev'])
+        self.dp.name = 'dp'
+
+    def build_tasks(self, mp_kwargs={}, dp_kwargs={}, use_mp=True,
+            fp_kwargs={}):
+        tasks = [Task([self.trial], self.fp, 'c', fp_kwargs)]
+        if use_mp:
+            tasks.append(Task([self.trial], self.mp, 'c', mp_kwargs))
+        tasks.append(Task([self.trial], self.dp, 'c', dp_kwargs))
+        return tasks
+
+    def run_tasks(self, tasks):
+        for task in tasks:
+            task.checkout()
+            task.complete(['result'])
+
+    def test_never_run(self):
+        tasks = self.build_tasks()
+        self.assertEqual(find_stale_tasks(tasks), tasks)
+
+    def test_up_to_date(self):
+        self.run_tasks(self.build_tasks())
+        self.assertEqual(find_stale_tasks(self.build_tasks()), [])
+
+    def test_downstream_setting_changed(self):
+        self.run_tasks(self.build_tasks())
+        tasks = self.build_tasks(dp_kwargs={'a':1})
+        self.assertEqual(find_stale_tasks(tasks), tasks[-1:])
+
+    def test_modifier_setting_changed(self):
+        '''Changing a modifier reruns what it modifies and what follows.'''
+        self.run_tasks(self.build_tasks())
+        tasks = self.build_tasks(mp_kwargs={'a':1})
+        self.assertEqual(find_stale_tasks(tasks), tasks)
+
+    def test_modifier_removed(self):
+        self.run_tasks(self.build_tasks())
+        tasks = self.build_tasks(use_mp=False)
+        self.assertEqual(find_stale_tasks(tasks), tasks)
+
+    def test_upstream_rerun_alone(self):
+        '''Rerunning a stage by itself makes the stages after it stale.'''
+        self.run_tasks(self.build_tasks(use_mp=False))
+        self.run_tasks([Task([self.trial], self.fp, 'c', {'a':1})])
+        tasks = self.build_tasks(use_mp=False, fp_kwargs={'a':1})
+        self.assertEqual(find_stale_tasks(tasks), tasks[-1:])
+
+    def test_data_not_loaded(self):
+        self.run_tasks(self.build_tasks())
+        for resource in self.trial.resources:
+            resource._data = UnloadableData()
+        self.assertEqual(find_stale_tasks(self.build_tasks()), [])
+
+    def test_input_set_manually(self):
+        self.run_tasks(self.build_tasks())
+        self.trial.pf.manually_set_data('new raw')
+        tasks = self.build_tasks()
+        self.assertEqual(find_stale_tasks(tasks), tasks)
+
+
+class FusedTaskTests(unittest.TestCase):
+    def setUp(self):
+        self.trials = []
+        for i in range(2):
+            trial = Trial()
+            trial.add_resource(Resource('pf', data=i))
+            self.trials.append(trial)
+        self.fp = FauxPlugin(requires=['pf'], provides=['df'])
+        self.fp.name = 'fp'
+        self.mp = FauxPlugin(requires=['df'], provides=['df'])
+        self.mp.name = 'mp'
+        self.dp = FauxPlugin(requires=['df'], provides=['ev'])
+        self.dp.name = 'dp'
+        self.cp = FauxPlugin(requires=['ev'], provides=['cl'])
+        self.cp.name = 'cp'
+        self.cp.is_pooling = True
+        self.ap = FauxPlugin(requires=['cl', 'df'], provides=['ap'])
+        self.ap.name = 'ap'
+
+    def build_tasks(self):
+        tasks = []
+        for plugin in [self.fp, self.mp, self.dp]:
+            for trial in self.trials:
+                tasks.append(Task([trial], plugin, 'c', {}))
+        tasks.append(Task(self.trials, self.cp, 'c', {}))
+        for trial in self.trials:
+            tasks.append(Task([trial], self.ap, 'c', {}))
+        return tasks
+
+    def test_fuse_tasks(self):
+        tasks = fuse_tasks(self.build_tasks())
+        fused = [task for task in tasks if isinstance(task, FusedTask)]
+        # the tasks after the pooled task are not fused with those before.
+        self.assertEqual(len(tasks), 1 + 2*2)
+        self.assertEqual(len(fused), 2)
+        for task in fused:
+            self.assertEqual([step.plugin.name for step in task.steps],
+                    ['fp', 'mp', 'dp'])
+            trial = task.trials[0]
+            self.assertEqual(task.required_ids, [trial.pf.id])
+            self.assertEqual(set(task.provided_ids), 
+                    set([trial.df.id, trial.ev.id]))
+
+    def test_complete(self):
+        '''Fused tasks leave the same data and provenance as unfused.'''
+        trial = self.trials[0]
+        steps = [Task([trial], plugin, 'c', {}) 
+                for plugin in [self.fp, self.mp, self.dp]]
+        fused = FusedTask(steps)
+        predicted_key = fused.cache_key
+
+        run_info = fused.checkout()
+        self.assertEqual(run_info['arg_names'], ['pf'])
+        self.assertEqual(run_info['args'], [0])
+        self.assertEqual(run_info['returns'], ['df', 'ev'])
+        self.assertTrue(trial.df.is_locked)
+        fused.complete(['final_df', 'final_ev'])
+        self.assertFalse(trial.df.is_locked)
+        self.assertFalse(trial.ev.is_locked)
+        self.assertEqual(trial.df.data, 'final_df')
+        self.assertEqual(trial.ev.data, 'final_ev')
+        self.assertEqual([ci['by'] for ci in trial.df.change_info], 
+                ['fp', 'mp'])
+
+        # the change_ids the steps gave their resources were predicted.
+        fused_change_id = trial.ev.change_id
+        other_steps = [Task([trial], plugin, 'c', {})
+                for plugin in [self.fp, self.mp, self.dp]]
+        self.assertEqual(FusedTask(other_steps).cache_key, predicted_key)
+        unfused = [Task([trial], plugin, 'c', {})
+                for plugin in [self.fp, self.mp, self.dp]]
+        for task in unfused:
+            task.checkout()
+            task.complete(['result'])
+        self.assertEqual(trial.ev.change_id, fused_change_id)
+
+    def test_pooled_change_ids(self):
+        '''The trials of a pooled task don't share change_ids or keys.'''
+        for trial in self.trials:
+            trial.add_resource(Resource('ev', data=[1.0]))
+        self.cp.silent_pooling = True
+        pooled = Task(self.trials, self.cp, 'c', {})
+        pooled.checkout()
+        pooled.complete([numpy.array([1, 2])])
+        self.assertNotEqual(self.trials[0].cl.change_id, 
+                self.trials[1].cl.change_id)
+        fp = FauxPlugin(requires=['cl'], provides=['ft'])
+        tasks = [Task([trial], fp, 'c', {}) for trial in self.trials]
+        self.assertNotEqual(tasks[0].cache_key, tasks[1].cache_key)
+        # even the same inputs give each trial its own results.
+        self.trials[1].cl._change_info = self.trials[0].cl.change_info
+        self.assertNotEqual(tasks[0].cache_key, tasks[1].cache_key)
+
+    def test_worker_cache_keys(self):
+        '''Resources of different trials never share a worker cache key.'''
+        self.trials[1].pf._change_info = self.trials[0].pf.change_info
+        tasks = [Task([trial], self.fp, 'c', {}) for trial in self.trials]
+        run_infos = [task.checkout() for task in tasks]
+        for task in tasks:
+            task.complete(['result'])
+        self.assertNotEqual(run_infos[0]['arg_keys'], 
+                run_infos[1]['arg_keys'])
+        self.assertNotEqual(run_infos[0]['result_keys'], 
+                run_infos[1]['result_keys'])
+        fused = [FusedTask([Task([trial], plugin, 'c', {}) 
+                for plugin in [self.mp, self.dp]]).checkout()
+                for trial in self.trials]
+        self.assertEqual(fused[0]['arg_keys'], [(self.trials[0].df.id, 
+                self.trials[0].df.change_id)])
+        self.assertNotEqual(fused[0]['arg_keys'], fused[1]['arg_keys'])
+
+    def test_remove_dependent_tasks(self):
+        '''A failed task only cancels the tasks that depend on it.'''
+        tasks = self.build_tasks()
+        task_manager = TaskManager(policy='fifo')
+        for task in tasks:
+            task_manager.add_task(task)
+        task_manager.add_root_task(IncrementalRootTask(tasks))
+
+        failed = tasks[2] # mp on the first trial.
+        removed = task_manager.remove_dependent_tasks(failed)
+        self.assertEqual(sorted(str(task) for task in removed), 
+                sorted(str(task) for task in [tasks[4], tasks[6], tasks[7], 
+                tasks[8]]))
+        self.assertTrue(tasks[5] in task_manager.tasks)
+        self.assertTrue(tasks[3] in task_manager.tasks)
+
+class AliasTaskTests(unittest.TestCase):
+    def setUp(self):
+        self.trial = Trial()
+        self.trial.add_resource(Resource('pf', data=numpy.arange(5.0)))
+        self.fp = FauxPlugin(requires=['pf'], provides=['df'])
+        self.fp.name = 'fp'
+        self.fp.aliases = ['pf']
+        self.dp = FauxPlugin(requires=['df'], provides=['ev'])
+        self.dp.name = 'dp'
+        self.ep = FauxPlugin(requires=['ev'], provides=['ef'])
+        self.ep.name = 'ep'
+        self.ep.aliases = [None]
+        self.xp = FauxPlugin(requires=['ef', 'ev'], provides=['ft'])
+        self.xp.name = 'xp'
+
+    def test_is_alias(self):
+        self.assertTrue(Task([self.trial], self.fp, 'c', {}).is_alias)
+        self.assertFalse(Task([self.trial], self.dp, 'c', {}).is_alias)
+        self.assertFalse(Task([self.trial], self.ep, 'c', {}).is_alias)
+
+    def test_shared_data(self):
+        task = Task([self.trial], self.fp, 'c', {})
+        task.checkout()
+        task.complete(task.alias_result())
+        pf = self.trial.pf.data
+        df = self.trial.df.data
+        self.assertTrue(numpy.may_share_memory(pf, df))
+        self.assertEqual(self.trial.df.change_info[0]['by'], 'fp')
+        # the alias cannot change the data in place...
+        self.assertRaises(ValueError, df.__setitem__, 0, 10.0)
+        # ...but new data replaces it, leaving the original alone.
+        key = self.trial.df.checkout()['locking_key']
+        self.trial.df.checkin({'data':df*2, 'change_info':{'by':'mp', 
+                'with':{}, 'using':[]}}, key=key)
+        self.assertEqual(list(self.trial.df.data), [0.0, 2.0, 4.0, 6.0, 8.0])
+        self.assertEqual(list(self.trial.pf.data), [0.0, 1.0, 2.0, 3.0, 4.0])
+
+    def test_not_fused(self):
+        '''Alias tasks split the chains they are in, like pooling tasks.'''
+        self.ep.aliases = ['ev']
+        tasks = [Task([self.trial], plugin, 'c', {}) 
+                for plugin in [self.fp, self.dp, self.ep, self.xp]]
+        fused = fuse_tasks(tasks)
+        self.assertEqual(len(fused), 4)
+        self.assertFalse(True in [isinstance(task, FusedTask) 
+                for task in fused])
+
+class MemoryBudgetTests(unittest.TestCase):
+    def setUp(self):
+        self.plugin = FauxPlugin(requires=['pf'], provides=['df'])
+        self.plugin.name = 'fp'
+        self.tasks = []
+        for i in range(4):
+            trial = Trial()
+            trial.add_resource(Resource('pf', data=numpy.zeros(125)))
+            self.tasks.append(Task([trial], self.plugin, 'c', {}))
+
+    def build_task_manager(self, memory_budget):
+        task_manager = TaskManager(policy='fifo', memory_budget=memory_budget)
+        for task in self.tasks:
+            task_manager.add_task(task)
+        task_manager.add_root_task(IncrementalRootTask(self.tasks))
+        return task_manager
+
+    def checkout_all(self, task_manager):
+        checked_out = []
+        task = task_manager.get_next_task()
+        while task is not None:
+            task_manager.checkout_task(task)
+            checked_out.append(task)
+            task = task_manager.get_next_task()
+        return checked_out
+
+    def test_budget(self):
+        # each task is estimated at 3*1000 bytes, two fit in the budget.
+        task_manager = self.build_task_manager(memory_budget=7000)
+        checked_out = self.checkout_all(task_manager)
+        self.assertEqual(len(checked_out), 2)
+        self.assertEqual(task_manager.admitted_memory, 6000)
+
+        task_manager.complete_task(checked_out[0], ['result'])
+        self.assertEqual(task_manager.admitted_memory, 3000)
+        self.assertEqual(len(self.checkout_all(task_manager)), 1)
+
+    def test_always_admits_one(self):
+        task_manager = self.build_task_manager(memory_budget=1)
+        checked_out = self.checkout_all(task_manager)
+        self.assertEqual(len(checked_out), 1)
+        task_manager.complete_task(checked_out[0], ['result'])
+        self.assertEqual(task_manager.admitted_memory, 0)
+        self.assertEqual(len(self.checkout_all(task_manager)), 1)
 
+    def test_no_budget(self):
+        task_manager = self.build_task_manager(memory_budget=None)
+        self.assertEqual(len(self.checkout_all(task_manager)), 4)
 
+    def test_inputs_measured_once(self):
+        measured = []
+        def counting_get_input_bytes(task):
+            measured.append(task)
+            return get_input_bytes(task)
+        task_manager_module.get_input_bytes = counting_get_input_bytes
+        try:
+            task_manager = self.build_task_manager(memory_budget=7000)
+            self.assertEqual(len(self.checkout_all(task_manager)), 2)
+            # the third task is held back, polling must not re-measure it.
+            for i in range(10):
+                self.assertTrue(task_manager.get_next_task() is None)
+        finally:
+            task_manager_module.get_input_bytes = get_input_bytes
+        # two checked out tasks and the held back one, each measured once.
+        self.assertEqual(len(measured), 3)
+        self.assertEqual(len(set(measured)), 3)
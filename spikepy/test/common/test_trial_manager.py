@@ -0,0 +1,131 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import time
+import unittest
+
+import numpy
+
+from spikepy.common.trial_manager import TrialManager, Trial, Resource
+from spikepy.common.errors import *
+
+def make_trials(num_trials, num_channels=1, display_name='trial'):
+    trials = []
+    for i in range(num_trials):
+        trial = Trial(display_name=display_name)
+        trial.add_resource(Resource('pf_traces', 
+                data=numpy.zeros((num_channels, 2))))
+        trials.append(trial)
+    return trials
+
+class TrialManagerTests(unittest.TestCase):
+    def setUp(self):
+        self.tm = TrialManager()
+        self.trials = self.tm.add_trials(make_trials(3, display_name='a'))
+
+    def test_unique_names(self):
+        self.assertEqual([t.display_name for t in self.trials], 
+                ['a', 'a(1)', 'a(2)'])
+        self.tm.remove_trial(self.trials[1])
+        new_trial = self.tm.add_trials(make_trials(1, display_name='a'))[0]
+        self.assertEqual(new_trial.display_name, 'a(1)')
+
+    def test_get_trial_with_name(self):
+        self.assertTrue(self.tm.get_trial_with_name('a') is self.trials[0])
+        self.assertTrue(self.tm.get_trial_with_name('(2') is self.trials[2])
+        self.assertRaises(MissingTrialError, self.tm.get_trial_with_name, 
+                '(')
+        self.assertRaises(MissingTrialError, self.tm.get_trial_with_name, 
+                'b')
+
+    def test_rename(self):
+        self.tm.rename_trial('a(1)', 'b')
+        self.assertTrue(self.tm.get_trial_with_name('b') is self.trials[1])
+        self.assertRaises(MissingTrialError, self.tm.get_trial_with_name, 
+                'a(1)')
+        self.assertEqual(self.tm.all_display_names, set(['a', 'b', 'a(2)']))
+
+    def test_remove(self):
+        self.tm.remove_trial(self.trials[0])
+        self.assertEqual(len(self.tm.trials), 2)
+        self.assertEqual(len(self.tm.marked_trials), 2)
+        self.assertTrue(self.tm.get_trial_with_name('a(2)') is 
+                self.trials[2])
+        # 'a' is no longer a full name, and is part of two.
+        self.assertRaises(MissingTrialError, self.tm.get_trial_with_name, 
+                'a')
+
+    def test_marking(self):
+        self.assertEqual(set(self.tm.marked_trial_ids), 
+                set(t.trial_id for t in self.trials))
+        self.tm.mark_trial('a(1)', False)
+        self.assertEqual(set(self.tm.marked_trials), 
+                set([self.trials[0], self.trials[2]]))
+        self.assertFalse(self.trials[1].is_marked)
+
+        # trials with a different number of channels cannot be marked.
+        other = self.tm.add_trials(make_trials(1, num_channels=2))[0]
+        self.assertFalse(other.is_marked)
+        self.assertEqual(len(self.tm.marked_trials), 2)
+        for trial in self.trials:
+            self.tm.mark_trial(trial.display_name, False)
+        self.tm.mark_trial(other.display_name, True)
+        self.assertEqual(self.tm.marked_trials, [other])
+
+
+class TrialManagerBenchmark(unittest.TestCase):
+    '''
+        Times adding, marking and finding trials in large sessions.  Run 
+    this module directly to see the times for up to 10^4 trials.
+    '''
+    def time_operations(self, num_trials):
+        trials = make_trials(num_trials)
+        tm = TrialManager()
+        times = {}
+        start_time = time.time()
+        tm.add_trials(trials)
+        times['add'] = time.time() - start_time
+
+        start_time = time.time()
+        for trial in trials:
+            tm.mark_trial(trial.display_name, False)
+        for trial in trials[::10]:
+            tm.mark_trial(trial.display_name, True)
+        for i in range(100):
+            tm.marked_trials
+        times['mark'] = time.time() - start_time
+
+        start_time = time.time()
+        for trial in trials:
+            tm.get_trial_with_name(trial.display_name)
+        times['lookup'] = time.time() - start_time
+        return times
+
+    def test_operations_are_not_quadratic(self):
+        small = self.time_operations(500)
+        large = self.time_operations(5000)
+        # 10 times the trials, a quadratic registry takes 100 times longer.
+        for key in small.keys():
+            self.assertTrue(large[key] < 30*max(small[key], 1e-3))
+
+
+if __name__ == '__main__':
+    benchmark = TrialManagerBenchmark('test_operations_are_not_quadratic')
+    print '%8s %10s %10s %10s' % ('trials', 'add(s)', 'mark(s)', 'lookup(s)')
+    for num_trials in [100, 1000, 10000]:
+        times = benchmark.time_operations(num_trials)
+        print '%8d %10.3f %10.3f %10.3f' % (num_trials, times['add'],
+                times['mark'], times['lookup'])
@@ -0,0 +1,268 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import os
+import Queue
+import unittest
+from collections import OrderedDict
+
+import numpy
+
+from spikepy.common.worker_pool import WorkerPool, WorkerResourceCache,\
+        is_transient_failure, job_runners
+from spikepy.common.shared_arrays import share_arrays
+
+def make_payload(task_id, args, arg_keys, result_keys):
+    return {'task_id':task_id, 'args':args, 'arg_keys':arg_keys,
+            'result_keys':result_keys, 'shared_memory_threshold':None}
+
+class WorkerResourceCacheTests(unittest.TestCase):
+    def test_prepare_args(self):
+        cache = WorkerResourceCache()
+        data = numpy.arange(10)
+        args = cache.prepare_args({'args':[data],
+                'store_args':[(0, ('a', 'df'))]})
+        self.assertTrue(numpy.all(args[0] == data))
+        args = cache.prepare_args({'args':[None],
+                'cached_args':[(0, ('a', 'df'))]})
+        self.assertTrue(numpy.all(args[0] == data))
+        # cached arrays can't be changed by a plugin.
+        self.assertRaises(ValueError, args[0].__setitem__, 0, 5)
+
+    def test_plugin_cannot_change_cache(self):
+        cache = WorkerResourceCache()
+        args = cache.prepare_args({'args':[numpy.arange(10)],
+                'store_args':[(0, ('a', 'df'))]})
+        # a plugin changing its argument in place fails, on the first
+        #   dispatch just as on a cache hit.
+        self.assertRaises(ValueError, args[0].__setitem__, 0, 99)
+        args = cache.prepare_args({'args':[None],
+                'cached_args':[(0, ('a', 'df'))]})
+        self.assertTrue(numpy.array_equal(args[0], numpy.arange(10)))
+
+    def test_forget_results(self):
+        cache = WorkerResourceCache()
+        task_info = {'store_results':[(0, ('b', 'df'))]}
+        cache.store_results(task_info, [numpy.arange(3)])
+        self.assertEqual(len(cache), 1)
+        cache.forget_results(task_info)
+        self.assertEqual(len(cache), 0)
+
+
+class WorkerPoolRoutingTests(unittest.TestCase):
+    '''The routing is tested without starting any worker processes.'''
+    def setUp(self):
+        self.pool = WorkerPool(num_workers=2, cache_size=1000)
+        self.pool.start = lambda: None
+        self.pool._input_queues = [Queue.Queue(), Queue.Queue()]
+        self.pool._running_jobs = {0:None, 1:None}
+        self.pool._mirrors = [OrderedDict(), OrderedDict()]
+
+    def finish(self, worker_index, result):
+        message = self.pool._input_queues[worker_index].get_nowait()
+        self.pool._job_finished({'worker':worker_index,
+                'channel':message['channel'], 'job_id':message['job_id'],
+                'result':{'result':result}})
+        return message
+
+    def test_affinity(self):
+        '''A job goes to the worker that produced its arguments.'''
+        pool = self.pool
+        data = numpy.arange(10)
+        pool.submit('task', make_payload(1, [data], [('a', 'raw')],
+                [('b', 'df')]), 'c')
+        pool.submit('task', make_payload(2, [data], [('x', 'raw')],
+                [('y', 'df')]), 'c')
+        first = self.finish(0, [data])
+        self.assertEqual(first['payload']['store_args'], [(0, ('a', 'raw'))])
+        self.finish(1, [data])
+
+        pool.submit('task', make_payload(3, [data], [('y', 'df')],
+                [('z', 'cl')]), 'c')
+        self.assertTrue(pool._input_queues[0].empty())
+        message = pool._input_queues[1].get_nowait()
+        self.assertEqual(message['payload']['args'], [None])
+        self.assertEqual(message['payload']['cached_args'], [(0, ('y', 'df'))])
+
+    def test_work_stealing(self):
+        '''If the preferred worker is busy, another worker takes the job.'''
+        pool = self.pool
+        data = numpy.arange(10)
+        pool.submit('task', make_payload(1, [data], [('a', 'raw')],
+                [('b', 'df')]), 'c')
+        self.finish(0, [data])
+        pool.submit('task', make_payload(2, [data], [('b', 'df')],
+                [('c', 'df')]), 'c')
+        pool.submit('task', make_payload(3, [data], [('b', 'df')],
+                [('d', 'df')]), 'c')
+        self.assertEqual(pool._input_queues[0].qsize(), 1)
+        message = pool._input_queues[1].get_nowait()
+        self.assertTrue(message['payload']['args'][0] is data)
+
+    def test_eviction(self):
+        '''The least recently used resources are evicted to fit the cache.'''
+        pool = self.pool
+        pool._running_jobs = {0:None}
+        big = numpy.arange(100, dtype=numpy.float64) # 800 bytes
+        pool.submit('task', make_payload(1, [big], [('a', 'raw')],
+                [('b', 'df')]), 'c')
+        self.finish(0, [big])
+        pool.submit('task', make_payload(2, [big], [('x', 'raw')],
+                [('y', 'df')]), 'c')
+        message = self.finish(0, [big])
+        self.assertEqual(message['evict'], [('a', 'raw'), ('b', 'df')])
+        self.assertEqual(pool._mirrors[0].keys(), [('x', 'raw'), ('y', 'df')])
+
+    def test_dead_worker_replaced(self):
+        '''The job of a worker that died fails and the worker is replaced.'''
+        pool = self.pool
+        started = []
+        def start_worker(worker_index):
+            started.append(worker_index)
+            pool._workers[worker_index] = FakeProcess(alive=True)
+            pool._running_jobs[worker_index] = None
+            pool._mirrors[worker_index] = OrderedDict()
+        pool._start_worker = start_worker
+        pool._workers = [FakeProcess(alive=True), FakeProcess(alive=False)]
+
+        data = numpy.arange(10)
+        pool.submit('task', make_payload(1, [data], [('a', 'raw')],
+                [('b', 'df')]), 'c')
+        pool.submit('task', make_payload(2, [data], [('x', 'raw')],
+                [('y', 'df')]), 'c')
+        messages = pool._replace_dead_workers()
+        self.assertEqual(started, [1])
+        self.assertEqual(len(messages), 1)
+        result = messages[0]['result']
+        self.assertEqual(result['task_id'], 2)
+        self.assertTrue(result['result'] is None)
+        self.assertTrue(is_transient_failure(result))
+
+        pool._job_finished(messages[0])
+        self.assertTrue(pool._running_jobs[1] is None)
+        self.assertEqual(pool._mirrors[1].keys(), [])
+
+    def test_cancel(self):
+        '''Waiting and running jobs are cancelled right away.'''
+        pool = self.pool
+        def start_worker(worker_index):
+            pool._workers[worker_index] = FakeProcess(alive=True)
+            pool._running_jobs[worker_index] = None
+            pool._mirrors[worker_index] = OrderedDict()
+        pool._start_worker = start_worker
+        pool._workers = [FakeProcess(alive=True), FakeProcess(alive=True)]
+        pool._running_jobs = {0:None}
+
+        data = numpy.arange(10)
+        for task_id in [1, 2]:
+            pool.submit('task', make_payload(task_id, [data], [('a', 'raw')],
+                    [('b', 'df')]), 'c')
+        stale = pool._input_queues[0].get_nowait()
+        pool.cancel('c')
+        results = sorted(pool._pending['c'], key=lambda r:r['task_id'])
+        self.assertEqual([r['error_type'] for r in results],
+                ['CancelledError']*2)
+        # the worker is replaced, not killed, and finishes its job first.
+        self.assertTrue(pool._workers[0].alive)
+        self.assertTrue(pool._workers[0] is not pool._retired[0][0])
+        self.assertTrue(pool._retired[0][0].alive)
+        self.assertTrue(pool._running_jobs[0] is None)
+        # the result the old worker sends is ignored, and its shared
+        #   memory freed.
+        shared = share_arrays([data], 0)
+        self.assertFalse(pool._job_finished({'worker':0, 'channel':'c',
+                'job_id':stale['job_id'], 'result':{'result':shared}}))
+        self.assertFalse(os.path.exists(shared[0].filename))
+
+
+def report_pid(payload, resource_cache=None):
+    return {'task_id':payload['task_id'], 'result':[os.getpid()]}
+
+class WorkerPoolProcessTests(unittest.TestCase):
+    '''These start real worker processes.'''
+    def setUp(self):
+        # workers are forked, so they know this job kind too.
+        job_runners['report_pid'] = report_pid
+        self.pool = WorkerPool(num_workers=2, cache_size=0)
+        self.pool.poll_interval = 0.1
+
+    def tearDown(self):
+        self.pool.shutdown()
+        del job_runners['report_pid']
+
+    def run_jobs(self, num_jobs):
+        '''Return the results of <num_jobs> jobs.'''
+        channel = self.pool.new_channel()
+        for task_id in range(num_jobs):
+            self.pool.submit('report_pid', {'task_id':task_id}, channel)
+        results = [self.pool.get_result(channel) for i in range(num_jobs)]
+        self.assertEqual(sorted(r['task_id'] for r in results), 
+                range(num_jobs))
+        return results
+
+    def get_pids(self, results):
+        return set(r['result'][0] for r in results)
+
+    def test_workers_persist(self):
+        self.pool.start()
+        pids = set(worker.pid for worker in self.pool._workers)
+        self.assertEqual(len(pids), 2)
+        self.assertTrue(self.get_pids(self.run_jobs(6)) <= pids)
+        self.assertTrue(self.get_pids(self.run_jobs(6)) <= pids)
+        self.assertEqual(set(worker.pid for worker in self.pool._workers),
+                pids)
+
+        workers = list(self.pool._workers)
+        self.pool.shutdown()
+        self.assertFalse(self.pool.is_running)
+        for worker in workers:
+            self.assertFalse(worker.is_alive())
+            self.assertEqual(worker.exitcode, 0)
+
+    def test_dead_worker_replaced(self):
+        self.pool.start()
+        dead = self.pool._workers[0]
+        dead.terminate()
+        dead.join()
+        # a job sent to the dead worker fails, and can be retried.
+        results = self.run_jobs(4)
+        failed = [r for r in results if r['result'] is None]
+        self.assertTrue(len(failed) <= 1)
+        for result in failed:
+            self.assertTrue(is_transient_failure(result))
+        replacement = self.pool._workers[0]
+        self.assertTrue(replacement.is_alive())
+        self.assertTrue(replacement.pid != dead.pid)
+        pids = self.get_pids(self.run_jobs(4))
+        self.assertFalse(dead.pid in pids)
+
+
+class FakeProcess(object):
+    def __init__(self, alive):
+        self.alive = alive
+        self.exitcode = None if alive else -9
+
+    def is_alive(self):
+        return self.alive
+
+    def terminate(self):
+        self.alive = False
+        self.exitcode = -15
+
+    def join(self):
+        pass
@@ -0,0 +1,100 @@
+"""
+Copyright (C) 2011  David Morton
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import cPickle
+import time
+import unittest
+
+from spikepy.utils.substring_dict import SubstringDict
+
+class SubstringDictTests(unittest.TestCase):
+    def setUp(self):
+        self.sd = SubstringDict()
+        for name in ['Threshold', 'Threshold 2', 'K-means', 'Spike Window']:
+            self.sd[name] = name.lower()
+
+    def test_exact(self):
+        # exact keys win even if they are part of other keys.
+        self.assertEqual(self.sd['Threshold'], 'threshold')
+        self.assertEqual(self.sd['Threshold 2'], 'threshold 2')
+
+    def test_substring(self):
+        self.assertEqual(self.sd['K-m'], 'k-means')
+        self.assertEqual(self.sd['e W'], 'spike window')
+        self.assertEqual(self.sd['Window'], 'spike window')
+        self.assertEqual(self.sd[' 2'], 'threshold 2')
+
+    def test_invalid(self):
+        for key in ['Thresh', 'old', 'x', 'Spike Windows', '', 3]:
+            self.assertRaises(KeyError, self.sd.__getitem__, key)
+            # again, from the cached result.
+            self.assertRaises(KeyError, self.sd.__getitem__, key)
+
+    def test_mutation(self):
+        self.assertEqual(self.sd['K-m'], 'k-means')
+        self.sd['K-medians'] = 'k-medians'
+        self.assertRaises(KeyError, self.sd.__getitem__, 'K-m')
+        del self.sd['K-means']
+        self.assertEqual(self.sd['K-m'], 'k-medians')
+        self.sd.pop('Threshold 2')
+        self.assertEqual(self.sd['Thresh'], 'threshold')
+        self.sd.update({'Threshold 3':None})
+        self.assertRaises(KeyError, self.sd.__getitem__, 'Thresh')
+        self.sd.clear()
+        self.assertRaises(KeyError, self.sd.__getitem__, 'Window')
+        self.sd.setdefault('Window', 1)
+        self.assertEqual(self.sd['Win'], 1)
+
+    def test_pickle(self):
+        self.sd['Threshold']
+        for protocol in [0, 2]:
+            copy = cPickle.loads(cPickle.dumps(self.sd, protocol))
+            self.assertEqual(copy, self.sd)
+            self.assertEqual(copy['K-m'], 'k-means')
+            copy['K-medians'] = None
+            self.assertRaises(KeyError, copy.__getitem__, 'K-m')
+
+
+class SubstringDictBenchmark(unittest.TestCase):
+    '''
+        Times finding keys by substring in large dictionaries.  Run this 
+    module directly to see the times for up to 10^4 keys.
+    '''
+    def time_lookups(self, num_keys, num_lookups=1000):
+        sd = SubstringDict()
+        for i in range(num_keys):
+            sd['recording_%05d.ns5' % i] = i
+        keys = ['ing_%05d' % (i*num_keys/num_lookups) 
+                for i in range(num_lookups)]
+        sd['ing_'] = None # builds the index, then keeps it up to date.
+        self.assertRaises(KeyError, sd.__getitem__, 'ing_0')
+        start_time = time.time()
+        for key in keys:
+            sd[key]
+        return time.time() - start_time
+
+    def test_lookups_do_not_scan(self):
+        small = min(self.time_lookups(100) for i in range(2))
+        large = min(self.time_lookups(10000) for i in range(2))
+        # a scan of every key takes 100 times longer.
+        self.assertTrue(large < 20*max(small, 1e-3))
+
+
+if __name__ == '__main__':
+    benchmark = SubstringDictBenchmark('test_lookups_do_not_scan')
+    print '%8s %12s' % ('keys', '1000 lookups(s)')
+    for num_keys in [100, 1000, 10000]:
+        print '%8d %12.4f' % (num_keys, benchmark.time_lookups(num_keys))
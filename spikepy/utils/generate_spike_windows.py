@@ -39,8 +39,10 @@ def generate_spike_windows(signal, sampling_freq, event_times,
     if len(collapsed_event_times) == 0:
         # need to return something compatible in shape with what would have
         # been returned if there were event_times.
-        return [numpy.empty((0, window_size)),numpy.empty(0),
-                numpy.empty((0, window_size)),numpy.empty(0)]
+        return [numpy.empty((0, window_size), dtype=signal.dtype),
+                numpy.empty(0),
+                numpy.empty((0, window_size), dtype=signal.dtype),
+                numpy.empty(0)]
 
     spike_index_list = numpy.array(collapsed_event_times, 
             dtype=numpy.float64)*sampling_freq
@@ -15,21 +15,130 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+_missing = object()
+
 class SubstringDict(dict):
     '''
         A dictionary whose elements can be fetched either by giving the full
     key or a unique subset of the key.  Raises a KeyError if the key provided
     isn't a unique subset of any key.
+        Full keys are found like in any dictionary.  Subsets are found with
+    an index of the substrings (up to ngram_size long) of every string key,
+    and are remembered until the dictionary is next changed.
     '''
-    def __getitem__(self, key):
-        if key in self.keys():
-            return dict.__getitem__(self, key)
+    ngram_size = 3
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._changed()
+
+    def __getstate__(self):
+        # the index is rebuilt when it is next needed.
+        return {}
+
+    def _changed(self):
+        self._index = None
+        self._found = {} # subset -> the key it was found in (or None).
+
+    def _ngrams(self, key, size):
+        return [key[i:i+size] for i in xrange(len(key)-size+1)]
+
+    def _substrings(self, key):
+        result = set()
+        for size in xrange(1, self.ngram_size+1):
+            result.update(self._ngrams(key, size))
+        return result
+
+    def _add_to_index(self, index, key):
+        if isinstance(key, basestring):
+            for substring in self._substrings(key):
+                index.setdefault(substring, set()).add(key)
+
+    def _remove_from_index(self, index, key):
+        if isinstance(key, basestring):
+            for substring in self._substrings(key):
+                keys = index[substring]
+                keys.discard(key)
+                if not keys:
+                    del index[substring]
+
+    @property
+    def _substring_index(self):
+        '''A dictionary of substring -> set of keys containing it.'''
+        if getattr(self, '_index', None) is None:
+            self._index = {}
+            for key in self.iterkeys():
+                self._add_to_index(self._index, key)
+        return self._index
+
+    def _find_key(self, key):
+        '''Return the only key that <key> is a subset of, or None.'''
+        if not isinstance(key, basestring):
+            return None
+        if len(key) == 0:
+            candidates = self.keys()
+        elif len(key) <= self.ngram_size:
+            candidates = self._substring_index.get(key, ())
         else:
-            pkeys = []
-            for skey in self.keys():
-                if key in skey:
-                    pkeys.append(skey)
-            if len(pkeys) == 1:
-                return dict.__getitem__(self, pkeys[0])
-            else:
-                raise KeyError("%s is an invalid key." % key)
+            index = self._substring_index
+            ngram_sets = [index.get(ngram, ()) 
+                    for ngram in self._ngrams(key, self.ngram_size)]
+            candidates = min(ngram_sets, key=len)
+            candidates = [c for c in candidates if key in c]
+        if len(candidates) == 1:
+            return iter(candidates).next()
+        return None
+
+    def __getitem__(self, key):
+        value = dict.get(self, key, _missing)
+        if value is not _missing:
+            return value
+
+        if getattr(self, '_found', None) is None:
+            self._found = {}
+        if key not in self._found:
+            self._found[key] = self._find_key(key)
+        if self._found[key] is None:
+            raise KeyError("%s is an invalid key." % key)
+        return dict.__getitem__(self, self._found[key])
+
+    def __setitem__(self, key, value):
+        is_new = key not in self
+        dict.__setitem__(self, key, value)
+        if is_new:
+            index = getattr(self, '_index', None)
+            self._changed()
+            if index is not None: # keep the index up to date.
+                self._add_to_index(index, key)
+                self._index = index
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        index = getattr(self, '_index', None)
+        self._changed()
+        if index is not None: # keep the index up to date.
+            self._remove_from_index(index, key)
+            self._index = index
+
+    def clear(self):
+        dict.clear(self)
+        self._changed()
+
+    def pop(self, *args):
+        result = dict.pop(self, *args)
+        self._changed()
+        return result
+
+    def popitem(self):
+        result = dict.popitem(self)
+        self._changed()
+        return result
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self._changed()